@@ -0,0 +1,158 @@
+# src/plugins/My_Fucked_turtle_soup/annotate.py
+"""
+海龟汤本地题库离线标注工具。
+
+按 turtle.json (或 turtle.jsonl) 编译本地题库，用固定数量的并发协程为每个题目生成分级提示、线索整理、
+汤底关键词和常见问题，结果按题目内容哈希追加写入插件目录下的 turtle_annotations.jsonl。
+中断后重新运行会跳过已经标注且内容未变化的题目；加上 --force 则全部重新标注。
+已不在题库中的题目的标注默认保留，加上 --prune 才会删除。
+插件运行时，已标注的本地题目开局后提示、整理线索和常见问题都直接读取标注，不再调用LLM。
+与插件中的 /hgt 预处理 使用同一套逻辑。
+
+用法 (在 MaiBot 根目录下运行，以便导入 src.plugin_system)：
+    python src/plugins/My_Fucked_turtle_soup/annotate.py
+    python src/plugins/My_Fucked_turtle_soup/annotate.py --concurrency 8 --model deepseek-ai/DeepSeek-V3
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import importlib.util
+from typing import Any, Dict, Optional
+
+try:
+    import tomllib # Python 3.11+，用于读取插件的 config.toml
+except ImportError:
+    tomllib = None
+
+PLUGIN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plugin.py")
+
+
+# --- 加载插件 ---
+def _add_maibot_root(explicit: Optional[str]):
+    """把 MaiBot 根目录加入 sys.path，以便插件导入 src.plugin_system"""
+    candidates = [explicit] if explicit else []
+    candidates.append(os.getcwd())
+    path = os.path.dirname(PLUGIN_FILE)
+    for _ in range(4):
+        path = os.path.dirname(path)
+        candidates.append(path)
+    for root in candidates:
+        if root and os.path.isdir(os.path.join(root, "src", "plugin_system")):
+            sys.path.insert(0, root)
+            return
+    raise SystemExit("找不到 src/plugin_system，请在 MaiBot 根目录下运行或使用 --maibot-root 指定。")
+
+
+def _load_plugin(plugin_dir: Optional[str]):
+    """导入 plugin.py，plugin_dir 不为空时把插件数据目录 (题库、标注文件) 指向该目录"""
+    spec = importlib.util.spec_from_file_location("hgt_plugin_annotate", PLUGIN_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if plugin_dir:
+        module.PLUGIN_DIR = plugin_dir
+    return module
+
+
+def _read_config(plugin_dir: str) -> dict:
+    """读取插件的 config.toml，文件不存在或缺少 tomllib 时返回空配置"""
+    path = os.path.join(plugin_dir, "config.toml")
+    if not os.path.exists(path):
+        return {}
+    if tomllib is None:
+        print("[Annotate] 当前 Python 不支持 tomllib，忽略 config.toml，请通过命令行参数指定 LLM 配置。")
+        return {}
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+def _config_getter(config: dict):
+    def get_config(key: str, default: Any = None) -> Any:
+        current = config
+        for part in key.split("."):
+            if not isinstance(current, dict) or part not in current:
+                return default
+            current = current[part]
+        return current
+    return get_config
+
+
+# --- 标注 ---
+async def run_annotate(args) -> Dict[str, int]:
+    plugin = _load_plugin(args.plugin_dir)
+    get_config = _config_getter(_read_config(plugin.PLUGIN_DIR))
+    api_url = (args.api_url or get_config("llm.api_url", "")).strip()
+    api_key = (args.api_key or get_config("llm.api_key", "")).strip()
+    model = args.model or get_config("llm.model", "deepseek-ai/DeepSeek-V3")
+    temperature = args.temperature if args.temperature is not None else get_config("llm.temperature", 0.7)
+    concurrency = max(1, args.concurrency or get_config("annotations.concurrency", 4))
+    if not (api_url and api_key):
+        raise SystemExit("缺少 LLM API 地址或密钥，请在 config.toml 中配置或使用 --api-url/--api-key 指定。")
+
+    # 只创建标注需要的 HTTP 客户端和调度器，不恢复游戏存档，避免与运行中的插件互相覆盖
+    plugin.llm_client = plugin.LLMClient(
+        limit_per_host=max(concurrency, get_config("http.limit_per_host", 8)),
+        dns_cache_ttl=get_config("http.dns_cache_ttl", 300),
+        keepalive_timeout=get_config("http.keepalive_timeout", 30.0),
+        request_timeout=get_config("http.request_timeout", 30.0),
+    )
+    plugin.llm_scheduler = plugin.LLMScheduler(
+        max_concurrency=concurrency,
+        rate_per_second=get_config("scheduler.rate_per_second", 5.0),
+        burst=get_config("scheduler.burst", 10.0),
+    )
+    plugin.local_turtle_soups = plugin._open_local_library()
+    success, message = await plugin._load_local_turtle_soups()
+    if not success:
+        raise SystemExit(message)
+    library = plugin.local_turtle_soups
+    annotations = plugin.SoupAnnotations()
+    annotations.load()
+
+    started = time.monotonic()
+
+    def on_progress(stats: Dict[str, int]):
+        finished = stats["done"] + stats["failed"]
+        remaining = stats["total"] - stats["skipped"]
+        print(
+            f"[Annotate] {finished}/{remaining} (成功 {stats['done']}，失败 {stats['failed']})，"
+            f"已用 {time.monotonic() - started:.0f}s"
+        )
+
+    print(f"[Annotate] 使用模型 {model}，并发 {concurrency}，标注文件 {annotations.path}")
+    try:
+        return await plugin._annotate_library(
+            library, annotations, api_url, api_key, model, temperature,
+            concurrency=concurrency, force=args.force, prune=args.prune, on_progress=on_progress
+        )
+    finally:
+        library.close()
+        await plugin.llm_client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="海龟汤本地题库离线标注 (提示、线索整理、关键词、常见问题)")
+    parser.add_argument("--api-url", help="LLM API 地址，默认读取 config.toml 的 llm.api_url")
+    parser.add_argument("--api-key", help="LLM API 密钥，默认读取 config.toml 的 llm.api_key")
+    parser.add_argument("--model", help="标注使用的模型，默认读取 config.toml 的 llm.model")
+    parser.add_argument("--temperature", type=float, help="默认读取 config.toml 的 llm.temperature")
+    parser.add_argument("--concurrency", type=int, help="同时标注的题目数，默认读取 annotations.concurrency")
+    parser.add_argument("--force", action="store_true", help="忽略已有标注，全部重新生成")
+    parser.add_argument("--prune", action="store_true", help="删除已不在题库中的题目的标注")
+    parser.add_argument("--plugin-dir", help="插件数据目录 (包含 turtle.json)，默认为本脚本所在目录")
+    parser.add_argument("--maibot-root", help="MaiBot 根目录 (包含 src/plugin_system)")
+    args = parser.parse_args()
+
+    _add_maibot_root(args.maibot_root)
+    stats = asyncio.run(run_annotate(args))
+    print(
+        f"标注完成：共 {stats['total']} 个题目，跳过 {stats['skipped']} 个，"
+        f"新标注 {stats['done']} 个，失败 {stats['failed']} 个。"
+    )
+    if stats["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,525 @@
+# src/plugins/My_Fucked_turtle_soup/benchmark.py
+"""
+海龟汤插件压测脚本。
+
+在进程内启动一个兼容 OpenAI /v1/chat/completions 的假服务 (可配置延迟分布、错误率和流式输出)，
+用模拟的聊天流在 N 个群里并发驱动 HaiTurtleSoupCommand.execute，按 问题/提示/猜谜/本地 等动作的比例
+发送命令，统计吞吐量、p50/p95/p99 延迟、峰值内存和每条命令触发的 LLM 请求数，结果保存为 JSON，
+便于在不同版本之间对比。不会调用真实的 LLM API。
+
+用法 (在 MaiBot 根目录下运行，以便导入 src.plugin_system)：
+    python src/plugins/My_Fucked_turtle_soup/benchmark.py --groups 50 --commands 30
+    python src/plugins/My_Fucked_turtle_soup/benchmark.py --error-rate 0.05 --compare bench-1.8.1.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import importlib.util
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+try:
+    import resource # 仅 Unix 可用，用于读取进程峰值 RSS
+except ImportError:
+    resource = None
+
+from aiohttp import web
+
+PLUGIN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plugin.py")
+
+# --- 模拟玩家使用的问题和猜测 ---
+SAMPLE_QUESTIONS = [
+    "他是被杀的吗", "死者是男性吗", "和家人有关吗", "发生在晚上吗", "他知道自己会死吗",
+    "有第三个人在场吗", "和天气有关吗", "他是故意的吗", "这件事和食物有关吗", "他后悔了吗",
+    "现场有血吗", "他认识凶手吗", "和钱有关吗", "他生病了吗", "和动物有关吗",
+]
+SAMPLE_GUESSES = [
+    "他是被冻死的", "父母被放进了冰箱", "姐姐在纸房子里被烧死了", "护士在给他打针",
+    "他其实早就死了", "一切都是他的梦",
+]
+SAMPLE_HINTS = [
+    "注意故事发生的地点。", "想想主人公的职业。", "时间是关键，仔细看看前后顺序。",
+    "有一个人一直没有说话。", "表面上的关心未必是关心。",
+]
+
+
+# --- 假的 OpenAI 兼容服务 ---
+class FakeLLMServer:
+    """
+    进程内的假 LLM 服务，根据提示词内容返回符合插件解析格式的回复。
+    延迟服从对数正态分布 (median, sigma)，按 error_rate 随机返回 503；
+    请求带 stream=true 时以 SSE 分块返回，每块之间间隔 chunk_delay 秒。
+    """
+
+    def __init__(
+        self, latency_median: float, latency_sigma: float, error_rate: float,
+        chunk_chars: int, chunk_delay: float, solve_rate: float, seed: int
+    ):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.chunk_chars = max(1, chunk_chars)
+        self.chunk_delay = chunk_delay
+        self.solve_rate = solve_rate
+        self.random = random.Random(seed)
+        self.requests: Dict[str, int] = {}
+        self.errors = 0
+        self.streamed = 0
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    async def start(self) -> str:
+        """在随机端口上启动服务，返回 chat/completions 地址"""
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/v1/chat/completions"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _latency(self) -> float:
+        if self.latency_median <= 0:
+            return 0.0
+        return self.random.lognormvariate(0.0, self.latency_sigma) * self.latency_median
+
+    def _reply(self, prompt: str) -> tuple:
+        """按提示词识别请求类型，返回 (类型, 回复文本)"""
+        if "JSON数组" in prompt:
+            count = 1
+            for token in prompt.split("一次生成", 1)[-1].split():
+                if token.isdigit():
+                    count = int(token)
+                    break
+            puzzles = [self._puzzle() for _ in range(count)]
+            return "批量出题", json.dumps(puzzles, ensure_ascii=False)
+        if '"faq"' in prompt:
+            faq = [{"question": question, "verdict": self.random.choice(["是", "不是", "无关"])} for question in SAMPLE_QUESTIONS[:10]]
+            return "标注", json.dumps({
+                "hints": self.random.sample(SAMPLE_HINTS, 3), "clues": "1. 关键人物\n2. 关键时间",
+                "keywords": ["冰箱", "深夜"], "faq": faq,
+            }, ensure_ascii=False)
+        if '"hints"' in prompt:
+            hints = self.random.sample(SAMPLE_HINTS, 3)
+            return "提示包", json.dumps({"hints": hints, "clues": "1. 关键人物\n2. 关键时间"}, ensure_ascii=False)
+        if '"question"' in prompt:
+            return "出题", json.dumps(self._puzzle(), ensure_ascii=False)
+        if "用户猜测的答案" in prompt:
+            return "猜谜", "是" if self.random.random() < self.solve_rate else "不是"
+        if "用户问题列表" in prompt:
+            numbered = [line for line in prompt.split("用户问题列表", 1)[1].splitlines() if line[:1].isdigit()]
+            verdicts = self.random.choices(["是", "不是", "无关", "是也不是"], k=len(numbered))
+            return "批量问题", "\n".join(f"{i}. {verdict}" for i, verdict in enumerate(verdicts, 1))
+        if "用户问题" in prompt:
+            return "问题", self.random.choice(["是", "不是", "无关", "是也不是"])
+        if "整理出关键线索" in prompt:
+            return "整理线索", "1. 关键人物没有说话。\n2. 事情发生在深夜。\n3. 冰箱很重要。"
+        if "新的问答" in prompt:
+            return "线索更新", "1. 关键人物没有说话。\n2. 事情发生在深夜。\n3. 已确认与冰箱有关。"
+        if "提示" in prompt:
+            return "提示", self.random.choice(SAMPLE_HINTS)
+        if "生成一个合理的答案" in prompt:
+            return "汤底", "他其实早就死了，一直在重复那一天。"
+        return "汤面", self._text(30)
+
+    def _text(self, length: int) -> str:
+        """随机汉字组成的文本，保证生成的题目互不近似重复"""
+        return "".join(chr(self.random.randrange(0x4E00, 0x9FA5)) for _ in range(length))
+
+    def _puzzle(self) -> dict:
+        return {"question": self._text(30), "answer": self._text(60)}
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        prompt = "".join(m.get("content", "") for m in payload.get("messages", []))
+        kind, content = self._reply(prompt)
+        self.requests[kind] = self.requests.get(kind, 0) + 1
+        await asyncio.sleep(self._latency())
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503, text="simulated overload")
+
+        usage = {"prompt_tokens": len(prompt), "completion_tokens": len(content)}
+        if not payload.get("stream"):
+            return web.json_response({
+                "id": "bench", "object": "chat.completion", "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        self.streamed += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        try:
+            for start in range(0, len(content), self.chunk_chars):
+                delta = content[start:start + self.chunk_chars]
+                event = {"choices": [{"index": 0, "delta": {"content": delta}}]}
+                await response.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+                if self.chunk_delay > 0:
+                    await asyncio.sleep(self.chunk_delay)
+            final = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+            await response.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+            await response.write_eof()
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass # 插件识别出判断结果后会提前断开流
+        return response
+
+
+# --- 加载插件 ---
+def _add_maibot_root(explicit: Optional[str]):
+    """把 MaiBot 根目录加入 sys.path，以便插件导入 src.plugin_system"""
+    candidates = [explicit] if explicit else []
+    candidates.append(os.getcwd())
+    path = os.path.dirname(PLUGIN_FILE)
+    for _ in range(4):
+        path = os.path.dirname(path)
+        candidates.append(path)
+    for root in candidates:
+        if root and os.path.isdir(os.path.join(root, "src", "plugin_system")):
+            sys.path.insert(0, root)
+            return
+    raise SystemExit("找不到 src/plugin_system，请在 MaiBot 根目录下运行或使用 --maibot-root 指定。")
+
+
+def _load_plugin(work_dir: str):
+    """导入 plugin.py，并把插件数据目录指向临时目录，避免压测写入真实的存档和题库"""
+    spec = importlib.util.spec_from_file_location("hgt_plugin_benchmark", PLUGIN_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.PLUGIN_DIR = work_dir
+    return module
+
+
+def _config_getter(config: dict):
+    def get_config(key: str, default: Any = None) -> Any:
+        current = config
+        for part in key.split("."):
+            if not isinstance(current, dict) or part not in current:
+                return default
+            current = current[part]
+        return current
+    return get_config
+
+
+def _build_config(args, api_url: str) -> dict:
+    models = [f"bench-model-{i + 1}" for i in range(args.models)]
+    return {
+        "plugin": {"enabled": True},
+        "llm": {"api_url": api_url, "api_key": "bench", "model": models[0], "models": models},
+        "streaming": {"actions": [] if args.no_stream else ["问题", "猜谜", "提示", "整理线索"]},
+        "scheduler": {
+            "max_concurrency": args.max_concurrency, "rate_per_second": args.rate,
+            "burst": max(args.rate, 1.0), "queue_timeout": 60.0,
+        },
+        "puzzle_pool": {"enabled": not args.no_pool},
+        "prefetch": {"enabled": not args.no_prefetch},
+        "question_batch": {"enabled": args.question_batch, "window_ms": args.batch_window_ms},
+        "metrics": {"enabled": False, "admin_users": []},
+        "outbox": {"enabled": not args.no_outbox, "min_interval": args.send_interval, "rate_per_second": 0},
+    }
+
+
+def _write_local_library(work_dir: str, count: int):
+    soups = [
+        {"name": f"压测题目{i}", "question": f"第{i}个人打开了门，然后哭了。", "answer": f"门后是第{i}个人失散多年的亲人。"}
+        for i in range(count)
+    ]
+    with open(os.path.join(work_dir, "turtle.json"), "w", encoding="utf-8") as f:
+        json.dump(soups, f, ensure_ascii=False)
+
+
+# --- 模拟群聊 ---
+def _parse_mix(text: str) -> Dict[str, float]:
+    """解析动作比例，如 "问题=6,提示=1,猜谜=2,本地=1" """
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {"问题", "提示", "整理线索", "猜谜", "本地", "汤面"}
+    if unknown:
+        raise SystemExit(f"不支持的动作: {', '.join(sorted(unknown))}")
+    return mix
+
+
+class _Recorder:
+    """记录每条命令的耗时和结果"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.failures: Dict[str, int] = {}
+        self.sent_messages = 0
+
+    def record(self, action: str, elapsed: float, success: bool):
+        self.latencies.setdefault(action, []).append(elapsed)
+        if not success:
+            self.failures[action] = self.failures.get(action, 0) + 1
+
+
+def _make_command_class(plugin, recorder: _Recorder, send_latency: float):
+    class BenchCommand(plugin.HaiTurtleSoupCommand):
+        """发送消息时只计数 (可模拟发送耗时)，不经过真实的聊天平台"""
+
+        async def _deliver(self, *args, **kwargs):
+            recorder.sent_messages += 1
+            if send_latency > 0:
+                await asyncio.sleep(send_latency)
+            return True
+
+    return BenchCommand
+
+
+def _make_message(group_id: str):
+    user_info = SimpleNamespace(user_id=f"user-{group_id}")
+    chat_stream = SimpleNamespace(
+        stream_id=f"stream-{group_id}", group_info=SimpleNamespace(group_id=group_id), user_info=user_info
+    )
+    return SimpleNamespace(chat_stream=chat_stream, message_info=SimpleNamespace(user_info=user_info))
+
+
+async def _run_group(
+    plugin, command_class, config: dict, group_id: str, mix: Dict[str, float],
+    commands: int, think_time: float, recorder: _Recorder, rng: random.Random
+):
+    """一个群按顺序发送命令：没有进行中的游戏时先开局，之后按比例抽取动作"""
+    message = _make_message(group_id)
+    actions, weights = list(mix), list(mix.values())
+    local_weight = mix.get("本地", 0)
+    for _ in range(commands):
+        game = plugin.game_states.get(group_id)
+        if game is None or game.over:
+            if local_weight and rng.random() < local_weight / sum(weights):
+                action, rest = "本地", None
+            else:
+                action, rest = "开局", None
+        else:
+            action = rng.choices(actions, weights)[0]
+            rest = None
+            if action == "问题":
+                rest = rng.choice(SAMPLE_QUESTIONS) + rng.choice(["", "？", "?"])
+            elif action == "猜谜":
+                rest = rng.choice(SAMPLE_GUESSES)
+        command = command_class(message=message, plugin_config=config)
+        command.matched_groups = {"action": "问题" if action == "开局" else action, "rest": rest}
+        started = time.perf_counter()
+        try:
+            success = bool((await command.execute())[0])
+        except Exception as e:
+            print(f"[Benchmark] 群 {group_id} 执行 {action} 时出现异常: {e!r}")
+            success = False
+        recorder.record(action, time.perf_counter() - started, success)
+        if think_time > 0:
+            await asyncio.sleep(rng.expovariate(1.0 / think_time))
+
+
+# --- 统计 ---
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def _latency_summary(values: List[float], failures: int = 0) -> Dict[str, float]:
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "failures": failures,
+        "mean": sum(ordered) / len(ordered) if ordered else 0.0,
+        "p50": _percentile(ordered, 0.50),
+        "p95": _percentile(ordered, 0.95),
+        "p99": _percentile(ordered, 0.99),
+        "max": ordered[-1] if ordered else 0.0,
+    }
+
+
+def _peak_rss_kb() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak # macOS 以字节为单位，Linux 以 KB 为单位
+
+
+async def run_benchmark(args) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="hgt-bench-")
+    plugin = _load_plugin(work_dir)
+    server = FakeLLMServer(
+        args.latency_median, args.latency_sigma, args.error_rate,
+        args.chunk_chars, args.chunk_delay, args.solve_rate, args.seed
+    )
+    api_url = await server.start()
+    config = _build_config(args, api_url)
+    _write_local_library(work_dir, args.local_puzzles)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    plugin._init_runtime(_config_getter(config))
+    await plugin._load_local_turtle_soups()
+    if args.annotate:
+        # 预先标注本地题库，本地题目的提示、线索整理和常见问题不再调用LLM (标注请求不计入结果)
+        await plugin._annotate_library(
+            plugin.local_turtle_soups, plugin._get_soup_annotations(),
+            api_url, "bench", config["llm"]["model"], 0.7, concurrency=args.max_concurrency
+        )
+        server.requests.clear()
+
+    recorder = _Recorder()
+    command_class = _make_command_class(plugin, recorder, args.send_latency)
+    mix = _parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    print(f"[Benchmark] {args.groups} 个群 × {args.commands} 条命令，假服务 {api_url}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        _run_group(
+            plugin, command_class, config, f"bench-{i}", mix, args.commands,
+            args.think_time, recorder, random.Random(rng.random())
+        )
+        for i in range(args.groups)
+    ))
+    wall = time.perf_counter() - started
+
+    traced_peak = None
+    if args.trace_memory:
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    sessions = plugin._session_memory_stats()
+    llm_by_action = {
+        action: item["count"]
+        for action, item in plugin.metrics.summarize("llm_request_duration_seconds", "action").items()
+    }
+    outbox = plugin._get_outbox()
+    await plugin._shutdown_runtime() # 关闭时等待发送队列发送完
+    await server.stop()
+
+    all_latencies = [value for values in recorder.latencies.values() for value in values]
+    total_commands = len(all_latencies)
+    server_requests = sum(server.requests.values())
+    return {
+        "plugin_version": plugin.HaiTurtleSoupPlugin.plugin_version,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "maibot_root")},
+        "wall_seconds": wall,
+        "commands": total_commands,
+        "throughput_per_second": total_commands / wall if wall > 0 else 0.0,
+        "messages_sent": recorder.sent_messages,
+        "outbox": dict(outbox.counts),
+        "latency": {
+            "all": _latency_summary(all_latencies, sum(recorder.failures.values())),
+            **{
+                action: _latency_summary(values, recorder.failures.get(action, 0))
+                for action, values in sorted(recorder.latencies.items())
+            },
+        },
+        "llm": {
+            "server_requests": server_requests,
+            "server_errors": server.errors,
+            "streamed": server.streamed,
+            "requests_by_kind": dict(sorted(server.requests.items())),
+            "requests_per_command": server_requests / total_commands if total_commands else 0.0,
+            "requests_by_action": dict(sorted(llm_by_action.items())),
+            "failover": plugin._get_llm_router().stats(),
+        },
+        "memory": {
+            "peak_rss_kb": _peak_rss_kb(),
+            "tracemalloc_peak_bytes": traced_peak,
+            "sessions": sessions,
+        },
+    }
+
+
+def _print_report(result: dict, baseline: Optional[dict]):
+    print(f"\n📊 海龟汤压测结果 (插件 {result['plugin_version']})")
+    print(f"命令数 {result['commands']}，耗时 {result['wall_seconds']:.2f}s，吞吐 {result['throughput_per_second']:.1f} 条/秒")
+    print(f"{'动作':<8}{'次数':>7}{'失败':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for action, item in result["latency"].items():
+        print(
+            f"{action:<8}{item['count']:>7}{item['failures']:>6}"
+            f"{item['p50'] * 1000:>10.1f}{item['p95'] * 1000:>10.1f}{item['p99'] * 1000:>10.1f}"
+        )
+    llm = result["llm"]
+    print(
+        f"LLM 请求 {llm['server_requests']} 次 (失败 {llm['server_errors']}，流式 {llm['streamed']})，"
+        f"每条命令 {llm['requests_per_command']:.2f} 次；按类型: {llm['requests_by_kind']}"
+    )
+    outbox = result.get("outbox") or {}
+    print(
+        f"发送消息 {result['messages_sent']} 条；发送队列合并 {outbox.get('merged', 0)}，拆分 {outbox.get('split', 0)}，"
+        f"重试 {outbox.get('retried', 0)}，失败 {outbox.get('failed', 0)}，丢弃 {outbox.get('dropped', 0)}"
+    )
+    memory = result["memory"]
+    print(f"峰值 RSS {memory['peak_rss_kb']} KB，tracemalloc 峰值 {memory['tracemalloc_peak_bytes']} 字节")
+
+    if baseline:
+        def change(new: float, old: float) -> str:
+            return f"{(new - old) / old:+.1%}" if old else "n/a"
+        print(f"\n与 {baseline.get('plugin_version')} ({baseline.get('timestamp')}) 对比：")
+        print(f"吞吐 {change(result['throughput_per_second'], baseline['throughput_per_second'])}，"
+              f"每条命令 LLM 请求 {change(llm['requests_per_command'], baseline['llm']['requests_per_command'])}")
+        for action, item in result["latency"].items():
+            old = baseline["latency"].get(action)
+            if old:
+                print(f"{action}: p50 {change(item['p50'], old['p50'])}，p95 {change(item['p95'], old['p95'])}，p99 {change(item['p99'], old['p99'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="海龟汤插件压测 (使用进程内的假 LLM 服务)")
+    parser.add_argument("--groups", type=int, default=20, help="并发的群数")
+    parser.add_argument("--commands", type=int, default=20, help="每个群发送的命令数")
+    parser.add_argument("--mix", default="问题=6,提示=1,猜谜=2,本地=1", help="进行中游戏的动作比例；本地的权重同时决定开局时选本地题目的概率")
+    parser.add_argument("--think-time", type=float, default=0.0, help="同一群两条命令之间的平均间隔 (秒，指数分布)")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="模拟每次发送消息的耗时 (秒)")
+    parser.add_argument("--send-interval", type=float, default=0.0, help="outbox.min_interval，同一群两条消息的最小间隔 (秒)")
+    parser.add_argument("--no-outbox", action="store_true", help="关闭发送队列，命令直接发送消息")
+    parser.add_argument("--latency-median", type=float, default=0.2, help="假服务响应延迟的中位数 (秒)")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="对数正态延迟分布的 sigma，越大长尾越重")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="假服务返回 503 的概率")
+    parser.add_argument("--solve-rate", type=float, default=0.15, help="猜谜被判定为“是”的概率")
+    parser.add_argument("--chunk-chars", type=int, default=4, help="流式响应每块的字符数")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="流式响应每块之间的间隔 (秒)")
+    parser.add_argument("--models", type=int, default=2, help="配置的模型数 (用于故障转移)")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="scheduler.max_concurrency")
+    parser.add_argument("--rate", type=float, default=50.0, help="scheduler.rate_per_second (0 表示不限)")
+    parser.add_argument("--local-puzzles", type=int, default=1000, help="生成的本地题库大小")
+    parser.add_argument("--no-stream", action="store_true", help="关闭流式调用")
+    parser.add_argument("--no-pool", action="store_true", help="关闭预生成题目池")
+    parser.add_argument("--no-prefetch", action="store_true", help="关闭提示预取")
+    parser.add_argument("--annotate", action="store_true", help="压测前先离线标注本地题库 (/hgt 预处理)")
+    parser.add_argument("--question-batch", action="store_true", help="开启问题判断合批 (question_batch.enabled)")
+    parser.add_argument("--batch-window-ms", type=int, default=300, help="question_batch.window_ms")
+    parser.add_argument("--trace-memory", action="store_true", help="用 tracemalloc 统计 Python 分配峰值 (会降低吞吐)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="结果 JSON 路径，默认为 bench-<版本>-<时间>.json")
+    parser.add_argument("--compare", help="与之前保存的结果 JSON 对比")
+    parser.add_argument("--maibot-root", help="MaiBot 根目录 (包含 src/plugin_system)")
+    args = parser.parse_args()
+
+    _add_maibot_root(args.maibot_root)
+    result = asyncio.run(run_benchmark(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    _print_report(result, baseline)
+
+    output = args.output or f"bench-{result['plugin_version']}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,31 @@
 # src/plugins/My_Fucked_turtle_soup/plugin.py
 import os
+import re
+import sys
+import enum
 import json
+import math
+import mmap
+import time
 import random
-import aiohttp
-from typing import List, Tuple, Type, Optional
+import asyncio
+import bisect
+import hashlib
+import heapq
+import shutil
+import struct
+import itertools
+import contextlib
+import contextvars
+import importlib
+import weakref
+import unicodedata
+from array import array
+from collections import OrderedDict, deque
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Deque, Dict, List, Tuple, Type, Optional, Union
+
+if TYPE_CHECKING:
+    import aiohttp # 运行时延迟到第一次创建连接池 (或启动后的后台预热) 时才导入，导入 aiohttp 约需 0.2s
 from src.plugin_system import (
     BasePlugin,
     register_plugin,
@@ -15,15 +37,79 @@ from src.plugin_system.apis import send_api
 
 PLUGIN_DIR = os.path.dirname(__file__)
 
+# --- 可选依赖：orjson 提供更快的 JSON 编解码，缺失时回退到标准库 ---
+try:
+    import orjson
+
+    def _json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    _json_loads = orjson.loads
+except ImportError:
+    orjson = None
+
+    def _json_dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+
+    _json_loads = json.loads
+
 # --- 全局游戏状态存储 ---
-game_states = {} # {group_id: {"current_question": "", "current_answer": "", "hints_used": 0, "game_active": False, "guess_history": [], "game_over": False}}
+game_states = {} # {group_id: GameSession}
 
 # --- 全局本地题目存储 ---
-local_turtle_soups = [] # 存储从 turtle.json 加载的题目 [{name, question, answer}, ...]
+local_turtle_soups = None # SoupLibrary 实例，按序号或题目id (内容哈希) 读取 {id, name, question, answer}，在下方定义后初始化
 
 # --- 全局模型选择存储 (新增) ---
 model_selections = {} # {stream_id: "selected_model_name"}
 
+# --- 全局共享 LLM 客户端 (由 HaiTurtleSoupPlugin 创建和关闭) ---
+llm_client = None # LLMClient 实例
+
+# --- 全局 LLM 请求调度器 (由 HaiTurtleSoupPlugin 创建) ---
+llm_scheduler = None # LLMScheduler 实例
+
+# --- 全局模型路由：重试、故障转移和熔断 (由 HaiTurtleSoupPlugin 创建) ---
+llm_router = None # ModelRouter 实例
+
+# --- 全局游戏状态持久化 (由 HaiTurtleSoupPlugin 创建) ---
+game_store = None # GameStore 实例
+
+# --- 全局预生成题目池 (由 HaiTurtleSoupPlugin 创建) ---
+puzzle_pool = None # PuzzlePool 实例
+
+# --- 全局跨群问题判断缓存 (由 HaiTurtleSoupPlugin 创建) ---
+verdict_cache = None # VerdictCache 实例
+
+# --- 全局近似重复题目索引 (由 HaiTurtleSoupPlugin 按配置创建) ---
+dedup_index = None # PuzzleDedupIndex 实例
+
+# --- 全局问题判断合批器 (由 HaiTurtleSoupPlugin 创建) ---
+question_batcher = None # QuestionBatcher 实例
+
+# --- 全局本地题库自动载入与变化监视 (由 HaiTurtleSoupPlugin 按配置创建) ---
+library_watcher = None # LibraryWatcher 实例
+
+# --- 全局消息发送队列 (由 HaiTurtleSoupPlugin 按配置创建) ---
+outbox = None # Outbox 实例
+
+# --- 全局提示词模板库 (由 HaiTurtleSoupPlugin 按配置编译) ---
+prompt_registry = None # PromptRegistry 实例
+
+# --- 全局本地题目离线标注 (由 HaiTurtleSoupPlugin 加载) ---
+soup_annotations = None # SoupAnnotations 实例
+
+# --- 进行中的 /hgt 预处理 后台任务 (插件关闭时取消) ---
+annotation_task = None # asyncio.Task 实例
+
+# --- 默认启用流式输出的动作 ---
+DEFAULT_STREAMING_ACTIONS = ["问题", "猜谜", "提示", "整理线索"]
+
+# --- 出题类提示词默认附带的示例题目数量 {示例分组: 示例数量} ---
+DEFAULT_FEW_SHOT = {"出题": 2, "汤面": 2, "汤底": 2}
+
+# --- 全局预取提示包存储 ---
+hint_bundles = {} # {group_id: asyncio.Task -> {"hints": [温和, 中等, 强], "clues": "线索整理"} 或 None}
+
 # --- 插件定义 ---
 @register_plugin
 class HaiTurtleSoupPlugin(BasePlugin):
@@ -31,7 +117,7 @@ class HaiTurtleSoupPlugin(BasePlugin):
 
     plugin_name = "My_Fucked_turtle_soup"
     plugin_description = "支持游戏模式的海龟汤题目生成和互动。"
-    plugin_version = "1.6.2" # 更新版本号
+    plugin_version = "1.8.9" # 更新版本号
     plugin_author = "Unreal"
     enable_plugin = True
 
@@ -43,6 +129,22 @@ class HaiTurtleSoupPlugin(BasePlugin):
     config_section_descriptions = {
         "plugin": "插件启用配置",
         "llm": "LLM API 配置",
+        "http": "LLM HTTP 连接池配置",
+        "puzzle_pool": "预生成题目池配置",
+        "verdict_cache": "问题判断缓存配置",
+        "dedup": "近似重复题目检测配置",
+        "question_batch": "问题判断合批配置",
+        "scheduler": "LLM 请求调度配置",
+        "failover": "LLM 重试与故障转移配置",
+        "prefetch": "提示预取配置",
+        "prompts": "提示词模板配置",
+        "library": "本地题库配置",
+        "annotations": "本地题目离线标注配置",
+        "guess_prescreen": "猜谜本地预判配置",
+        "persistence": "游戏状态持久化配置",
+        "streaming": "流式输出配置",
+        "outbox": "消息发送队列配置",
+        "metrics": "运行指标配置",
         "anti_abuse": "反滥用配置" # 新增配置节描述
     }
     # --- 更新配置 Schema ---
@@ -55,7 +157,7 @@ class HaiTurtleSoupPlugin(BasePlugin):
             ),
             "config_version": ConfigField( # 添加配置版本
                 type=str,
-                default="1.6.2", # 更新配置版本
+                default="1.8.9", # 更新配置版本
                 description="配置文件版本"
             ),
         },
@@ -91,6 +193,368 @@ class HaiTurtleSoupPlugin(BasePlugin):
                 type=float,
                 default=0.7,
                 description="LLM 生成文本的随机性 (0.0-1.0)"
+            ),
+            "generation_mode": ConfigField(
+                type=str,
+                default="single",
+                description="AI出题模式: single=一次调用同时生成汤面和汤底(JSON), two_step=分两次调用生成"
+            )
+        },
+        "http": {
+            "limit_per_host": ConfigField(
+                type=int,
+                default=8,
+                description="每个 API 地址的最大并发连接数"
+            ),
+            "dns_cache_ttl": ConfigField(
+                type=int,
+                default=300,
+                description="DNS 解析结果缓存时间 (秒)"
+            ),
+            "keepalive_timeout": ConfigField(
+                type=float,
+                default=30.0,
+                description="空闲长连接保持时间 (秒)"
+            ),
+            "request_timeout": ConfigField(
+                type=float,
+                default=30.0,
+                description="单次 LLM 请求超时时间 (秒)"
+            ),
+            "drain_timeout": ConfigField(
+                type=float,
+                default=10.0,
+                description="插件卸载时等待进行中请求完成的最长时间 (秒)"
+            )
+        },
+        "scheduler": {
+            "max_concurrency": ConfigField(
+                type=int,
+                default=16,
+                description="所有群合计同时进行的 LLM 请求数上限"
+            ),
+            "rate_per_second": ConfigField(
+                type=float,
+                default=5.0,
+                description="每个 API Key 每秒最多发起的请求数 (令牌桶速率，0 表示不限速)"
+            ),
+            "burst": ConfigField(
+                type=float,
+                default=10.0,
+                description="令牌桶容量，允许的瞬时突发请求数"
+            ),
+            "queue_timeout": ConfigField(
+                type=float,
+                default=60.0,
+                description="请求排队等待的最长时间 (秒)，超时视为调用失败"
+            ),
+            "group_weights": ConfigField(
+                type=dict,
+                default={},
+                description="群权重 {群号: 权重}，权重越大在公平排队中获得的份额越多，默认 1"
+            )
+        },
+        "puzzle_pool": {
+            "enabled": ConfigField(
+                type=bool,
+                default=True,
+                description="是否在后台为每个模型预生成题目，开局时直接取用"
+            ),
+            "size": ConfigField(
+                type=int,
+                default=10,
+                description="每个模型题目池的最大容量"
+            ),
+            "low_watermark": ConfigField(
+                type=int,
+                default=2,
+                description="题目数量不高于此值时开始后台补充"
+            ),
+            "high_watermark": ConfigField(
+                type=int,
+                default=5,
+                description="后台补充的目标数量"
+            ),
+            "batch_size": ConfigField(
+                type=int,
+                default=3,
+                description="每次LLM调用生成的题目数量"
+            )
+        },
+        "verdict_cache": {
+            "enabled": ConfigField(
+                type=bool,
+                default=True,
+                description="是否缓存问题判断结果 (同一题目的相同问题跨群复用)"
+            ),
+            "max_entries": ConfigField(
+                type=int,
+                default=5000,
+                description="缓存的最大条目数，超出时淘汰最久未使用的条目"
+            ),
+            "ttl_seconds": ConfigField(
+                type=int,
+                default=604800,
+                description="缓存条目的有效期 (秒)"
+            ),
+            "persist": ConfigField(
+                type=bool,
+                default=True,
+                description="是否把缓存保存到插件目录下的 verdict_cache.json"
+            )
+        },
+        "dedup": {
+            "enabled": ConfigField(
+                type=bool,
+                default=True,
+                description="是否拒绝与示例、本地题目或之前生成过的题目近似重复的AI题目"
+            ),
+            "threshold": ConfigField(
+                type=float,
+                default=0.5,
+                description="判为重复的相似度 (汤面+汤底字符三元组的 Jaccard 相似度估计，0-1)"
+            ),
+            "max_entries": ConfigField(
+                type=int,
+                default=50000,
+                description="索引保留的最大题目数，超出时淘汰最早加入的题目"
+            ),
+            "max_retries": ConfigField(
+                type=int,
+                default=2,
+                description="开局生成的题目重复时换题或重新生成的最大次数"
+            )
+        },
+        "question_batch": {
+            "enabled": ConfigField(
+                type=bool,
+                default=False,
+                description="是否把同一局短时间内的多个问题合并为一次LLM调用 (合批时不使用流式输出)"
+            ),
+            "window_ms": ConfigField(
+                type=int,
+                default=300,
+                description="第一个问题到达后等待合批的时长 (毫秒)"
+            ),
+            "max_questions": ConfigField(
+                type=int,
+                default=5,
+                description="每批最多合并的问题数，凑满后立即发出"
+            )
+        },
+        "failover": {
+            "enabled": ConfigField(
+                type=bool,
+                default=True,
+                description="LLM 调用失败时是否重试并切换到 llm.models 中的其他模型"
+            ),
+            "max_attempts": ConfigField(
+                type=int,
+                default=3,
+                description="每次调用最多尝试的次数 (含第一次)"
+            ),
+            "backoff_base": ConfigField(
+                type=float,
+                default=0.5,
+                description="重试退避的基础时长 (秒)，每次翻倍并随机抖动"
+            ),
+            "backoff_max": ConfigField(
+                type=float,
+                default=4.0,
+                description="重试退避的最长时长 (秒)"
+            ),
+            "hedge_percentile": ConfigField(
+                type=float,
+                default=0.95,
+                description="请求耗时超过该模型近期延迟的此分位数时发出对冲请求，设为 0 关闭对冲"
+            ),
+            "hedge_min_delay": ConfigField(
+                type=float,
+                default=2.0,
+                description="发出对冲请求前至少等待的时长 (秒)"
+            ),
+            "breaker_failures": ConfigField(
+                type=int,
+                default=5,
+                description="模型连续失败多少次后熔断"
+            ),
+            "breaker_cooldown": ConfigField(
+                type=float,
+                default=30.0,
+                description="熔断后多久 (秒) 放行一个试探请求"
+            )
+        },
+        "prefetch": {
+            "enabled": ConfigField(
+                type=bool,
+                default=True,
+                description="开局时在后台一次性生成三个分级提示和线索整理，提示/整理线索时直接返回"
+            )
+        },
+        "prompts": {
+            "few_shot": ConfigField(
+                type=dict,
+                default=dict(DEFAULT_FEW_SHOT),
+                description="出题类提示词附带的示例题目数量 {出题: n, 汤面: n, 汤底: n}，每个 0-4，越少输入 token 越少"
+            )
+        },
+        "library": {
+            "page_size": ConfigField(
+                type=int,
+                default=20,
+                description="/hgt 列表 每页显示的题目数"
+            ),
+            "search_results": ConfigField(
+                type=int,
+                default=10,
+                description="/hgt 搜索 最多返回的题目数"
+            ),
+            "auto_load": ConfigField(
+                type=bool,
+                default=True,
+                description="插件启动后是否在后台自动载入 turtle.json，无需手动 /hgt 载入"
+            ),
+            "watch_interval": ConfigField(
+                type=float,
+                default=30.0,
+                description="检查 turtle.json 修改时间和大小的间隔 (秒)，变化时在后台重新载入；0 为不检查"
+            )
+        },
+        "annotations": {
+            "enabled": ConfigField(
+                type=bool,
+                default=True,
+                description="本地题目开局时使用 /hgt 预处理 (或 annotate.py) 预先生成的提示、线索整理和常见问题，不再调用LLM"
+            ),
+            "concurrency": ConfigField(
+                type=int,
+                default=4,
+                description="/hgt 预处理 同时标注的题目数"
+            ),
+            "admin_users": ConfigField(
+                type=list,
+                default=[],
+                description="允许使用 /hgt 预处理 的用户ID列表，为空时任何人都不能使用"
+            )
+        },
+        "guess_prescreen": {
+            "mode": ConfigField(
+                type=str,
+                default="shadow",
+                description="猜谜本地预判模式：off 关闭，shadow 只记录本地预判与LLM是否一致，enforce 明确的结果直接回复不再调用LLM"
+            ),
+            "accept_threshold": ConfigField(
+                type=float,
+                default=0.8,
+                description="本地得分不低于此值时直接判定为“是”"
+            ),
+            "reject_threshold": ConfigField(
+                type=float,
+                default=0.05,
+                description="猜测与汤面、汤底的相关度低于此值时直接判定为“无关”"
+            )
+        },
+        "streaming": {
+            "actions": ConfigField(
+                type=list,
+                default=DEFAULT_STREAMING_ACTIONS,
+                description="使用流式 (SSE) 调用LLM的动作。问题/猜谜在识别出判断结果后立即停止，提示/整理线索按句子分段先发送"
+            ),
+            "flush_min_chars": ConfigField(
+                type=int,
+                default=40,
+                description="流式长文本每段至少累积的字符数"
+            )
+        },
+        "outbox": {
+            "enabled": ConfigField(
+                type=bool,
+                default=True,
+                description="是否通过按聊天流排队的发送队列回复 (命令放入队列后立即返回，由后台按平台限速发送)"
+            ),
+            "min_interval": ConfigField(
+                type=float,
+                default=1.0,
+                description="同一聊天流两条消息之间的最小间隔 (秒)"
+            ),
+            "rate_per_second": ConfigField(
+                type=float,
+                default=5.0,
+                description="所有聊天流合计每秒最多发送的消息数，0 为不限制"
+            ),
+            "burst": ConfigField(
+                type=float,
+                default=10.0,
+                description="所有聊天流合计允许的突发消息数"
+            ),
+            "coalesce_chars": ConfigField(
+                type=int,
+                default=500,
+                description="同一聊天流排队中的连续短回复合并为一条消息，合并后不超过此字符数；0 为不合并"
+            ),
+            "max_chars": ConfigField(
+                type=int,
+                default=1500,
+                description="单条消息的最大字符数，更长的文本按段落、换行或句子拆分后依次发送"
+            ),
+            "max_retries": ConfigField(
+                type=int,
+                default=3,
+                description="发送失败后的最大重试次数"
+            ),
+            "retry_backoff": ConfigField(
+                type=float,
+                default=1.0,
+                description="第一次重试前的等待时间 (秒)，之后每次翻倍"
+            ),
+            "max_pending": ConfigField(
+                type=int,
+                default=50,
+                description="每个聊天流最多排队的消息数，超出时丢弃最早的消息"
+            )
+        },
+        "persistence": {
+            "enabled": ConfigField(
+                type=bool,
+                default=True,
+                description="是否把游戏状态和模型选择保存到插件目录，重启或重载后恢复"
+            ),
+            "compact_every": ConfigField(
+                type=int,
+                default=500,
+                description="日志累积多少条变更后压缩为快照"
+            ),
+            "idle_ttl_hours": ConfigField(
+                type=float,
+                default=24,
+                description="游戏无人操作超过此时长 (小时) 后被清理"
+            ),
+            "finished_ttl_minutes": ConfigField(
+                type=float,
+                default=30,
+                description="已结束的游戏保留多长时间 (分钟) 后被清理"
+            ),
+            "sweep_interval": ConfigField(
+                type=float,
+                default=300,
+                description="检查过期游戏的最小间隔 (秒)"
+            )
+        },
+        "metrics": {
+            "enabled": ConfigField(
+                type=bool,
+                default=True,
+                description="是否定期把运行指标以 Prometheus 文本格式写入插件目录下的 metrics.prom"
+            ),
+            "export_interval": ConfigField(
+                type=float,
+                default=60.0,
+                description="写出指标文件的最小间隔 (秒)"
+            ),
+            "admin_users": ConfigField(
+                type=list,
+                default=[],
+                description="允许使用 /hgt 统计 的用户ID列表，为空时任何人都不能使用"
             )
         },
         # 新增配置节
@@ -103,6 +567,14 @@ class HaiTurtleSoupPlugin(BasePlugin):
         }
     }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        _init_runtime(self.get_config)
+
+    async def on_unload(self):
+        """插件卸载/重载时调用：停止后台补充任务，等待进行中的请求完成后关闭连接池"""
+        await _shutdown_runtime()
+
     def get_plugin_components(self) -> List[Tuple[ComponentInfo, Type]]:
         """注册插件组件"""
         return [
@@ -110,6 +582,165 @@ class HaiTurtleSoupPlugin(BasePlugin):
         ]
 
 
+# --- 运行时初始化与关闭 (插件加载/卸载时调用，压测脚本也通过它们按配置搭建运行环境) ---
+def _init_runtime(get_config: Callable[[str, Any], Any]):
+    """按配置创建共享的 HTTP 客户端、调度器、故障转移路由、题目池、判断缓存、本地题库和游戏存储"""
+    global llm_client
+    # 重载插件时先让旧客户端排空并关闭，避免泄漏连接
+    if llm_client is not None:
+        _schedule_client_close(llm_client)
+    llm_client = LLMClient(
+        limit_per_host=get_config("http.limit_per_host", 8),
+        dns_cache_ttl=get_config("http.dns_cache_ttl", 300),
+        keepalive_timeout=get_config("http.keepalive_timeout", 30.0),
+        request_timeout=get_config("http.request_timeout", 30.0),
+        drain_timeout=get_config("http.drain_timeout", 10.0),
+    )
+    global llm_scheduler
+    llm_scheduler = LLMScheduler(
+        max_concurrency=get_config("scheduler.max_concurrency", 16),
+        rate_per_second=get_config("scheduler.rate_per_second", 5.0),
+        burst=get_config("scheduler.burst", 10.0),
+        queue_timeout=get_config("scheduler.queue_timeout", 60.0),
+        group_weights=get_config("scheduler.group_weights", {}),
+    )
+    metrics.configure(
+        enabled=get_config("metrics.enabled", True),
+        export_interval=get_config("metrics.export_interval", 60.0),
+    )
+    global llm_router
+    llm_router = ModelRouter(
+        enabled=get_config("failover.enabled", True),
+        models=get_config("llm.models", ["deepseek-ai/DeepSeek-V3"]),
+        max_attempts=get_config("failover.max_attempts", 3),
+        backoff_base=get_config("failover.backoff_base", 0.5),
+        backoff_max=get_config("failover.backoff_max", 4.0),
+        hedge_percentile=get_config("failover.hedge_percentile", 0.95),
+        hedge_min_delay=get_config("failover.hedge_min_delay", 2.0),
+        failure_threshold=get_config("failover.breaker_failures", 5),
+        cooldown=get_config("failover.breaker_cooldown", 30.0),
+    )
+    global puzzle_pool
+    puzzle_pool = PuzzlePool(
+        enabled=get_config("puzzle_pool.enabled", True),
+        size=get_config("puzzle_pool.size", 10),
+        low_watermark=get_config("puzzle_pool.low_watermark", 2),
+        high_watermark=get_config("puzzle_pool.high_watermark", 5),
+        batch_size=get_config("puzzle_pool.batch_size", 3),
+    )
+    puzzle_pool.load()
+    global verdict_cache
+    if verdict_cache is not None:
+        verdict_cache.save()
+    verdict_cache = VerdictCache(
+        enabled=get_config("verdict_cache.enabled", True),
+        max_entries=get_config("verdict_cache.max_entries", 5000),
+        ttl_seconds=get_config("verdict_cache.ttl_seconds", 604800),
+        persist=get_config("verdict_cache.persist", True),
+    )
+    verdict_cache.load()
+    global dedup_index
+    if dedup_index is not None:
+        dedup_index.save()
+    dedup_index = PuzzleDedupIndex(
+        enabled=get_config("dedup.enabled", True),
+        threshold=get_config("dedup.threshold", 0.5),
+        max_entries=get_config("dedup.max_entries", 50000),
+    ) # 索引文件由 library_watcher 在后台线程中加载
+    global question_batcher
+    question_batcher = QuestionBatcher(
+        enabled=get_config("question_batch.enabled", False),
+        window=get_config("question_batch.window_ms", 300) / 1000,
+        max_questions=get_config("question_batch.max_questions", 5),
+    )
+    global outbox
+    outbox = Outbox(
+        enabled=get_config("outbox.enabled", True),
+        min_interval=get_config("outbox.min_interval", 1.0),
+        rate_per_second=get_config("outbox.rate_per_second", 5.0),
+        burst=get_config("outbox.burst", 10.0),
+        coalesce_chars=get_config("outbox.coalesce_chars", 500),
+        max_chars=get_config("outbox.max_chars", 1500),
+        max_retries=get_config("outbox.max_retries", 3),
+        retry_backoff=get_config("outbox.retry_backoff", 1.0),
+        max_pending=get_config("outbox.max_pending", 50),
+        drain_timeout=get_config("http.drain_timeout", 10.0),
+    )
+    global prompt_registry
+    prompt_registry = PromptRegistry(get_config("prompts.few_shot", DEFAULT_FEW_SHOT))
+    # 插件重载后第一条命令重新读取配置快照
+    _config_snapshots.invalidate()
+    global local_turtle_soups
+    local_turtle_soups.close()
+    local_turtle_soups = _open_local_library()
+    global soup_annotations
+    soup_annotations = SoupAnnotations(enabled=get_config("annotations.enabled", True))
+    soup_annotations.load()
+    global game_store
+    game_store = GameStore(
+        enabled=get_config("persistence.enabled", True),
+        compact_every=get_config("persistence.compact_every", 500),
+        idle_ttl=get_config("persistence.idle_ttl_hours", 24) * 3600,
+        finished_ttl=get_config("persistence.finished_ttl_minutes", 30) * 60,
+        sweep_interval=get_config("persistence.sweep_interval", 300),
+    )
+    games, models = game_store.restore()
+    if games or models:
+        memory = _session_memory_stats()
+        print(f"[Game Store] 已恢复 {games} 个游戏和 {models} 个模型选择，会话共占用约 {memory['bytes']} 字节。")
+    global library_watcher
+    if library_watcher is not None:
+        library_watcher.cancel()
+    library_watcher = LibraryWatcher(
+        auto_load=get_config("library.auto_load", True),
+        interval=get_config("library.watch_interval", 30.0),
+    )
+    library_watcher.start() # 没有运行中的事件循环时在第一条命令时启动
+
+
+async def _shutdown_runtime():
+    """停止后台补充任务，等待进行中的请求完成后关闭连接池"""
+    metrics.maybe_export(force=True)
+    global annotation_task
+    task, annotation_task = annotation_task, None
+    if task is not None and not task.done():
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    global library_watcher
+    watcher, library_watcher = library_watcher, None
+    if watcher is not None:
+        await watcher.aclose()
+    global llm_client, puzzle_pool, verdict_cache
+    pool, puzzle_pool = puzzle_pool, None
+    if pool is not None:
+        await pool.aclose()
+    global question_batcher
+    batcher, question_batcher = question_batcher, None
+    if batcher is not None:
+        await batcher.aclose()
+    global outbox
+    queue, outbox = outbox, None
+    if queue is not None:
+        await queue.aclose()
+    cache, verdict_cache = verdict_cache, None
+    if cache is not None:
+        await cache.aclose()
+    global dedup_index
+    index, dedup_index = dedup_index, None
+    if index is not None:
+        index.save()
+    global game_store
+    store, game_store = game_store, None
+    if store is not None:
+        await store.aclose()
+    global local_turtle_soups
+    local_turtle_soups.close()
+    client, llm_client = llm_client, None
+    if client is not None:
+        await client.aclose()
+
+
 # --- 工具函数 ---
 def _load_json_data(filename: str) -> dict:
     """加载JSON数据文件"""
@@ -134,671 +765,4911 @@ def _save_json_data(filename: str, data: dict): # 修复参数名称
         print(f"保存 {filename} 失败: {e}")
         raise # 让调用者处理保存失败
 
-# --- 新增工具函数：加载本地题目 ---
-def _load_local_turtle_soups():
-    """从 ./turtle.json 文件加载海龟汤题目到全局变量 local_turtle_soups"""
-    global local_turtle_soups
-    local_turtle_soups = [] # 清空旧数据
-    file_path = os.path.join(PLUGIN_DIR, "turtle.json")
+# --- 共享 LLM HTTP 客户端 ---
+class _SSEParser:
+    """增量 SSE 解析器：喂入任意切分的字节块，返回已完整接收的事件的 data 字段"""
 
-    if not os.path.exists(file_path):
-        print(f"本地题目文件 {file_path} 不存在。")
-        return False, f"本地题目文件 {file_path} 不存在。"
+    def __init__(self):
+        self._buffer = b""
+        self._data_lines: List[str] = []
 
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-        if not isinstance(data, list):
-             error_msg = f"{file_path} 文件内容必须是一个数组。"
-             print(error_msg)
-             return False, error_msg
-
-        valid_soups = []
-        for i, item in enumerate(data):
-            if not isinstance(item, dict):
-                print(f"警告：{file_path} 第 {i+1} 项不是对象，已跳过。")
-                continue
+    def feed(self, chunk: bytes) -> List[str]:
+        self._buffer += chunk
+        events = []
+        while True:
+            newline = self._buffer.find(b"\n")
+            if newline == -1:
+                break
+            line = self._buffer[:newline].rstrip(b"\r").decode("utf-8", errors="replace")
+            self._buffer = self._buffer[newline + 1:]
+            if not line:
+                # 空行表示一个事件结束
+                if self._data_lines:
+                    events.append("\n".join(self._data_lines))
+                    self._data_lines = []
+            elif line.startswith("data:"):
+                self._data_lines.append(line[5:].lstrip(" "))
+            # 其他字段 (event/id/retry) 和注释行 (":") 不需要处理
+        return events
 
-            name = item.get("name")
-            question = item.get("question")
-            answer = item.get("answer")
+    def flush(self) -> List[str]:
+        """流结束时返回尚未以空行结尾的最后一个事件"""
+        events = self.feed(b"\n") if self._buffer else []
+        if self._data_lines:
+            events.append("\n".join(self._data_lines))
+            self._data_lines = []
+        return events
 
-            if not all(isinstance(field, str) and field for field in [name, question, answer]):
-                print(f"警告：{file_path} 第 {i+1} 项缺少 'name', 'question' 或 'answer' 字段，或字段为空，已跳过。")
-                continue
 
-            valid_soups.append({
-                "name": name.strip(),
-                "question": question.strip(),
-                "answer": answer.strip()
-            })
+class LLMClient:
+    """
+    插件级共享的 LLM HTTP 客户端。
+    每个 api_url 维护一个长连接池 (keep-alive + DNS 缓存)，避免每次调用重复建立 TCP/TLS 连接。
+    关闭时先等待进行中的请求完成 (最多 drain_timeout 秒)，再释放连接。
+    """
 
-        local_turtle_soups = valid_soups
-        success_msg = f"成功从 {file_path} 加载了 {len(local_turtle_soups)} 个本地海龟汤题目。"
-        print(success_msg)
-        return True, success_msg
+    def __init__(
+        self, limit_per_host: int = 8, dns_cache_ttl: int = 300,
+        keepalive_timeout: float = 30.0, request_timeout: float = 30.0,
+        drain_timeout: float = 10.0
+    ):
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.drain_timeout = drain_timeout
+        self._sessions: Dict[str, "aiohttp.ClientSession"] = {} # {api_url: session}
+        self._inflight = 0
+        self._idle: Optional[asyncio.Event] = None
+        self._closing = False
 
-    except json.JSONDecodeError as e:
-        error_msg = f"解析 {file_path} 失败: {e}"
-        print(error_msg)
-        return False, error_msg
-    except Exception as e:
-        error_msg = f"加载 {file_path} 时发生未知错误: {e}"
-        print(error_msg)
-        return False, error_msg
+    @property
+    def closed(self) -> bool:
+        return self._closing
 
+    def _get_session(self, api_url: str) -> "aiohttp.ClientSession":
+        """获取 (必要时创建) api_url 对应的连接池，需在事件循环内调用"""
+        session = self._sessions.get(api_url)
+        if session is None or session.closed:
+            import aiohttp
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+                json_serialize=_json_dumps,
+            )
+            self._sessions[api_url] = session
+        return session
 
-# --- Command组件 ---
-class HaiTurtleSoupCommand(BaseCommand):
-    """处理 /hgt 命令"""
+    def _begin_request(self):
+        """登记一个进行中的请求，关闭后拒绝新请求"""
+        if self._closing:
+            raise RuntimeError("LLM 客户端已关闭")
+        if self._idle is None:
+            self._idle = asyncio.Event()
+        self._inflight += 1
+        self._idle.clear()
 
-    command_name = "HaiTurtleSoupCommand"
-    command_description = "生成海龟汤题目或进行游戏互动。用法: /hgt [问题|提示|整理线索|猜谜|退出|帮助|汤面|揭秘|载入|本地|列表|模型]"
-    # 更新后的正则表达式，支持 /hgt 本地 <序号> 和 /hgt 模型 <参数>
-    command_pattern = r"^/hgt\s+(?P<action>\S+)(?:\s+(?P<rest>.+))?$"
-    command_help = (
-        "海龟汤游戏：\n"
-        "/hgt 问题 - 生成AI题目\n"
-        "/hgt 问题 <问题> - 提问\n"
-        "/hgt 提示 - 获取提示\n"
-        "/hgt 整理线索 - 整理线索\n"
-        "/hgt 猜谜 <答案> - 猜测汤底\n"
-        "/hgt 揭秘 - 揭示汤底\n"
-        "/hgt 退出 - 退出游戏\n"
-        "/hgt 汤面 - 查看题目\n"
-        "/hgt 帮助 - 查看帮助\n"
-        "/hgt 载入 - 从 turtle.json 载入本地题目\n"
-        "/hgt 列表 - 查看已载入的本地题目列表\n"
-        "/hgt 本地 - 随机使用一个本地题目开始游戏\n"
-        "/hgt 本地 <序号> - 使用指定序号的本地题目开始游戏\n"
-        "/hgt 模型 - 列出可用模型\n"
-        "/hgt 模型 <序号> - 切换模型"
-    )
-    command_examples = [
-        "/hgt 问题", "/hgt 问题 为什么海龟不喝水？", "/hgt 提示", "/hgt 整理线索",
-        "/hgt 猜谜 海龟是用海龟做的", "/hgt 退出", "/hgt 帮助", "/hgt 汤面",
-        "/hgt 揭秘", "/hgt 载入", "/hgt 列表", "/hgt 本地", "/hgt 本地 1",
-        "/hgt 模型", "/hgt 模型 2"
-    ]
-    intercept_message = True # 确保拦截消息，防止转发
+    def _end_request(self):
+        self._inflight -= 1
+        if self._inflight == 0:
+            self._idle.set()
 
-    async def execute(self) -> Tuple[bool, Optional[str], bool]:
-        """执行命令逻辑"""
-        # --- 安全处理匹配结果 ---
-        matched_groups = self.matched_groups if self.matched_groups is not None else {}
+    async def post_json(self, api_url: str, headers: dict, payload: dict) -> Tuple[int, Optional[dict], str]:
+        """
+        POST JSON 请求。
+        返回 (HTTP状态码, 解析后的JSON或None, 原始响应文本)
+        """
+        self._begin_request()
+        try:
+            session = self._get_session(api_url)
+            async with session.post(api_url, headers=headers, json=payload) as response:
+                body = await response.read()
+                text = body.decode("utf-8", errors="replace")
+                data = None
+                if response.status == 200:
+                    try:
+                        data = _json_loads(body)
+                    except ValueError:
+                        data = None
+                return response.status, data, text
+        finally:
+            self._end_request()
 
-        # 安全获取 action 和 rest
-        action = ""
-        rest_input = ""
+    async def post_stream(
+        self, api_url: str, headers: dict, payload: dict,
+        on_event: Callable[[str], Awaitable[bool]]
+    ) -> Tuple[int, str]:
+        """
+        POST 请求并按 SSE (text/event-stream) 逐个事件回调 on_event(data)。
+        on_event 返回 True 时提前结束读取 (连接随之关闭，不放回连接池)。
+        返回 (HTTP状态码, 非200时的响应文本)
+        """
+        self._begin_request()
+        try:
+            session = self._get_session(api_url)
+            async with session.post(api_url, headers=headers, json=payload) as response:
+                if response.status != 200:
+                    return response.status, await response.text()
+                parser = _SSEParser()
+                async for chunk in response.content.iter_any():
+                    for data in parser.feed(chunk):
+                        if await on_event(data):
+                            return response.status, ""
+                for data in parser.flush():
+                    if await on_event(data):
+                        break
+                return response.status, ""
+        finally:
+            self._end_request()
 
-        # 检查是否匹配成功
-        if matched_groups:
-            action = matched_groups.get("action", "") if matched_groups.get("action") is not None else ""
-            rest_input = matched_groups.get("rest", "") if matched_groups.get("rest") is not None else ""
+    async def aclose(self):
+        """等待进行中的请求完成后关闭所有连接池"""
+        self._closing = True
+        if self._idle is not None and self._inflight > 0:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=self.drain_timeout)
+            except asyncio.TimeoutError:
+                print(f"LLM 客户端关闭时仍有 {self._inflight} 个请求未完成，强制关闭。")
+        sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            try:
+                await session.close()
+            except Exception as e:
+                print(f"关闭 LLM 连接池失败: {e}")
 
-        # 确保字符串安全处理
-        action = str(action).strip()
-        rest_input = str(rest_input).strip()
 
-        # --- 获取聊天上下文 ---
-        chat_stream = getattr(self, 'chat_stream', None)
-        if chat_stream is None:
-            message_obj = getattr(self, 'message', None)
-            if message_obj:
-                chat_stream = getattr(message_obj, 'chat_stream', None)
+def _schedule_client_close(client: "LLMClient"):
+    """在当前事件循环中异步关闭旧客户端；没有运行中的循环时直接丢弃 (尚未建立过连接)"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        client._closing = True
+        return
+    loop.create_task(client.aclose())
 
-        if chat_stream is None:
-            error_msg = "❌ 无法获取聊天上下文信息 (chat_stream)。"
-            try:
-                await self.send_text(error_msg)
-            except Exception as send_e:
-                print(f"发送聊天上下文错误消息也失败了: {send_e}")
-            return False, "缺少聊天上下文 (chat_stream)", True
 
-        stream_id = getattr(chat_stream, 'stream_id', None)
-        if stream_id is None:
-            error_msg = "❌ 无法获取聊天流ID (stream_id)。"
-            try:
+def _get_llm_client() -> "LLMClient":
+    """
+    获取共享 LLM 客户端。客户端只由 _init_runtime 按配置创建：
+    尚未创建或已经关闭 (插件卸载后仍在运行的后台任务) 时抛出 RuntimeError，不再悄悄新建无人关闭的连接池。
+    """
+    if llm_client is None or llm_client.closed:
+        raise RuntimeError("LLM 客户端尚未创建或已关闭")
+    return llm_client
+
+
+# --- 运行指标：按动作、模型和结果统计的延迟直方图和计数器 ---
+_metric_action: contextvars.ContextVar = contextvars.ContextVar("hgt_metric_action", default="后台")
+METRIC_ACTIONS = (
+    "问题", "提示", "整理线索", "猜谜", "退出", "帮助", "汤面", "揭秘",
+    "载入", "本地", "列表", "搜索", "模型", "统计", "预处理",
+)
+METRIC_HELP = {
+    "command_duration_seconds": ("histogram", "命令端到端耗时"),
+    "llm_call_duration_seconds": ("histogram", "一次LLM调用的总耗时 (含重试和对冲)"),
+    "llm_request_duration_seconds": ("histogram", "单次LLM HTTP请求耗时"),
+    "llm_queue_wait_seconds": ("histogram", "LLM请求在调度器中的排队时间"),
+    "send_duration_seconds": ("histogram", "发送消息耗时"),
+    "llm_tokens_total": ("counter", "LLM响应 usage 中的 token 数"),
+    "llm_errors_total": ("counter", "LLM请求失败次数"),
+    "cache_lookups_total": ("counter", "缓存和预取的命中/未命中次数"),
+    "prompt_renders_total": ("counter", "按模板统计的提示词渲染次数"),
+    "prompt_tokens_estimated_total": ("counter", "渲染后提示词的估算输入 token 数"),
+    "dedup_rejections_total": ("counter", "因与已有题目近似重复而被拒绝的生成题目数"),
+    "outbox_messages_total": ("counter", "发送队列的消息数 (已发送/合并/拆分/重试/失败/丢弃)"),
+    "outbox_delay_seconds": ("histogram", "消息从放入发送队列到发送成功的耗时"),
+}
+
+
+class MetricsRegistry:
+    """
+    进程内指标：直方图 (固定分桶) 和计数器，标签为 (名称, 值) 元组。
+    定期写出 Prometheus 文本格式文件，并为 /hgt 统计 提供汇总。
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    EXPORT_FILE = "metrics.prom"
+
+    def __init__(self):
+        self.enabled = True
+        self.export_interval = 60.0
+        self.started = time.time()
+        self._histograms: Dict[str, Dict[tuple, list]] = {} # {名称: {标签: [各分桶计数..., 总数, 总和]}}
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._last_export = time.monotonic()
+
+    def configure(self, enabled: bool, export_interval: float):
+        self.enabled = enabled
+        self.export_interval = export_interval
+
+    def observe(self, name: str, value: float, **labels):
+        series = self._histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        data = series.get(key)
+        if data is None:
+            data = series[key] = [0] * (len(self.BUCKETS) + 2) + [0.0]
+        data[bisect.bisect_left(self.BUCKETS, value)] += 1
+        data[-2] += 1
+        data[-1] += value
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        series = self._counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + amount
+
+    # --- 汇总 ---
+    def summarize(self, name: str, by: str) -> Dict[str, Dict[str, float]]:
+        """按某个标签汇总直方图：{标签值: {count, avg, p95, errors}}，p95 为所在分桶的上界"""
+        merged: Dict[str, list] = {}
+        errors: Dict[str, int] = {}
+        for key, data in self._histograms.get(name, {}).items():
+            labels = dict(key)
+            value = labels.get(by, "")
+            target = merged.setdefault(value, [0] * len(data))
+            for i, item in enumerate(data):
+                target[i] += item
+            if labels.get("outcome", "ok") != "ok":
+                errors[value] = errors.get(value, 0) + data[-2]
+        summary = {}
+        for value, data in merged.items():
+            count = data[-2]
+            summary[value] = {
+                "count": count,
+                "avg": data[-1] / count if count else 0.0,
+                "p95": self._quantile(data, 0.95),
+                "errors": errors.get(value, 0),
+            }
+        return summary
+
+    def _quantile(self, data: list, q: float) -> float:
+        count = data[-2]
+        seen = 0
+        for i, bound in enumerate(self.BUCKETS):
+            seen += data[i]
+            if count and seen >= q * count:
+                return bound
+        return float("inf")
+
+    def counter_totals(self, name: str, by: Tuple[str, ...]) -> Dict[tuple, float]:
+        totals: Dict[tuple, float] = {}
+        for key, value in self._counters.get(name, {}).items():
+            labels = dict(key)
+            group = tuple(labels.get(label, "") for label in by)
+            totals[group] = totals.get(group, 0) + value
+        return totals
+
+    # --- 导出 ---
+    @staticmethod
+    def _format_labels(labels) -> str:
+        if not labels:
+            return ""
+        escaped = (
+            f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), chr(92) + "n")}"'
+            for k, v in labels
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def render_prometheus(self, gauges: List[Tuple[str, str, tuple, float]]) -> str:
+        """渲染 Prometheus 文本格式，gauges 为 [(名称, 说明, 标签, 值)]"""
+        lines = []
+        for name in sorted(set(self._histograms) | set(self._counters)):
+            kind, help_text = METRIC_HELP.get(name, ("counter" if name in self._counters else "histogram", name))
+            lines.append(f"# HELP hgt_{name} {help_text}")
+            lines.append(f"# TYPE hgt_{name} {kind}")
+            for key, data in sorted(self._histograms.get(name, {}).items()):
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + (float("inf"),), data):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"hgt_{name}_bucket{self._format_labels(key + (('le', le),))} {cumulative}")
+                lines.append(f"hgt_{name}_sum{self._format_labels(key)} {data[-1]}")
+                lines.append(f"hgt_{name}_count{self._format_labels(key)} {data[-2]}")
+            for key, value in sorted(self._counters.get(name, {}).items()):
+                lines.append(f"hgt_{name}{self._format_labels(key)} {value}")
+        described = set()
+        for name, help_text, labels, value in gauges:
+            if name not in described:
+                lines.append(f"# HELP hgt_{name} {help_text}")
+                lines.append(f"# TYPE hgt_{name} gauge")
+                described.add(name)
+            lines.append(f"hgt_{name}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def maybe_export(self, force: bool = False):
+        """距上次导出超过 export_interval 时写出 metrics.prom (先写临时文件再替换)"""
+        now = time.monotonic()
+        if not self.enabled or (not force and now - self._last_export < self.export_interval):
+            return
+        self._last_export = now
+        path = os.path.join(PLUGIN_DIR, self.EXPORT_FILE)
+        try:
+            text = self.render_prometheus(_collect_metric_gauges())
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            print(f"写入运行指标文件失败: {e}")
+
+
+def _metric_action_label(action: str) -> str:
+    """把命令动作映射为有限的标签值，防止任意输入撑大指标"""
+    return action if action in METRIC_ACTIONS else "其他"
+
+
+def _collect_metric_gauges() -> List[Tuple[str, str, tuple, float]]:
+    """导出时采集的瞬时值：调度器、熔断器、缓存、题目池和会话"""
+    gauges = []
+    scheduler = _get_llm_scheduler().stats()
+    gauges.append(("llm_running", "正在进行的LLM请求数", (), scheduler["running"]))
+    for priority, queued in scheduler["queued"].items():
+        gauges.append(("llm_queued", "排队中的LLM请求数", (("priority", priority),), queued))
+    router = _get_llm_router().stats()
+    for model, info in router["models"].items():
+        gauges.append(("llm_breaker_open", "模型熔断状态 (1 为熔断中)", (("model", model),), int(info["state"] == "open")))
+    for event in ("retries", "failovers", "hedges", "hedge_wins"):
+        gauges.append(("llm_failover_events", "重试/切换模型/对冲请求累计次数", (("event", event),), router[event]))
+    gauges.append(("verdict_cache_entries", "判断缓存条目数", (), _get_verdict_cache().stats()["entries"]))
+    gauges.append(("dedup_index_entries", "近似重复检测索引中的题目数", (), len(_get_dedup_index())))
+    pool = _get_puzzle_pool()
+    for model in pool.models():
+        gauges.append(("puzzle_pool_size", "预生成题目池剩余题目数", (("model", model),), pool.available(model)))
+    gauges.append(("game_sessions", "内存中的游戏会话数", (), len(game_states)))
+    gauges.append(("outbox_pending", "发送队列中等待发送的消息数", (), _get_outbox().pending()))
+    for outcome, value in prescreen_stats.items():
+        gauges.append(("guess_prescreen_results", "猜谜本地预判与LLM的一致情况", (("outcome", outcome),), value))
+    return gauges
+
+
+# --- 全局指标实例 ---
+metrics = MetricsRegistry()
+
+
+# --- 全局 LLM 请求调度器 ---
+PRIORITY_JUDGE = 0    # 问题/猜谜判断，玩家正在等待结果
+PRIORITY_HINT = 1     # 提示/线索整理
+PRIORITY_GENERATE = 2 # 出题 (包括后台题目池补充)
+PRIORITY_NAMES = {PRIORITY_JUDGE: "判断", PRIORITY_HINT: "提示", PRIORITY_GENERATE: "出题"}
+
+
+class _TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积累 burst 个"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def try_take(self, now: float) -> float:
+        """取一个令牌，成功返回 0，否则返回需要等待的秒数"""
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+
+class _SchedulerWaiter:
+    __slots__ = ("future", "api_key", "group_id", "action", "enqueued_at", "cancelled")
+
+    def __init__(self, future: asyncio.Future, api_key: str, group_id: str):
+        self.future = future
+        self.api_key = api_key
+        self.group_id = group_id
+        self.action = _metric_action.get() # 在发起请求的命令上下文中创建，用于指标标签
+        self.enqueued_at = time.monotonic()
+        self.cancelled = False
+
+
+class LLMScheduler:
+    """
+    所有 LLM 请求的统一入口。
+    - 全局并发上限 max_concurrency
+    - 每个 API Key 一个令牌桶限速，避免触发上游 429；按 Key 分开排队，被限速的 Key 不阻塞其他 Key
+    - 按优先级出队：判断 > 提示 > 出题
+    - 同一优先级内按群做加权公平排队 (虚拟完成时间)，刷屏的群不会饿死其他群
+    """
+
+    def __init__(
+        self, max_concurrency: int = 16, rate_per_second: float = 5.0, burst: float = 10.0,
+        queue_timeout: float = 60.0, group_weights: Optional[Dict[str, float]] = None
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.queue_timeout = queue_timeout
+        self.group_weights = {str(k): float(v) for k, v in (group_weights or {}).items() if float(v) > 0}
+        # {priority: {api_key: [(tag, seq, waiter), ...]}}，每个 API Key 一个小顶堆，限速的 Key 不阻塞其他 Key
+        self._queues: Dict[int, Dict[str, list]] = {p: {} for p in PRIORITY_NAMES}
+        self._group_tags: Dict[str, float] = {} # {group_id: 该群最后一个请求的虚拟完成时间}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+        self._buckets: Dict[str, _TokenBucket] = {}
+        self._running = 0
+        self._wakeup = None
+        # 监控数据
+        self.granted = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int, group_id: str, api_key: str):
+        """排队获取一个请求名额，退出时归还"""
+        await self.acquire(priority, group_id, api_key)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority: int, group_id: str, api_key: str):
+        loop = asyncio.get_running_loop()
+        waiter = _SchedulerWaiter(loop.create_future(), api_key, group_id)
+        weight = self.group_weights.get(group_id, 1.0)
+        tag = max(self._virtual_time, self._group_tags.get(group_id, 0.0)) + 1.0 / weight
+        self._group_tags[group_id] = tag
+        heapq.heappush(self._queues.setdefault(priority, {}).setdefault(api_key, []), (tag, next(self._seq), waiter))
+        self._dispatch()
+        try:
+            await asyncio.wait_for(waiter.future, timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            waiter.cancelled = True
+            self.timeouts += 1
+            raise
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release() # 已分配名额后被取消，归还名额
+            waiter.cancelled = True
+            raise
+
+    def release(self):
+        self._running -= 1
+        if len(self._group_tags) > 1000:
+            # 清理已经没有排队请求的群，防止字典无限增长
+            self._group_tags = {g: t for g, t in self._group_tags.items() if t > self._virtual_time}
+        self._dispatch()
+
+    def _bucket(self, api_key: str) -> _TokenBucket:
+        bucket = self._buckets.get(api_key)
+        if bucket is None:
+            bucket = _TokenBucket(self.rate_per_second, self.burst)
+            self._buckets[api_key] = bucket
+        return bucket
+
+    def _next_ready(self, now: float) -> Tuple[Optional[Tuple[int, tuple]], Optional[float]]:
+        """
+        按优先级、同一优先级内按公平顺序取出第一个所用 API Key 还有令牌的请求 (并取走令牌)。
+        只比较各 Key 子队列的队首，令牌桶已空的 Key 整体跳过，不阻塞其他 Key 的请求；
+        全部被限速时返回 (None, 最早可以发放的等待秒数)，没有排队请求时返回 (None, None)。
+        """
+        earliest = None
+        throttled = set()
+        for priority in sorted(self._queues):
+            by_key = self._queues[priority]
+            heads = []
+            for api_key in list(by_key):
+                queue = by_key[api_key]
+                # 跳过已超时/取消的等待者 (wait_for 超时会先取消 future)
+                while queue and (queue[0][2].cancelled or queue[0][2].future.done()):
+                    heapq.heappop(queue)
+                if not queue:
+                    del by_key[api_key]
+                elif api_key not in throttled:
+                    heads.append((queue[0], api_key))
+            heads.sort(key=lambda head: head[0][:2])
+            for head, api_key in heads:
+                delay = self._bucket(api_key).try_take(now)
+                if delay > 0:
+                    throttled.add(api_key)
+                    earliest = delay if earliest is None else min(earliest, delay)
+                    continue
+                heapq.heappop(by_key[api_key])
+                return (priority, head), None
+        return None, earliest
+
+    def _dispatch(self):
+        while self._running < self.max_concurrency:
+            now = time.monotonic()
+            entry, delay = self._next_ready(now)
+            if entry is None:
+                if delay is not None:
+                    self._schedule_wakeup(delay)
+                return
+            priority, (tag, _, waiter) = entry
+            self._virtual_time = max(self._virtual_time, tag)
+            self._running += 1
+            waited = now - waiter.enqueued_at
+            self.granted += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            metrics.observe(
+                "llm_queue_wait_seconds", waited,
+                action=waiter.action, priority=PRIORITY_NAMES.get(priority, str(priority))
+            )
+            if waited > 5:
+                print(f"[LLM Scheduler] 群 {waiter.group_id} 的{PRIORITY_NAMES.get(priority, priority)}请求排队 {waited:.1f}s")
+            waiter.future.set_result(None)
+
+    def _schedule_wakeup(self, delay: float):
+        """在 delay 秒后重新派发；已有更早的唤醒时保留它，否则改为更早的时间"""
+        loop = asyncio.get_running_loop()
+        if self._wakeup is not None and not self._wakeup.cancelled():
+            if self._wakeup.when() <= loop.time() + delay:
+                return
+            self._wakeup.cancel()
+
+        def wake():
+            self._wakeup = None
+            self._dispatch()
+
+        self._wakeup = loop.call_later(delay, wake)
+
+    def stats(self) -> Dict[str, Any]:
+        """监控数据：各优先级排队数、运行数、平均/最大排队时间"""
+        return {
+            "running": self._running,
+            "queued": {
+                PRIORITY_NAMES.get(p, str(p)): sum(
+                    1 for q in by_key.values() for e in q if not (e[2].cancelled or e[2].future.done())
+                )
+                for p, by_key in self._queues.items()
+            },
+            "granted": self.granted,
+            "timeouts": self.timeouts,
+            "avg_wait": self.total_wait / self.granted if self.granted else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+def _get_llm_scheduler() -> "LLMScheduler":
+    """获取全局调度器，插件实例尚未创建时按默认配置懒加载"""
+    global llm_scheduler
+    if llm_scheduler is None:
+        llm_scheduler = LLMScheduler()
+    return llm_scheduler
+
+
+# --- 多模型故障转移：重试、对冲请求和熔断 ---
+class _CircuitBreaker:
+    """单个模型的熔断器：连续失败 failure_threshold 次后打开，冷却 cooldown 秒后放行一个试探请求"""
+
+    __slots__ = ("failures", "opened_at", "probing")
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    def state(self, now: float, cooldown: float) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if now - self.opened_at >= cooldown else "open"
+
+
+class ModelRouter:
+    """
+    为每次 LLM 调用选择模型：
+    - 失败时按抖动退避重试，并依次切换到 llm.models 中其他健康的模型
+    - 请求耗时超过该模型近期延迟的分位数时，向下一个健康模型 (没有时为同一模型) 发出对冲请求，取先成功的结果
+    - 每个模型一个熔断器，连续失败后在冷却期内不再向它发送请求
+    """
+
+    LATENCY_SAMPLES = 100
+    MIN_HEDGE_SAMPLES = 20
+
+    def __init__(
+        self, enabled: bool = True, models: Optional[List[str]] = None, max_attempts: int = 3,
+        backoff_base: float = 0.5, backoff_max: float = 4.0,
+        hedge_percentile: float = 0.95, hedge_min_delay: float = 2.0,
+        failure_threshold: int = 5, cooldown: float = 30.0
+    ):
+        self.enabled = enabled
+        self.models = list(models or [])
+        self.max_attempts = max(1, max_attempts) if enabled else 1
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self._breakers: Dict[str, _CircuitBreaker] = {}
+        self._latencies: Dict[str, deque] = {}
+        # 监控数据
+        self.retries = 0
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _breaker(self, model: str) -> _CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = _CircuitBreaker()
+        return breaker
+
+    def candidates(self, model: str) -> List[str]:
+        """首选模型在前，其后是 llm.models 中的其他模型"""
+        if not self.enabled:
+            return [model]
+        return [model] + [m for m in self.models if m != model]
+
+    def available(self, model: str) -> bool:
+        breaker = self._breaker(model)
+        state = breaker.state(time.monotonic(), self.cooldown)
+        return state == "closed" or (state == "half_open" and not breaker.probing)
+
+    def pick(self, candidates: List[str], start: int = 0, exclude: Optional[str] = None) -> Optional[str]:
+        """从 start 开始轮转选出第一个未熔断的模型"""
+        for offset in range(len(candidates)):
+            model = candidates[(start + offset) % len(candidates)]
+            if model != exclude and self.available(model):
+                return model
+        return None
+
+    def backoff(self, attempt: int) -> float:
+        """第 attempt 次重试前的等待时间 (full jitter 指数退避)"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1))))
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        """按该模型近期延迟的分位数计算对冲等待时间，样本不足或未启用时返回 None"""
+        samples = self._latencies.get(model)
+        if not self.enabled or self.hedge_percentile <= 0 or not samples or len(samples) < self.MIN_HEDGE_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile))
+        return max(self.hedge_min_delay, ordered[index])
+
+    def begin(self, model: str):
+        """请求发出前调用：半开状态下标记试探请求，其他请求继续被拒绝"""
+        breaker = self._breaker(model)
+        if breaker.state(time.monotonic(), self.cooldown) == "half_open":
+            breaker.probing = True
+
+    def abandon(self, model: str):
+        """请求被取消 (对冲请求已先返回)，不计入成败，但要释放半开状态的试探名额"""
+        self._breaker(model).probing = False
+
+    def record(self, model: str, success: bool, latency: float):
+        breaker = self._breaker(model)
+        breaker.probing = False
+        if success:
+            if breaker.opened_at is not None:
+                print(f"[LLM Failover] 模型 {model} 已恢复。")
+            breaker.failures = 0
+            breaker.opened_at = None
+            self._latencies.setdefault(model, deque(maxlen=self.LATENCY_SAMPLES)).append(latency)
+            return
+        breaker.failures += 1
+        if breaker.opened_at is not None or breaker.failures >= self.failure_threshold:
+            breaker.opened_at = time.monotonic()
+            print(f"[LLM Failover] 模型 {model} 连续失败 {breaker.failures} 次，熔断 {self.cooldown:.0f}s。")
+
+    def stats(self) -> Dict[str, Any]:
+        """监控数据：各模型熔断状态和延迟分位数，以及重试/切换/对冲次数"""
+        now = time.monotonic()
+        models = {}
+        for model in set(self._breakers) | set(self._latencies):
+            ordered = sorted(self._latencies.get(model, ()))
+            models[model] = {
+                "state": self._breaker(model).state(now, self.cooldown),
+                "failures": self._breaker(model).failures,
+                "p50": ordered[len(ordered) // 2] if ordered else None,
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else None,
+            }
+        return {
+            "models": models,
+            "retries": self.retries,
+            "failovers": self.failovers,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+def _get_llm_router() -> "ModelRouter":
+    """获取全局模型路由，插件实例尚未创建时按默认配置懒加载"""
+    global llm_router
+    if llm_router is None:
+        llm_router = ModelRouter()
+    return llm_router
+
+
+async def _request_llm(
+    prompt: Union[str, List[Dict[str, str]]], api_url: str, api_key: str, model: str, temperature: float,
+    max_tokens: int = 500, stream: bool = False,
+    on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+    stop_when: Optional[Callable[[str], Optional[str]]] = None,
+    priority: int = PRIORITY_GENERATE, group_id: str = ""
+) -> str:
+    """
+    调用OpenAI格式的LLM API并返回响应文本，失败时返回空字符串。
+    prompt 为 PromptRegistry.render 渲染的 messages 列表；传入字符串时作为 user 消息，使用通用的 system 消息。
+    不依赖命令实例，后台任务 (如题目池补充) 也可直接调用。
+    stream=True 时使用 SSE 流式输出：每收到一段文本调用 on_delta，
+    stop_when(已收到的文本) 返回非 None 时立即停止并以其返回值作为结果。
+    请求先经过全局调度器排队，priority 越小越优先，同优先级内按 group_id 公平轮转。
+    失败时按退避重试并切换到其他健康的模型；已经向聊天输出过内容 (on_delta) 的流式请求不再重试，也不发对冲请求。
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+    if isinstance(prompt, str):
+        messages = [
+            {"role": "system", "content": "你是一个专业的海龟汤故事生成器和解释者。"},
+            {"role": "user", "content": prompt}
+        ]
+    else:
+        messages = list(prompt)
+    payload = {
+        "model": model, # --- 使用传入的模型名称 ---
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens, # 默认500，结构化生成时调大以容纳汤面和汤底
+        "stream": stream
+    }
+    router = _get_llm_router()
+    emitted = False
+    call_started = time.monotonic()
+
+    async def forward_delta(delta: str):
+        nonlocal emitted
+        emitted = True
+        await on_delta(delta)
+
+    async def attempt(attempt_model: str) -> str:
+        async with _get_llm_scheduler().slot(priority, group_id, api_key):
+            router.begin(attempt_model)
+            started = time.monotonic()
+            try:
+                content = await _request_llm_once(
+                    api_url, headers, dict(payload, model=attempt_model), stream,
+                    forward_delta if on_delta is not None else None, stop_when
+                )
+            except asyncio.CancelledError:
+                router.abandon(attempt_model) # 被对冲请求取消时不计入成败
+                raise
+            latency = time.monotonic() - started
+            router.record(attempt_model, bool(content), latency)
+            metrics.observe(
+                "llm_request_duration_seconds", latency,
+                action=_metric_action.get(), model=attempt_model, outcome="ok" if content else "error"
+            )
+            return content
+
+    candidates = router.candidates(model)
+    content = ""
+    try:
+        for attempt_index in range(router.max_attempts):
+            current = router.pick(candidates, attempt_index) or candidates[attempt_index % len(candidates)]
+            if current != model:
+                router.failovers += 1
+            if attempt_index > 0:
+                router.retries += 1
+                delay = router.backoff(attempt_index)
+                print(f"[LLM Failover] 第 {attempt_index + 1} 次尝试，{delay:.2f}s 后使用模型 {current}")
+                await asyncio.sleep(delay)
+            hedge_delay = router.hedge_delay(current) if on_delta is None else None
+            content = await _hedged(attempt, current, candidates, hedge_delay, router)
+            if content or emitted:
+                break # 成功，或已经向聊天输出了部分内容 (重试会重复输出)
+    except asyncio.TimeoutError:
+        # 调度器排队超时说明整体过载，不再重试
+        print(f"LLM 请求排队超时 (priority={priority}, group={group_id})")
+    metrics.observe(
+        "llm_call_duration_seconds", time.monotonic() - call_started,
+        action=_metric_action.get(), model=model, outcome="ok" if content else "error"
+    )
+    return content
+
+
+async def _hedged(
+    attempt: Callable[[str], Awaitable[str]], model: str, candidates: List[str],
+    hedge_delay: Optional[float], router: "ModelRouter"
+) -> str:
+    """先向 model 发出请求，超过 hedge_delay 仍未返回时再发出一个对冲请求，返回先成功的结果"""
+    primary = asyncio.create_task(attempt(model))
+    if hedge_delay is None:
+        return await primary
+    done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+    if done:
+        return primary.result()
+    hedge_model = router.pick(candidates, 0, exclude=model) or model
+    router.hedges += 1
+    print(f"[LLM Failover] 模型 {model} 超过 {hedge_delay:.2f}s 未返回，向 {hedge_model} 发出对冲请求")
+    hedge = asyncio.create_task(attempt(hedge_model))
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                content = task.result()
+                if content:
+                    if task is hedge:
+                        router.hedge_wins += 1
+                    return content
+        return ""
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _request_llm_once(
+    api_url: str, headers: dict, payload: dict, stream: bool,
+    on_delta: Optional[Callable[[str], Awaitable[None]]],
+    stop_when: Optional[Callable[[str], Optional[str]]]
+) -> str:
+    """发出单次请求，失败 (非200、异常或空回复) 时返回空字符串"""
+    try:
+        if stream:
+            return await _request_llm_stream(api_url, headers, payload, on_delta, stop_when)
+        # 复用插件级共享连接池，不再为每次调用新建 ClientSession
+        status, data, error_text = await _get_llm_client().post_json(api_url, headers, payload)
+        if status == 200 and isinstance(data, dict):
+            # 根据OpenAI API响应结构提取回复
+            # 假设回复在 choices[0].message.content 中
+            content = data.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
+            _record_token_usage(payload["model"], data.get("usage"))
+            if not content:
+                _record_llm_error(payload["model"], "empty")
+            return content
+        else:
+            print(f"LLM API 请求失败 ({payload['model']}): Status {status}, Body: {error_text}")
+            _record_llm_error(payload["model"], f"http_{status}")
+            return "" # 返回空字符串表示失败
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"调用LLM API时发生异常 ({payload['model']}): {e!r}")
+        _record_llm_error(payload["model"], type(e).__name__)
+        return "" # 返回空字符串表示失败
+
+
+def _record_token_usage(model: str, usage: Any):
+    """记录响应 usage 字段中的 token 数"""
+    if not isinstance(usage, dict):
+        return
+    for kind in ("prompt", "completion"):
+        value = usage.get(f"{kind}_tokens")
+        if isinstance(value, (int, float)):
+            metrics.inc("llm_tokens_total", value, action=_metric_action.get(), model=model, kind=kind)
+
+
+def _record_llm_error(model: str, reason: str):
+    metrics.inc("llm_errors_total", action=_metric_action.get(), model=model, reason=reason)
+
+
+async def _request_llm_stream(
+    api_url: str, headers: dict, payload: dict,
+    on_delta: Optional[Callable[[str], Awaitable[None]]],
+    stop_when: Optional[Callable[[str], Optional[str]]]
+) -> str:
+    """流式调用的实现，解析 choices[0].delta.content 增量"""
+    parts: List[str] = []
+    early_result: List[str] = []
+    usage: List[dict] = []
+
+    async def on_event(data: str) -> bool:
+        if data.strip() == "[DONE]":
+            return True
+        try:
+            event = _json_loads(data)
+        except ValueError:
+            return False
+        if isinstance(event.get("usage"), dict):
+            usage.append(event["usage"]) # 部分服务在最后一个事件中返回 usage
+        choices = event.get("choices") or [{}]
+        delta = (choices[0].get("delta") or {}).get("content") or ""
+        if not delta:
+            return False
+        parts.append(delta)
+        if on_delta is not None:
+            await on_delta(delta)
+        if stop_when is not None:
+            settled = stop_when("".join(parts))
+            if settled is not None:
+                early_result.append(settled)
+                return True
+        return False
+
+    status, error_text = await _get_llm_client().post_stream(api_url, headers, payload, on_event)
+    if status != 200:
+        print(f"LLM API 流式请求失败: Status {status}, Body: {error_text}")
+        _record_llm_error(payload["model"], f"http_{status}")
+        return ""
+    if usage:
+        _record_token_usage(payload["model"], usage[-1])
+    if early_result:
+        return early_result[0]
+    content = "".join(parts).strip()
+    if not content:
+        _record_llm_error(payload["model"], "empty")
+    return content
+
+
+def _settled_verdict(text: str) -> Optional[str]:
+    """
+    流式判断的提前结束条件：已收到的文本足以确定判断结果时返回该结果。
+    "是" 可能是 "是也不是" 的开头，需要再看到下一个字符才能确定。
+    """
+    text = text.strip()
+    for verdict in ("是也不是", "不是", "无关"):
+        if text.startswith(verdict):
+            return verdict
+    if len(text) >= 2 and text.startswith("是") and not text.startswith("是也"):
+        return "是"
+    return None
+
+
+class _SentenceFlusher:
+    """
+    流式长文本的分段发送器：累积到一定长度且遇到句子边界时把已完成的部分先发出去。
+    第一段带上标题；finish() 发送剩余文本。
+    """
+
+    SENTENCE_ENDS = "。！？!?\n"
+
+    def __init__(self, send: Callable[[str], Awaitable[Any]], header: str, min_chars: int = 40):
+        self._send = send
+        self._header = header
+        self._min_chars = min_chars
+        self._buffer = ""
+        self.flushed = False
+
+    async def feed(self, delta: str):
+        self._buffer += delta
+        if len(self._buffer) < self._min_chars:
+            return
+        cut = max(self._buffer.rfind(ch) for ch in self.SENTENCE_ENDS)
+        if cut < self._min_chars - 1:
+            return
+        ready, self._buffer = self._buffer[:cut + 1].strip(), self._buffer[cut + 1:]
+        if ready:
+            await self._emit(ready)
+
+    async def _emit(self, text: str):
+        if not self.flushed:
+            text = f"{self._header}{text}"
+            self.flushed = True
+        try:
+            await self._send(text)
+        except Exception as e:
+            print(f"发送流式分段失败: {e}")
+
+    async def finish(self):
+        rest, self._buffer = self._buffer.strip(), ""
+        if rest:
+            await self._emit(rest)
+
+
+# --- 消息发送队列：按聊天流排队、限速、合并短回复和拆分长文本 ---
+# 拆分长文本时依次尝试的边界：段落、换行、句末标点、分句标点、空格
+_SPLIT_BOUNDARIES = ("\n\n", "\n", "。", "！", "？", "!", "?", "；", ";", "，", ",", " ")
+
+
+def _split_message(text: str, max_chars: int) -> List[str]:
+    """把超过 max_chars 的文本在最靠后的安全边界处拆成多段，找不到边界时才硬切"""
+    if max_chars <= 0 or len(text) <= max_chars:
+        return [text]
+    pieces = []
+    while len(text) > max_chars:
+        window = text[:max_chars]
+        cut = max_chars
+        for boundary in _SPLIT_BOUNDARIES:
+            pos = window.rfind(boundary)
+            if pos >= max_chars // 2: # 边界太靠前时换下一种，避免拆出过短的片段
+                cut = pos + len(boundary)
+                break
+        piece, text = text[:cut].rstrip(), text[cut:].lstrip("\n")
+        if piece:
+            pieces.append(piece)
+    if text.strip():
+        pieces.append(text)
+    return pieces
+
+
+class _OutboundMessage:
+    __slots__ = ("text", "deliver", "args", "kwargs", "action", "enqueued_at", "attempts")
+
+    def __init__(self, text: str, deliver: Callable[..., Awaitable[Any]], args: tuple, kwargs: dict, action: str):
+        self.text = text
+        self.deliver = deliver
+        self.args = args
+        self.kwargs = kwargs
+        self.action = action # 放入队列时的命令动作，用于指标标签
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class _StreamOutbox:
+    __slots__ = ("queue", "task", "next_send")
+
+    def __init__(self):
+        self.queue: Deque[_OutboundMessage] = deque()
+        self.task: Optional[asyncio.Task] = None
+        self.next_send = 0.0 # 该聊天流下一条消息最早的发送时间 (monotonic)
+
+
+class Outbox:
+    """
+    按聊天流 (stream_id) 排队的消息发送队列，命令把回复放入队列后立即返回，由每个聊天流一个后台协程按顺序发送。
+    - 同一聊天流两条消息至少间隔 min_interval 秒，所有聊天流共享一个令牌桶 (rate_per_second / burst)
+    - 排队中的连续短回复合并为一条消息 (不超过 coalesce_chars)，超过 max_chars 的文本按段落、换行或句子拆分
+    - 发送抛出异常或返回 False 时按指数退避重试 max_retries 次，仍失败则记录日志后丢弃
+    队列发送完后后台协程退出，空闲的聊天流不占用协程。
+    """
+
+    MAX_IDLE_STREAMS = 1000 # 超过时清理已经发送完且过了间隔的聊天流
+
+    def __init__(
+        self, enabled: bool = True, min_interval: float = 1.0, rate_per_second: float = 5.0, burst: float = 10.0,
+        coalesce_chars: int = 500, max_chars: int = 1500, max_retries: int = 3, retry_backoff: float = 1.0,
+        max_pending: int = 50, drain_timeout: float = 10.0
+    ):
+        self.enabled = enabled
+        self.min_interval = max(0.0, min_interval)
+        self.max_chars = max(0, max_chars)
+        # 合并后也不能超过单条消息上限，否则拆开的长文本会被重新拼回去
+        self.coalesce_chars = max(0, min(coalesce_chars, self.max_chars) if self.max_chars else coalesce_chars)
+        self.max_retries = max(0, max_retries)
+        self.retry_backoff = max(0.0, retry_backoff)
+        self.max_pending = max(1, max_pending)
+        self.drain_timeout = drain_timeout
+        self._bucket = _TokenBucket(rate_per_second, burst)
+        self._streams: Dict[str, _StreamOutbox] = {}
+        self.counts = {"sent": 0, "merged": 0, "split": 0, "retried": 0, "failed": 0, "dropped": 0}
+
+    def _count(self, result: str, amount: int = 1):
+        self.counts[result] += amount
+        metrics.inc("outbox_messages_total", amount, result=result)
+
+    def pending(self) -> int:
+        return sum(len(stream.queue) for stream in self._streams.values())
+
+    def put(self, stream_id: str, text: str, deliver: Callable[..., Awaitable[Any]], args: tuple = (), kwargs: Optional[dict] = None):
+        """把消息 (过长时先拆分) 放入聊天流的队列，需要时启动该聊天流的发送协程"""
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            if len(self._streams) >= self.MAX_IDLE_STREAMS:
+                self._prune()
+            stream = self._streams[stream_id] = _StreamOutbox()
+        pieces = _split_message(text, self.max_chars)
+        if len(pieces) > 1:
+            self._count("split")
+        action = _metric_action.get()
+        for piece in pieces:
+            stream.queue.append(_OutboundMessage(piece, deliver, args, kwargs or {}, action))
+        while len(stream.queue) > self.max_pending:
+            dropped = stream.queue.popleft()
+            self._count("dropped")
+            print(f"[Outbox] {stream_id} 排队消息超过 {self.max_pending} 条，丢弃最早的消息: {dropped.text[:30]}")
+        if stream.task is None or stream.task.done():
+            stream.task = asyncio.ensure_future(self._run(stream_id, stream))
+
+    def _prune(self):
+        now = time.monotonic()
+        self._streams = {
+            sid: stream for sid, stream in self._streams.items()
+            if stream.queue or stream.next_send > now or (stream.task is not None and not stream.task.done())
+        }
+
+    async def send_now(self, text: str, deliver: Callable[..., Awaitable[Any]], args: tuple = (), kwargs: Optional[dict] = None, action: Optional[str] = None) -> Any:
+        """直接发送一条消息并记录发送耗时，异常向上抛出"""
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            result = await deliver(text, *args, **(kwargs or {}))
+            if result is not False:
+                outcome = "ok"
+            return result
+        finally:
+            metrics.observe(
+                "send_duration_seconds", time.monotonic() - started,
+                action=action or _metric_action.get(), outcome=outcome
+            )
+
+    async def _run(self, stream_id: str, stream: _StreamOutbox):
+        while stream.queue:
+            await self._pace(stream)
+            message = self._take(stream)
+            await self._deliver(stream_id, message)
+            stream.next_send = time.monotonic() + self.min_interval
+
+    async def _pace(self, stream: _StreamOutbox):
+        """等到聊天流的发送间隔已过并从全局令牌桶取到令牌"""
+        while True:
+            now = time.monotonic()
+            wait = stream.next_send - now
+            if wait <= 0:
+                wait = self._bucket.try_take(now)
+                if wait <= 0:
+                    return
+            await asyncio.sleep(wait)
+
+    def _take(self, stream: _StreamOutbox) -> _OutboundMessage:
+        """取出队首消息，并把紧随其后、发送参数相同的短消息合并进来"""
+        message = stream.queue.popleft()
+        parts, length = [message.text], len(message.text)
+        while stream.queue and self.coalesce_chars:
+            following = stream.queue[0]
+            if (
+                following.args != message.args or following.kwargs != message.kwargs
+                or length + 1 + len(following.text) > self.coalesce_chars
+            ):
+                break
+            stream.queue.popleft()
+            parts.append(following.text)
+            length += 1 + len(following.text)
+        if len(parts) > 1:
+            message.text = "\n".join(parts)
+            self._count("merged", len(parts) - 1)
+        return message
+
+    async def _deliver(self, stream_id: str, message: _OutboundMessage):
+        while True:
+            try:
+                result = await self.send_now(message.text, message.deliver, message.args, message.kwargs, message.action)
+                error = "发送接口返回失败" if result is False else None
+            except Exception as e:
+                error = str(e) or type(e).__name__
+            if error is None:
+                self._count("sent")
+                metrics.observe("outbox_delay_seconds", time.monotonic() - message.enqueued_at, action=message.action)
+                return
+            if message.attempts >= self.max_retries:
+                self._count("failed")
+                print(f"[Outbox] 发送到 {stream_id} 失败 (已重试 {message.attempts} 次)，丢弃消息: {error}")
+                return
+            message.attempts += 1
+            self._count("retried")
+            await asyncio.sleep(min(self.retry_backoff * 2 ** (message.attempts - 1), 30.0))
+
+    async def aclose(self):
+        """等待各聊天流的队列发送完，超过 drain_timeout 后取消剩余的发送"""
+        tasks = [stream.task for stream in self._streams.values() if stream.task is not None and not stream.task.done()]
+        if not tasks:
+            return
+        done, running = await asyncio.wait(tasks, timeout=self.drain_timeout)
+        if running:
+            dropped = self.pending()
+            print(f"[Outbox] 关闭时仍有 {dropped} 条消息未发送，放弃发送。")
+            if dropped:
+                self._count("dropped", dropped)
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+        self._streams.clear()
+
+
+def _get_outbox() -> "Outbox":
+    """获取全局发送队列，插件实例尚未创建时按默认配置创建"""
+    global outbox
+    if outbox is None:
+        outbox = Outbox()
+    return outbox
+
+
+# --- 新增工具函数：加载本地题目 ---
+# --- 本地题库：流式导入 + 内存映射的二进制题库 ---
+LIBRARY_SOURCE_FILES = ("turtle.json", "turtle.jsonl") # 按顺序查找第一个存在的源文件
+LIBRARY_FILE = "turtle_library.bin" # 编译后的题库文件
+_LIBRARY_MAX_WARNINGS = 20 # 无效题目最多逐条打印的警告数
+
+
+def _iter_json_array(f, chunk_size: int = 1 << 16):
+    """分块读取 JSON 数组，逐个返回数组元素，不把整个文件读入内存"""
+    decoder = json.JSONDecoder()
+    separators = re.compile(r"[\s,]*")
+    buf, pos, eof, started = "", 0, False, False
+    while True:
+        if not eof and len(buf) - pos < chunk_size:
+            chunk = f.read(chunk_size)
+            if chunk:
+                buf, pos = buf[pos:] + chunk, 0
+            else:
+                eof = True
+        pos = separators.match(buf, pos).end()
+        if pos >= len(buf):
+            if eof:
+                raise ValueError("文件内容必须是一个完整的数组。")
+            continue
+        if not started:
+            if buf[pos] != "[":
+                raise ValueError("文件内容必须是一个数组。")
+            started, pos = True, pos + 1
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            item, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # 元素跨越了块边界，读入更多数据后重试
+            chunk = f.read(chunk_size)
+            if chunk:
+                buf, pos = buf[pos:] + chunk, 0
+            else:
+                eof = True
+            continue
+        yield item
+
+
+def _iter_soup_records(path: str):
+    """
+    流式读取题目源文件，逐条返回 (位置描述, 原始记录)。
+    根据第一个非空白字符识别格式：'[' 为 JSON 数组，否则按 JSONL (每行一个对象) 处理；
+    JSONL 中无法解析的行返回 None，由调用方当作无效题目跳过。
+    """
+    with open(path, "r", encoding="utf-8-sig") as f:
+        head = f.read(4096).lstrip()
+        f.seek(0)
+        if head.startswith("["):
+            for i, item in enumerate(_iter_json_array(f), 1):
+                yield f"第 {i} 项", item
+            return
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield f"第 {lineno} 行", _json_loads(line)
+            except ValueError:
+                yield f"第 {lineno} 行", None
+
+
+def _validate_soup(item: Any) -> Optional[Tuple[str, str, str]]:
+    """校验单条题目，有效时返回去除首尾空白的 (name, question, answer)"""
+    if not isinstance(item, dict):
+        return None
+    fields = (item.get("name"), item.get("question"), item.get("answer"))
+    if not all(isinstance(field, str) and field.strip() for field in fields):
+        return None
+    return tuple(field.strip() for field in fields)
+
+
+class SoupLibrary:
+    """
+    只读的本地题库，通过 mmap 映射编译后的二进制文件，按需解码题目。
+    文件布局 (小端)：
+      头部    magic, 题目数, 源文件 mtime_ns, 源文件大小
+      记录表  每个题目一条：题目id (sha1 摘要), name/question/answer 在文本区的偏移和长度
+      索引表  (题目id, 记录序号)，按题目id排序，用于二分查找
+      文本区  所有题目文本的 UTF-8 编码，依次拼接
+    """
+
+    MAGIC = b"HGTSOUP1"
+    HEADER = struct.Struct("<8sIqQ")
+    RECORD = struct.Struct("<20sQIQIQI")
+    INDEX = struct.Struct("<20sI")
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.count = 0
+        self.source_mtime_ns = 0
+        self.source_size = 0
+        self._file = None
+        self._mm = None
+        if path is not None:
+            self._open(path)
+
+    def _open(self, path: str):
+        f = open(path, "rb")
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            f.close()
+            raise
+        try:
+            if len(mm) < self.HEADER.size:
+                raise ValueError(f"{path} 不是有效的题库文件。")
+            magic, count, mtime_ns, size = self.HEADER.unpack_from(mm, 0)
+            blob_at = self.HEADER.size + count * (self.RECORD.size + self.INDEX.size)
+            if magic != self.MAGIC or len(mm) < blob_at:
+                raise ValueError(f"{path} 不是有效的题库文件。")
+        except Exception:
+            mm.close()
+            f.close()
+            raise
+        self._file, self._mm = f, mm
+        self.count, self.source_mtime_ns, self.source_size = count, mtime_ns, size
+        self._index_at = self.HEADER.size + count * self.RECORD.size
+        self._blob_at = blob_at
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._file.close()
+            self._mm = self._file = None
+        self.count = 0
+
+    # --- 读取 ---
+    def __len__(self) -> int:
+        return self.count
+
+    def _record(self, index: int) -> tuple:
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("题目序号超出范围")
+        return self.RECORD.unpack_from(self._mm, self.HEADER.size + index * self.RECORD.size)
+
+    def __getitem__(self, index: int) -> dict:
+        digest, name_at, name_len, q_at, q_len, a_at, a_len = self._record(index)
+        return {
+            "id": digest.hex(),
+            "name": self._text(name_at, name_len),
+            "question": self._text(q_at, q_len),
+            "answer": self._text(a_at, a_len),
+        }
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+    def page(self, page: int, page_size: int) -> List[Tuple[int, str]]:
+        """返回第 page 页 (从1开始) 的 [(序号, 名称)]，只读取该页的记录"""
+        start = (page - 1) * page_size
+        return [(index + 1, self.name(index)) for index in range(max(start, 0), min(start + page_size, self.count))]
+
+    def name(self, index: int) -> str:
+        """只解码题目名称，用于列表和搜索结果"""
+        record = self._record(index)
+        return self._text(record[1], record[2])
+
+    def digest(self, index: int) -> bytes:
+        return self._record(index)[0]
+
+    def _text(self, offset: int, length: int) -> str:
+        start = self._blob_at + offset
+        return self._mm[start:start + length].decode("utf-8")
+
+    def _index_entry(self, position: int) -> Tuple[bytes, int]:
+        return self.INDEX.unpack_from(self._mm, self._index_at + position * self.INDEX.size)
+
+    def find(self, digest: bytes) -> int:
+        """按题目id二分查找，返回记录序号，不存在时返回 -1"""
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self._index_entry(mid)[0] < digest:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.count:
+            found, index = self._index_entry(low)
+            if found == digest:
+                return index
+        return -1
+
+    def get(self, puzzle_id: str) -> Optional[dict]:
+        """按题目id (十六进制内容哈希) 获取题目"""
+        try:
+            digest = bytes.fromhex(puzzle_id)
+        except (TypeError, ValueError):
+            return None
+        index = self.find(digest)
+        return self[index] if index >= 0 else None
+
+    def digests(self) -> set:
+        return {self._index_entry(position)[0] for position in range(self.count)}
+
+    def is_current(self, source_path: str) -> bool:
+        """题库是否由该源文件的当前版本编译而来"""
+        try:
+            stat = os.stat(source_path)
+        except OSError:
+            return False
+        return self.count > 0 and (stat.st_mtime_ns, stat.st_size) == (self.source_mtime_ns, self.source_size)
+
+
+def _compile_soup_library(source_path: str, target_path: str) -> Tuple[int, int]:
+    """
+    流式读取题目源文件并编译为二进制题库，写入 target_path，返回 (有效题目数, 跳过题目数)。
+    文本直接写入临时文本区文件，内存中只保留每个题目的偏移和长度。
+    """
+    stat = os.stat(source_path)
+    records = []
+    skipped = 0
+    blob_path = target_path + ".blob"
+    try:
+        with open(blob_path, "wb") as blob:
+            offset = 0
+            for where, item in _iter_soup_records(source_path):
+                soup = _validate_soup(item)
+                if soup is None:
+                    skipped += 1
+                    if skipped <= _LIBRARY_MAX_WARNINGS:
+                        print(f"警告：{source_path} {where}不是对象，或缺少 'name', 'question' 或 'answer' 字段，或字段为空，已跳过。")
+                    continue
+                name, question, answer = soup
+                record = [bytes.fromhex(_puzzle_hash(question, answer))]
+                for text in soup:
+                    data = text.encode("utf-8")
+                    blob.write(data)
+                    record += [offset, len(data)]
+                    offset += len(data)
+                records.append(record)
+        if skipped > _LIBRARY_MAX_WARNINGS:
+            print(f"警告：{source_path} 共有 {skipped} 项无效题目被跳过。")
+        with open(target_path, "wb") as out:
+            out.write(SoupLibrary.HEADER.pack(SoupLibrary.MAGIC, len(records), stat.st_mtime_ns, stat.st_size))
+            for record in records:
+                out.write(SoupLibrary.RECORD.pack(*record))
+            for index, record in sorted(enumerate(records), key=lambda entry: entry[1][0]):
+                out.write(SoupLibrary.INDEX.pack(record[0], index))
+            with open(blob_path, "rb") as blob:
+                shutil.copyfileobj(blob, out)
+    finally:
+        if os.path.exists(blob_path):
+            os.remove(blob_path)
+    return len(records), skipped
+
+
+def _find_library_source() -> Optional[str]:
+    for filename in LIBRARY_SOURCE_FILES:
+        path = os.path.join(PLUGIN_DIR, filename)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _open_local_library() -> "SoupLibrary":
+    """映射上次编译的题库，不存在或损坏时返回空题库"""
+    path = os.path.join(PLUGIN_DIR, LIBRARY_FILE)
+    if not os.path.exists(path):
+        return SoupLibrary()
+    try:
+        library = SoupLibrary(path)
+    except Exception as e:
+        print(f"打开本地题库 {path} 失败: {e}")
+        return SoupLibrary()
+    print(f"[Soup Library] 已映射 {len(library)} 个本地海龟汤题目。")
+    return library
+
+
+def _normalize_search_text(text: str) -> str:
+    """归一化搜索文本：全角转半角 (NFKC)、小写、去掉标点和空白"""
+    return _NON_WORD_RE.sub("", unicodedata.normalize("NFKC", text).lower())
+
+
+class SoupSearchIndex:
+    """
+    本地题目的字符 n-gram 倒排索引，覆盖题目名称和汤面。
+    文档按内容哈希标识：重新载入题库时未变化的题目保留原有倒排项，只为新增的题目建立索引，
+    被删除的题目记为墓碑，墓碑数超过有效文档数时整体重建。
+    """
+
+    N = 2 # 二元组，中文题目按字切分效果最好
+
+    def __init__(self):
+        self.library: Optional[SoupLibrary] = None # 索引当前对应的题库，题库被替换后需要更新
+        self._postings: Dict[str, array] = {} # {gram: 文档号数组 (递增)}
+        self._doc_digests: List[Optional[bytes]] = [] # 文档号 -> 内容哈希，None 表示墓碑
+        self._docs_by_digest: Dict[bytes, int] = {}
+        self._doc_records = array("i") # 文档号 -> 题库中的序号，-1 表示不在当前题库中
+        self._tombstones = 0
+
+    @classmethod
+    def _grams(cls, text: str) -> set:
+        text = _normalize_search_text(text)
+        if len(text) <= cls.N:
+            return {text} if text else set()
+        return {text[i:i + cls.N] for i in range(len(text) - cls.N + 1)}
+
+    def update(self, library: "SoupLibrary") -> int:
+        """按题库增量更新索引，返回新建立索引的题目数"""
+        self.library = None
+        records = array("i", [-1]) * len(self._doc_digests)
+        added = 0
+        for index in range(len(library)):
+            digest = library.digest(index)
+            doc = self._docs_by_digest.get(digest)
+            if doc is None:
+                doc = len(self._doc_digests)
+                self._doc_digests.append(digest)
+                self._docs_by_digest[digest] = doc
+                records.append(index)
+                soup = library[index]
+                for gram in self._grams(soup["name"]) | self._grams(soup["question"]):
+                    self._postings.setdefault(gram, array("I")).append(doc)
+                added += 1
+            elif records[doc] == -1: # 内容重复的题目只收录第一个
+                records[doc] = index
+        for doc, digest in enumerate(self._doc_digests):
+            if digest is not None and records[doc] == -1:
+                self._doc_digests[doc] = None
+                del self._docs_by_digest[digest]
+                self._tombstones += 1
+        self._doc_records = records
+        if self._tombstones > len(self._docs_by_digest):
+            self.__init__()
+            return self.update(library)
+        self.library = library
+        return added
+
+    def search(self, query: str, limit: int) -> List[Tuple[int, float]]:
+        """
+        返回按相关度排序的 [(题库序号, 得分)]。
+        得分为关键词二元组的命中比例，名称中包含完整关键词时额外加 1；至少命中一半二元组才算匹配。
+        """
+        grams = self._grams(query)
+        if not grams or self.library is None:
+            return []
+        counts: Dict[int, int] = {}
+        for gram in grams:
+            for doc in self._postings.get(gram, ()):
+                counts[doc] = counts.get(doc, 0) + 1
+        threshold = (len(grams) + 1) // 2
+        records = self._doc_records
+        candidates = heapq.nlargest(
+            limit * 3,
+            ((matched, -doc) for doc, matched in counts.items() if matched >= threshold and records[doc] >= 0),
+        )
+        keyword = _normalize_search_text(query)
+        ranked = []
+        for matched, doc in candidates:
+            index = records[-doc]
+            score = matched / len(grams)
+            if keyword in _normalize_search_text(self.library.name(index)):
+                score += 1
+            ranked.append((-score, index))
+        ranked.sort()
+        return [(index, -score) for score, index in ranked[:limit]]
+
+
+async def _refresh_search_index():
+    """在后台线程中按当前题库更新搜索索引"""
+    library = local_turtle_soups
+    try:
+        added = await asyncio.to_thread(soup_search_index.update, library)
+    except Exception as e:
+        print(f"更新本地题目搜索索引失败: {e}")
+        return
+    print(f"[Soup Search] 索引已更新，新增 {added} 个题目，共 {len(library)} 个。")
+
+
+async def _load_local_turtle_soups():
+    """
+    从插件目录下的 turtle.json (或 turtle.jsonl) 加载海龟汤题目到全局题库 local_turtle_soups。
+    /hgt 载入、启动时的自动载入和源文件变化触发的重新载入同时发起时只编译一次。
+    """
+    return await _single_flight.run(("载入",), _reload_local_library)
+
+
+async def _reload_local_library():
+    """
+    编译和比较新旧题库都在后台线程中进行，不阻塞事件循环；源文件未变化时直接复用已编译的题库。
+    新题库准备好后一次性替换全局题库，旧题库不主动关闭，仍在后台线程中读取旧题库的任务不受影响。
+    按内容哈希比较新旧题库，只有引用了被删除题目的进行中游戏才会把题目文本复制到会话中。
+    """
+    global local_turtle_soups
+    file_path = _find_library_source()
+    if file_path is None:
+        file_path = os.path.join(PLUGIN_DIR, LIBRARY_SOURCE_FILES[0])
+        print(f"本地题目文件 {file_path} 不存在。")
+        return False, f"本地题目文件 {file_path} 不存在。"
+
+    if local_turtle_soups.is_current(file_path):
+        message = f"{file_path} 未发生变化，已载入 {len(local_turtle_soups)} 个本地海龟汤题目。"
+        print(message)
+        return True, message
+
+    old_library = local_turtle_soups
+    target_path = os.path.join(PLUGIN_DIR, LIBRARY_FILE)
+    tmp_path = target_path + ".tmp"
+
+    def compile_library():
+        count, skipped = _compile_soup_library(file_path, tmp_path)
+        library = SoupLibrary(tmp_path)
+        return count, skipped, library, old_library.digests(), library.digests()
+
+    try:
+        count, skipped, new_library, old_digests, new_digests = await asyncio.to_thread(compile_library)
+    except (json.JSONDecodeError, ValueError) as e:
+        error_msg = f"解析 {file_path} 失败: {e}"
+    except Exception as e:
+        error_msg = f"加载 {file_path} 时发生未知错误: {e}"
+    else:
+        error_msg = None
+    if error_msg is not None:
+        print(error_msg)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False, error_msg
+
+    # 新题库中不再包含的题目，先把正在进行的游戏的题目文本复制到会话里，避免游戏丢题
+    for session in game_states.values():
+        if new_library.get(session.puzzle_id) is None:
+            session.materialize()
+
+    try:
+        # 已映射的文件可以直接替换 (映射仍指向原来的内容)，替换后新题库对应正式的题库文件
+        os.replace(tmp_path, target_path)
+        new_library.path = target_path
+    except OSError:
+        # Windows 不允许替换已映射的文件：先关闭映射再替换
+        old_library.close()
+        new_library.close()
+        try:
+            os.replace(tmp_path, target_path)
+            new_library = SoupLibrary(target_path)
+        except Exception as e:
+            print(f"替换本地题库文件失败，暂时使用临时文件: {e}")
+            new_library = SoupLibrary(tmp_path)
+    local_turtle_soups = new_library
+
+    # 搜索索引只为新增的题目建立倒排项，近似重复索引只收录新增的题目
+    await _single_flight.run(("搜索索引",), _refresh_search_index)
+    await _index_library_for_dedup(local_turtle_soups)
+
+    added, removed = len(new_digests - old_digests), len(old_digests - new_digests)
+    success_msg = f"成功从 {file_path} 加载了 {count} 个本地海龟汤题目 (新增 {added} 个，移除 {removed} 个)。"
+    if skipped:
+        success_msg += f"跳过了 {skipped} 个无效题目。"
+    print(success_msg)
+    return True, success_msg
+
+
+# --- 全局本地题库实例 (插件初始化时映射已编译的题库) ---
+local_turtle_soups = SoupLibrary()
+soup_search_index = SoupSearchIndex() # 首次搜索或载入题库时建立
+
+
+# --- 启动预热与本地题库变化监视 ---
+async def _warm_up_dedup_index():
+    """在后台线程中把索引文件加载到新实例，再并入加载期间新加入的题目后替换全局索引"""
+    global dedup_index
+    index = _get_dedup_index()
+    if not index.enabled:
+        return
+    loaded = PuzzleDedupIndex(enabled=True, threshold=index.threshold, max_entries=index.max_entries)
+    try:
+        await asyncio.to_thread(loaded.load)
+    except Exception as e:
+        print(f"[Puzzle Dedup] 后台加载索引失败: {e}")
+        return
+    if dedup_index is not index: # 加载期间插件已重载
+        return
+    for digest, signature in index._signatures.items():
+        loaded.add(digest, signature)
+    loaded.rejections += index.rejections
+    dedup_index = loaded
+
+
+class LibraryWatcher:
+    """
+    插件启动后的后台任务，不阻塞事件循环：
+    - 在线程中导入 aiohttp、加载近似重复索引，第一条需要它们的命令不用再等待
+    - auto_load 时自动载入本地题库 (源文件未变化时只映射已编译的题库并建立搜索索引)
+    - 之后每隔 interval 秒检查源文件的修改时间和大小，变化时重新载入，搜索和近似重复索引只处理新增的题目
+    创建时没有运行中的事件循环则在第一条命令时启动。
+    """
+
+    def __init__(self, auto_load: bool = True, interval: float = 30.0):
+        self.auto_load = auto_load
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self._seen: Optional[Tuple[str, int, int]] = None # 上次处理过的 (源文件, mtime_ns, 大小)
+
+    def start(self):
+        if self._task is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        try:
+            await asyncio.to_thread(importlib.import_module, "aiohttp")
+        except Exception as e:
+            print(f"预先导入 aiohttp 失败: {e}")
+        await _warm_up_dedup_index()
+        if self.auto_load:
+            await self.check()
+        while self.interval > 0:
+            await asyncio.sleep(self.interval)
+            await self.check()
+
+    def _source_state(self) -> Optional[Tuple[str, int, int]]:
+        path = _find_library_source()
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return path, stat.st_mtime_ns, stat.st_size
+
+    async def check(self):
+        """源文件与上次处理时不同则重新载入；载入失败的文件再次变化前不重试"""
+        state = self._source_state()
+        if state is None or state == self._seen:
+            return
+        first = self._seen is None
+        self._seen = state
+        if first and local_turtle_soups.is_current(state[0]):
+            # 启动时题库已是最新，只在后台建立搜索索引
+            if soup_search_index.library is not local_turtle_soups:
+                await _single_flight.run(("搜索索引",), _refresh_search_index)
+            return
+        print(f"[Soup Library] 检测到 {state[0]} {'需要载入' if first else '发生变化'}，后台重新载入。")
+        try:
+            await _load_local_turtle_soups()
+        except Exception as e:
+            print(f"[Soup Library] 自动载入失败: {e}")
+
+    def cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def aclose(self):
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+def _get_library_watcher() -> "LibraryWatcher":
+    """获取全局题库监视器，插件实例尚未创建时返回不自动载入的默认实例"""
+    global library_watcher
+    if library_watcher is None:
+        library_watcher = LibraryWatcher(auto_load=False, interval=0)
+    return library_watcher
+
+
+# --- 提示词模板：固定前缀 (系统指令 + 示例) 在前，题目和玩家输入在后 ---
+# 示例题目，按 prompts.few_shot 配置的数量附加到出题类模板的固定前缀中
+FEW_SHOT_EXAMPLES = (
+    (
+        "子的爱",
+        "我的父母都不理我，但我还是很爱他们。",
+        "小时候我是个很听话的孩子，爸爸妈妈经常给我好吃的水果，我吃不完。他们就告诉我喜欢的东西一定要放进冰箱，这样可以保鲜，记得那时候他们工作可辛苦了，经常加班到深夜。没睡过一个好觉。于是我耍了个小聪明，在他们的水里下了安眠药。他们睡得可香了，然后我把他们放进冰箱里，从那以后我每天都会对他们说：爸爸妈妈我爱你们。现在我都六十了，他们还是那么年轻。",
+    ),
+    (
+        "舞",
+        "我六岁那年，外公去世，我和亲人一起去祭奠，和姐姐玩捉迷藏，然后我对母亲说了句话把她吓昏了过去。",
+        "我去参加外公的葬礼，同行的还有比我大两岁的姐姐，我和她完捉迷藏我没有找到她没想到她躲在了纸做的房子里，当纸房子被点燃，我看见姐姐在跳舞，我对妈说，妈姐姐在那房子里面跳舞，因为姐姐被烧死了，我一直记得这个事。",
+    ),
+    (
+        "插进来",
+        "他迅速的插进来，又迅速的拔出去。反反复复，我流血了。他满头大汗，露出了笑容。\"啊，好舒服\"",
+        "他是实习护士，在给我打针，针头打进血管里面会回血，因此说明成功了。流汗是因为反反复复了好几次，让人紧张。",
+    ),
+    (
+        "无罪",
+        "\"她是自愿的！\"尸体无暴力痕迹，凶手被判无罪。\"我是无罪的！\"尸体有暴力痕迹，凶手也被判无罪。",
+        "第一幕：女儿为救他人（如器官移植）自愿牺牲，所以\"自愿\"且无暴力痕迹，他人无罪。第二幕：父亲无法接受女儿死亡真相，杀害了被判无罪的人，但法医发现此人所受暴力伤害与父亲行为不符（或父亲伪造证据），真相是女儿死于意外，父亲为报复误杀他人，故父亲也称自己\"无罪\"，但法律上仍有罪。",
+    ),
+)
+
+
+def _estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩等宽字符每个约 1 个 token，其余字符约 4 个 1 个 token"""
+    wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+class PromptTemplate:
+    """
+    一个动作的提示词模板，按变化频率从低到高分为三段：
+      system   固定的角色、规则和示例，所有调用共享同一前缀，便于服务端缓存
+      context  同一局游戏内不变的内容 (汤面、汤底)
+      query    每次调用都不同的内容 (玩家的问题、猜测等)，放在最后
+    context 和 query 用 str.format 填充；examples 为示例分组名，为 None 时不附加示例。
+    """
+
+    __slots__ = ("name", "system", "context", "query", "examples", "examples_header")
+
+    def __init__(
+        self, name: str, system: str, context: str = "", query: str = "",
+        examples: Optional[str] = None, examples_header: str = ""
+    ):
+        self.name = name
+        self.system = system.strip()
+        self.context = context
+        self.query = query
+        self.examples = examples
+        self.examples_header = examples_header
+
+    def compile_system(self, example_count: int) -> str:
+        """拼接固定前缀：规则 + 前 example_count 个示例"""
+        if self.examples is None or example_count <= 0:
+            return self.system
+        lines = [self.system, "", self.examples_header]
+        for i, (name, question, answer) in enumerate(FEW_SHOT_EXAMPLES[:example_count], 1):
+            lines.append(f"{i}.【{name}】\n汤面：{question}\n汤底：{answer}\n")
+        return "\n".join(lines).strip()
+
+
+_PUZZLE_SYSTEM = """
+你是一个专业的海龟汤故事生成器。请生成一个有趣的海龟汤题目，并同时给出它的答案。
+
+要求：
+1. 汤面必须是海龟汤风格的推理谜题，包含一个看似矛盾或奇怪的情境，简洁明了，结尾留有悬念。
+2. 汤底是完整的真相，能合理解释汤面中的所有矛盾。
+3. 题目应该是原创的，不要复制已有例子。
+4. 汤面和汤底都使用纯文本，不要包含HTML、Markdown或其他格式。
+"""
+
+PROMPT_TEMPLATES = (
+    PromptTemplate(
+        "出题", _PUZZLE_SYSTEM,
+        query=(
+            "请严格只输出一个JSON对象，不要包含任何解释或其他文字，格式如下：\n"
+            '{{"question": "汤面", "answer": "汤底"}}'
+        ),
+        examples="出题", examples_header="可以参考的海龟汤汤面and汤底（仅供了解风格，不要照搬或套用其中的情节）：",
+    ),
+    PromptTemplate(
+        "批量出题", _PUZZLE_SYSTEM, # 与单题共用固定前缀
+        query=(
+            "这次请一次生成 {count} 个互不相同的海龟汤题目。\n"
+            "请严格只输出一个JSON数组，不要包含任何解释或其他文字，格式如下：\n"
+            '[{{"question": "汤面1", "answer": "汤底1"}}, {{"question": "汤面2", "answer": "汤底2"}}]'
+        ),
+        examples="出题", examples_header="可以参考的海龟汤汤面and汤底（仅供了解风格，不要照搬或套用其中的情节）：",
+    ),
+    PromptTemplate(
+        "修复", """
+下面这段文字本应是一个JSON对象，格式为 {"question": "汤面", "answer": "汤底"}，但它无法被解析。
+请把它修正为合法的JSON对象，保持内容不变，只输出JSON，不要包含任何解释或其他文字。
+""",
+        query="原始输出：\n{bad_output}",
+    ),
+    PromptTemplate(
+        "汤面", """
+你是一个专业的海龟汤故事生成器。请生成一个有趣的海龟汤题目。
+
+要求：
+1. 题目必须是海龟汤风格的推理谜题，包含一个看似矛盾或奇怪的情境。
+2. 题目应该简洁明了，容易理解。
+3. 题目结尾应该留有悬念，让人好奇真相。
+4. 生成的题目应该是原创的，不要复制已有例子。
+5. 请以纯文本形式返回，不要包含任何HTML、Markdown或其他格式。
+6. 不要包含任何解释、分析或答案。
+""",
+        query="请生成一个海龟汤题目。",
+        examples="汤面", examples_header="可以参考的海龟汤汤面and汤底（仅供了解风格，不要照搬或套用其中的情节，严格按照输出格式，仅输出汤面）：",
+    ),
+    PromptTemplate(
+        "汤底", """
+你是一个专业的海龟汤故事专家。请为用户给出的海龟汤题目生成一个合理的答案。
+请仅给出答案，不要包含任何解释或额外文字。
+""",
+        query="题目: {question}",
+        examples="汤底", examples_header="可以参考的海龟汤汤面and汤底（仅供了解风格，不要照搬或套用其中的情节，严格按照输出格式，仅输出汤底）：",
+    ),
+    PromptTemplate(
+        "问题", """
+你是一个海龟汤游戏专家。请判断用户提出的问题是否符合当前海龟汤的汤底（真相）。
+
+请仅回答以下四个词之一：
+- 是
+- 不是
+- 无关
+- 是也不是
+
+不要添加任何解释或额外文字。
+""",
+        context="当前海龟汤题目: {question}\n当前海龟汤答案: {answer}\n",
+        query="用户问题: {user_question}",
+    ),
+    PromptTemplate(
+        "批量问题", """
+你是一个海龟汤游戏专家。请逐一判断用户提出的每个问题是否符合当前海龟汤的汤底（真相）。
+
+每个问题只能回答以下四个词之一：是、不是、无关、是也不是。
+请按问题编号逐行输出，每行格式为“编号. 判断”，例如：
+1. 是
+2. 无关
+
+不要添加任何解释或额外文字。
+""",
+        context="当前海龟汤题目: {question}\n当前海龟汤答案: {answer}\n",
+        query="用户问题列表:\n{numbered_questions}",
+    ),
+    PromptTemplate(
+        "猜谜", """
+你是一个海龟汤游戏专家。请判断用户提出的答案是否是当前海龟汤的正确汤底（真相）。
+
+请仅回答以下三个词之一：
+- 是
+- 不是
+- 无关
+
+不要添加任何解释或额外文字。
+""",
+        context="当前海龟汤题目: {question}\n当前海龟汤答案: {answer}\n",
+        query="用户猜测的答案: {guess}",
+    ),
+    PromptTemplate(
+        "提示", """
+你是一个海龟汤游戏专家。请为用户给出的海龟汤提供一个温和的提示，帮助玩家推理。
+请给出一个不直接透露答案的提示，用简短的句子。不要包含任何解释或答案。
+""",
+        context="海龟汤题目: {question}\n海龟汤答案: {answer}",
+    ),
+    PromptTemplate(
+        "整理线索", """
+你是一个海龟汤游戏专家。请为用户给出的海龟汤整理出关键线索。
+请列出关键线索，用简洁的要点形式呈现。不要包含答案。
+""",
+        context="海龟汤题目: {question}\n海龟汤答案: {answer}",
+    ),
+    PromptTemplate(
+        "线索更新", """
+你是一个海龟汤游戏专家。下面给出海龟汤的汤面、当前的线索整理，以及玩家之后新提出的问题和判断结果。
+请把新问答中确认或排除的信息合并进线索整理，输出更新后的完整线索整理。
+用简洁的要点形式呈现，删去已被排除的猜想，不要包含答案。
+""",
+        context="海龟汤题目: {question}\n",
+        query="当前线索整理:\n{summary}\n\n新的问答:\n{entries}",
+    ),
+    PromptTemplate(
+        "标注", """
+你是一个海龟汤游戏专家。请为用户给出的海龟汤一次性准备游戏辅助资料。
+
+要求：
+1. hints 是三个提示，从温和到强烈依次递进：第一个只点出思考方向，第三个接近真相但不直接说出答案。每个提示用简短的句子。
+2. clues 是关键线索整理，用简洁的要点形式呈现，不要包含答案。
+3. keywords 是汤底中 3 到 8 个最关键的词语。
+4. faq 是玩家最可能提出的 10 个是非问题及其判断，verdict 只能是：是、不是、无关、是也不是。
+5. 请严格只输出一个JSON对象，不要包含任何解释或其他文字，格式如下：
+{"hints": ["提示1", "提示2", "提示3"], "clues": "线索整理", "keywords": ["关键词"], "faq": [{"question": "问题", "verdict": "是"}]}
+""",
+        context="海龟汤题目: {question}\n海龟汤答案: {answer}",
+    ),
+    PromptTemplate(
+        "提示包", """
+你是一个海龟汤游戏专家。请为用户给出的海龟汤一次性准备三个分级提示和一份线索整理。
+
+要求：
+1. hints 是三个提示，从温和到强烈依次递进：第一个只点出思考方向，第三个接近真相但不直接说出答案。每个提示用简短的句子。
+2. clues 是关键线索整理，用简洁的要点形式呈现，不要包含答案。
+3. 请严格只输出一个JSON对象，不要包含任何解释或其他文字，格式如下：
+{"hints": ["提示1", "提示2", "提示3"], "clues": "线索整理"}
+""",
+        context="海龟汤题目: {question}\n海龟汤答案: {answer}",
+    ),
+)
+
+
+class PromptRegistry:
+    """
+    插件加载时把所有模板编译一次：固定前缀 (含按配置截取的示例) 预先拼好并估算 token 数，
+    渲染时只填充 context 和 query。渲染结果为 OpenAI messages 列表，固定前缀作为 system 消息放在最前面。
+    每次渲染的估算 token 数计入运行指标，按模板汇总后可在 /hgt 统计 中查看。
+    """
+
+    def __init__(self, few_shot: Optional[Dict[str, int]] = None):
+        self.few_shot = dict(DEFAULT_FEW_SHOT)
+        for group, count in (few_shot or {}).items():
+            try:
+                self.few_shot[str(group)] = max(0, min(int(count), len(FEW_SHOT_EXAMPLES)))
+            except (TypeError, ValueError):
+                print(f"[Prompt Registry] 忽略无效的示例数量配置: {group}={count!r}")
+        self._compiled: Dict[str, Tuple[PromptTemplate, str, int]] = {} # {模板名: (模板, 固定前缀, 前缀token估算)}
+        for template in PROMPT_TEMPLATES:
+            system = template.compile_system(self.few_shot.get(template.examples, 0))
+            self._compiled[template.name] = (template, system, _estimate_tokens(system))
+
+    def render(self, name: str, **values) -> List[Dict[str, str]]:
+        """渲染模板为 messages 列表，并记录估算的输入 token 数"""
+        template, system, system_tokens = self._compiled[name]
+        user = (template.context + template.query).format(**values).strip()
+        metrics.inc("prompt_renders_total", template=name)
+        metrics.inc("prompt_tokens_estimated_total", system_tokens + _estimate_tokens(user), template=name)
+        return [{"role": "system", "content": system}, {"role": "user", "content": user}]
+
+    def prefix_tokens(self) -> Dict[str, int]:
+        """各模板固定前缀的估算 token 数"""
+        return {name: tokens for name, (_, _, tokens) in self._compiled.items()}
+
+
+def _get_prompt_registry() -> "PromptRegistry":
+    """获取全局提示词模板库，插件实例尚未创建时按默认配置懒加载"""
+    global prompt_registry
+    if prompt_registry is None:
+        prompt_registry = PromptRegistry()
+    return prompt_registry
+
+
+def _parse_puzzle_json(text: str) -> Optional[Tuple[str, str]]:
+    """
+    严格解析结构化生成的题目。
+    允许外层包裹 ```json 代码块或少量前后缀文字，但对象必须包含非空字符串字段
+    question/answer (或 汤面/汤底)，否则返回 None。
+    """
+    if not text:
+        return None
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    question = data.get("question", data.get("汤面"))
+    answer = data.get("answer", data.get("汤底"))
+    if not (isinstance(question, str) and question.strip() and isinstance(answer, str) and answer.strip()):
+        return None
+    return question.strip(), answer.strip()
+
+
+def _parse_puzzle_json_list(text: str) -> List[Tuple[str, str]]:
+    """解析批量生成的题目数组，跳过不合法的元素；整体无法解析时返回空列表"""
+    if not text:
+        return []
+    start = text.find("[")
+    end = text.rfind("]")
+    if start == -1 or end <= start:
+        single = _parse_puzzle_json(text)
+        return [single] if single else []
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return []
+    if not isinstance(data, list):
+        return []
+    puzzles = []
+    for item in data:
+        if isinstance(item, dict):
+            parsed = _parse_puzzle_json(json.dumps(item, ensure_ascii=False))
+            if parsed:
+                puzzles.append(parsed)
+    return puzzles
+
+
+async def _generate_puzzle_batch(
+    count: int, api_url: str, api_key: str, model: str, temperature: float
+) -> List[Tuple[str, str]]:
+    """一次LLM调用生成 count 个题目 (count 为 1 时使用单题结构化提示词)"""
+    prompts = _get_prompt_registry()
+    if count <= 1:
+        response = await _request_llm(prompts.render("出题"), api_url, api_key, model, temperature, 1000)
+        parsed = _parse_puzzle_json(response)
+        return [parsed] if parsed else []
+    # 与单题共用固定前缀，只有末尾的格式要求换成数组格式
+    prompt = prompts.render("批量出题", count=count)
+    response = await _request_llm(prompt, api_url, api_key, model, temperature, 800 * count)
+    return _parse_puzzle_json_list(response)
+
+
+# --- 预生成题目池 ---
+class PuzzlePool:
+    """
+    按模型维护预生成的 (汤面, 汤底) 题目池。
+    低于 low_watermark 时启动后台任务补充到 high_watermark，开局时直接从池中取题。
+    池内容保存到插件目录下的 spill 文件，重启后恢复：取题和补充后延迟 SAVE_DELAY 秒在后台线程中写入，
+    期间的多次变化只写一次，关闭时再同步写入一次。
+    """
+
+    SPILL_FILE = "puzzle_pool.json"
+    SAVE_DELAY = 2.0 # 题目池变化后延迟写入 spill 文件的秒数
+
+    def __init__(
+        self, enabled: bool = True, size: int = 10, low_watermark: int = 2,
+        high_watermark: int = 5, batch_size: int = 3
+    ):
+        self.enabled = enabled
+        self.size = max(1, size)
+        self.high_watermark = max(1, min(high_watermark, self.size))
+        self.low_watermark = max(0, min(low_watermark, self.high_watermark - 1))
+        self.batch_size = max(1, batch_size)
+        self._pools: Dict[str, List[Tuple[str, str]]] = {} # {model: [(汤面, 汤底), ...]}
+        self._refill_tasks: Dict[str, asyncio.Task] = {} # {model: task}
+        self._dirty = False # 有尚未写入 spill 文件的变化
+        self._save_task: Optional[asyncio.Task] = None
+        self._writing: Optional[asyncio.Future] = None # 后台线程中进行中的写入
+
+    def load(self):
+        """从 spill 文件恢复题目池"""
+        data = _load_json_data(self.SPILL_FILE)
+        for model, items in data.items():
+            puzzles = [
+                (item[0], item[1]) for item in items
+                if isinstance(item, list) and len(item) == 2 and all(isinstance(x, str) and x for x in item)
+            ]
+            if puzzles:
+                self._pools[model] = puzzles[:self.size]
+
+    def _snapshot(self) -> dict:
+        return {model: [list(p) for p in pool] for model, pool in self._pools.items()}
+
+    def save(self, data: Optional[dict] = None):
+        """把题目池 (或已取好的快照) 写入 spill 文件"""
+        try:
+            _save_json_data(self.SPILL_FILE, self._snapshot() if data is None else data)
+        except Exception:
+            pass # _save_json_data 已打印错误，题目池丢失不影响游戏
+
+    def _schedule_save(self):
+        """标记题目池已变化，需要时启动延迟写入任务 (不在事件循环中做文件读写和 JSON 编码)"""
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.ensure_future(self._save_later())
+
+    async def _save_later(self):
+        while self._dirty:
+            await asyncio.sleep(self.SAVE_DELAY)
+            self._dirty = False
+            # 快照在事件循环中取，写入在线程中进行；写入期间又有变化时再写一次
+            self._writing = asyncio.ensure_future(asyncio.to_thread(self.save, self._snapshot()))
+            await asyncio.shield(self._writing)
+
+    def models(self) -> List[str]:
+        """有过预生成题目的模型列表 (用于监控)"""
+        return list(self._pools)
+
+    def available(self, model: str) -> int:
+        return len(self._pools.get(model, []))
+
+    def pop(self, model: str) -> Optional[Tuple[str, str]]:
+        """取出一个预生成题目，池为空时返回 None"""
+        pool = self._pools.get(model)
+        if not self.enabled or not pool:
+            return None
+        puzzle = pool.pop(0)
+        self._schedule_save()
+        return puzzle
+
+    def maybe_refill(self, models: List[str], api_url: str, api_key: str, temperature: float):
+        """对低于低水位的模型启动后台补充任务 (同一模型同时只有一个补充任务)"""
+        if not self.enabled or not api_url or not api_key:
+            return
+        for model in models:
+            if self.available(model) > self.low_watermark:
+                continue
+            task = self._refill_tasks.get(model)
+            if task is not None and not task.done():
+                continue
+            self._refill_tasks[model] = asyncio.create_task(
+                self._refill(model, api_url, api_key, temperature)
+            )
+
+    async def _refill(self, model: str, api_url: str, api_key: str, temperature: float):
+        """补充题目直到达到高水位；某一轮没有生成出题目时停止，等待下次触发"""
+        _metric_action.set("题目池") # 在独立任务中运行，不影响创建它的命令
+        try:
+            while self.available(model) < self.high_watermark:
+                count = min(self.batch_size, self.high_watermark - self.available(model))
+                puzzles = await _generate_puzzle_batch(count, api_url, api_key, model, temperature)
+                if not puzzles:
+                    print(f"[Puzzle Pool] 模型 {model} 补充题目失败，稍后重试。")
+                    break
+                # 与已有题目近似重复的题目不进入题目池
+                puzzles = [puzzle for puzzle in puzzles if _get_dedup_index().admit(*puzzle, source="题目池")]
+                if not puzzles:
+                    print(f"[Puzzle Pool] 模型 {model} 本轮生成的题目都与已有题目重复，稍后重试。")
+                    break
+                pool = self._pools.setdefault(model, [])
+                pool.extend(puzzles[:self.size - len(pool)])
+                print(f"[Puzzle Pool] 模型 {model} 题目池: {len(pool)}/{self.high_watermark}")
+                self._schedule_save()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[Puzzle Pool] 模型 {model} 补充题目时发生异常: {e}")
+
+    async def aclose(self):
+        """取消进行中的补充任务和延迟写入，等待线程中的写入完成后同步保存题目池"""
+        tasks = [t for t in self._refill_tasks.values() if not t.done()]
+        if self._save_task is not None and not self._save_task.done():
+            tasks.append(self._save_task)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._refill_tasks.clear()
+        if self._writing is not None:
+            await asyncio.gather(self._writing, return_exceptions=True)
+        self.save()
+
+
+def _get_puzzle_pool() -> "PuzzlePool":
+    """获取全局题目池，插件实例尚未创建时按默认配置懒加载"""
+    global puzzle_pool
+    if puzzle_pool is None:
+        puzzle_pool = PuzzlePool()
+        puzzle_pool.load()
+    return puzzle_pool
+
+
+# --- 近似重复题目检测：MinHash + LSH ---
+class PuzzleDedupIndex:
+    """
+    AI 生成题目、示例题目和本地题目的近似重复检测索引。
+    把归一化后的汤面+汤底切成字符三元组，用 PERMUTATIONS 个 32 位 MinHash 值作为签名，
+    签名分为 BANDS 段做 LSH 分桶：只与至少一段完全相同的题目比较签名，查询耗时与索引大小基本无关。
+    签名中相同位置取值相等的比例即 Jaccard 相似度的估计，不低于 threshold 视为重复。
+    超过 max_entries 时淘汰最早加入的题目 (示例题目常驻)，签名按题目id保存到插件目录下的二进制文件：
+    新题目只追加记录，文件中的记录数超过 max_entries 两倍或关闭插件时才整体重写。
+    """
+
+    INDEX_FILE = "dedup_index.bin"
+    MAGIC = b"HGTDUP01"
+    HEADER = struct.Struct("<8sI") # magic, 签名长度；之后是定长记录 (20 字节题目id摘要 + 签名)
+    PERMUTATIONS = 64
+    BANDS = 16
+    ROWS = PERMUTATIONS // BANDS
+    SHINGLE = 3
+    SAVE_EVERY = 20 # 新增多少个题目后追加写一次文件
+    # 每个“排列”用一个随机掩码与三元组哈希异或后取最小值，map 在 C 层循环；百余字的题目单个签名约 1.5ms
+    _MASKS = tuple(
+        int.from_bytes(hashlib.blake2b(f"hgt-minhash-{i}".encode(), digest_size=4).digest(), "little")
+        for i in range(PERMUTATIONS)
+    )
+
+    def __init__(self, enabled: bool = True, threshold: float = 0.5, max_entries: int = 50000):
+        self.enabled = enabled
+        self.threshold = min(max(threshold, 0.0), 1.0)
+        self.max_entries = max(1, max_entries)
+        self._signatures: "OrderedDict[bytes, array]" = OrderedDict() # {题目id摘要: 签名}，按加入顺序
+        self._pinned: Dict[bytes, array] = {} # 示例题目，不淘汰也不保存
+        # {段值: 题目id摘要}，同一段值有多个题目时才用列表 (绝大多数桶只有一个题目，减少对象数和GC开销)
+        self._buckets: List[Dict[bytes, Union[bytes, List[bytes]]]] = [{} for _ in range(self.BANDS)]
+        self._pending: List[bytes] = [] # 尚未追加到文件的记录
+        self._file_records = 0 # 文件中的记录数 (含已淘汰和重复的记录)
+        self._dirty = False # 内存与文件内容不一致 (有未写入的记录或淘汰)
+        self.rejections = 0
+        for name, question, answer in FEW_SHOT_EXAMPLES:
+            self._add(bytes.fromhex(_puzzle_hash(question, answer)), self.signature(question, answer), pinned=True)
+
+    @classmethod
+    def signature(cls, question: str, answer: str) -> array:
+        """计算题目的 MinHash 签名"""
+        text = _normalize_search_text(question + answer)
+        grams = {text[i:i + cls.SHINGLE] for i in range(max(1, len(text) - cls.SHINGLE + 1))}
+        hashes = [
+            int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=4).digest(), "little")
+            for gram in grams
+        ]
+        return array("I", [min(map(mask.__xor__, hashes)) for mask in cls._MASKS])
+
+    def _bands(self, signature: array) -> List[bytes]:
+        raw = signature.tobytes()
+        width = self.ROWS * signature.itemsize
+        return [raw[i:i + width] for i in range(0, len(raw), width)]
+
+    def __contains__(self, digest: bytes) -> bool:
+        return digest in self._signatures or digest in self._pinned
+
+    def __len__(self) -> int:
+        return len(self._signatures) + len(self._pinned)
+
+    def find_similar(self, signature: array) -> Optional[Tuple[bytes, float]]:
+        """返回最相似且不低于阈值的 (题目id摘要, 相似度)，没有时返回 None"""
+        best = None
+        checked = set()
+        for bucket, key in zip(self._buckets, self._bands(signature)):
+            members = bucket.get(key, ())
+            for digest in (members,) if isinstance(members, bytes) else members:
+                if digest in checked:
+                    continue
+                checked.add(digest)
+                other = self._signatures.get(digest) or self._pinned[digest]
+                similarity = sum(map(int.__eq__, signature, other)) / self.PERMUTATIONS
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (digest, similarity)
+        return best
+
+    def _add(self, digest: bytes, signature: array, pinned: bool = False):
+        if digest in self:
+            return
+        (self._pinned if pinned else self._signatures)[digest] = signature
+        for bucket, key in zip(self._buckets, self._bands(signature)):
+            members = bucket.get(key)
+            if members is None:
+                bucket[key] = digest
+            elif isinstance(members, bytes):
+                bucket[key] = [members, digest]
+            else:
+                members.append(digest)
+        while len(self._signatures) > self.max_entries:
+            old_digest, old_signature = self._signatures.popitem(last=False)
+            for bucket, key in zip(self._buckets, self._bands(old_signature)):
+                members = bucket[key]
+                if isinstance(members, bytes):
+                    del bucket[key]
+                    continue
+                members.remove(old_digest)
+                if len(members) == 1:
+                    bucket[key] = members[0]
+
+    def add(self, digest: bytes, signature: array):
+        """加入一个已计算签名的题目 (如本地题目)"""
+        if digest in self:
+            return
+        self._add(digest, signature)
+        self._pending.append(digest + signature.tobytes())
+        self._dirty = True
+
+    def admit(self, question: str, answer: str, source: str = "") -> bool:
+        """
+        检查生成的题目：与已有题目近似重复时返回 False；否则加入索引并返回 True，
+        之后生成的相似题目也会被拒绝。未启用时总是返回 True。
+        """
+        if not self.enabled:
+            return True
+        digest = bytes.fromhex(_puzzle_hash(question, answer))
+        signature = self.signature(question, answer)
+        match = (digest, 1.0) if digest in self else self.find_similar(signature)
+        if match is not None:
+            self.rejections += 1
+            metrics.inc("dedup_rejections_total", source=source or "其他")
+            print(f"[Puzzle Dedup] 拒绝与 {match[0].hex()[:12]} 相似度 {match[1]:.2f} 的题目: {question[:30]}")
+            return False
+        self.add(digest, signature)
+        if len(self._pending) >= self.SAVE_EVERY:
+            self.flush()
+        return True
+
+    @property
+    def path(self) -> str:
+        return os.path.join(PLUGIN_DIR, self.INDEX_FILE)
+
+    @property
+    def _record_size(self) -> int:
+        return 20 + self.PERMUTATIONS * 4
+
+    def load(self):
+        """从索引文件恢复签名，文件不存在、格式不符或签名长度不同时忽略；重复和已淘汰的记录按顺序重放后自然去掉"""
+        if not self.enabled:
+            return
+        path = self.path
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            magic, permutations = self.HEADER.unpack_from(data, 0)
+            if magic != self.MAGIC or permutations != self.PERMUTATIONS:
+                print(f"[Puzzle Dedup] 索引文件 {path} 格式不符，忽略。")
+                return
+            record = self._record_size
+            offset = self.HEADER.size
+            count = (len(data) - offset) // record
+            for _ in range(count):
+                signature = array("I")
+                signature.frombytes(data[offset + 20:offset + record])
+                self._add(data[offset:offset + 20], signature)
+                offset += record
+        except Exception as e:
+            print(f"加载 {path} 失败: {e}")
+            return
+        self._file_records = count
+        self._dirty = count != len(self._signatures)
+        print(f"[Puzzle Dedup] 已加载 {len(self._signatures)} 个题目签名。")
+
+    def flush(self):
+        """把新加入的题目追加到索引文件，文件中的记录过多时改为整体重写"""
+        if not self.enabled or not self._pending:
+            return
+        if not os.path.exists(self.path) or self._file_records + len(self._pending) > 2 * self.max_entries:
+            self.save()
+            return
+        pending, self._pending = self._pending, []
+        try:
+            with open(self.path, "ab") as f:
+                f.write(b"".join(pending))
+            self._file_records += len(pending)
+        except Exception as e:
+            print(f"保存 {self.path} 失败: {e}")
+
+    def save(self):
+        """把全部签名重写到索引文件 (先写临时文件再替换)"""
+        if not self.enabled or not self._dirty:
+            return
+        path = self.path
+        try:
+            with open(path + ".tmp", "wb") as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.PERMUTATIONS))
+                f.write(b"".join(digest + signature.tobytes() for digest, signature in self._signatures.items()))
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            print(f"保存 {path} 失败: {e}")
+            return
+        self._pending.clear()
+        self._file_records = len(self._signatures)
+        self._dirty = False
+
+
+def _get_dedup_index() -> "PuzzleDedupIndex":
+    """获取全局近似重复索引，插件实例尚未创建时按默认配置懒加载"""
+    global dedup_index
+    if dedup_index is None:
+        dedup_index = PuzzleDedupIndex()
+        dedup_index.load()
+    return dedup_index
+
+
+async def _index_library_for_dedup(library: "SoupLibrary"):
+    """在后台线程中为尚未收录的本地题目计算签名，再在事件循环中加入近似重复索引"""
+    index = _get_dedup_index()
+    if not index.enabled:
+        return
+
+    def compute() -> List[Tuple[bytes, array]]:
+        signatures = []
+        for i in range(len(library)):
+            digest = library.digest(i)
+            if digest not in index:
+                soup = library[i]
+                signatures.append((digest, PuzzleDedupIndex.signature(soup["question"], soup["answer"])))
+        return signatures
+
+    try:
+        signatures = await asyncio.to_thread(compute)
+    except Exception as e:
+        print(f"[Puzzle Dedup] 收录本地题目失败: {e}")
+        return
+    for digest, signature in signatures:
+        index.add(digest, signature)
+    index.flush()
+    if signatures:
+        print(f"[Puzzle Dedup] 新收录 {len(signatures)} 个本地题目，索引共 {len(index)} 个题目。")
+
+
+# --- 跨群问题判断缓存 ---
+QUESTION_VERDICTS = ("是", "不是", "无关", "是也不是")
+
+# 句末语气词，归一化时去掉 (如 "他死了吗" 与 "他死了" 视为同一问题)
+_TRAILING_PARTICLES = "吗嘛么呢吧啊呀哇哦噢呐啦"
+_NON_WORD_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def _puzzle_hash(question: str, answer: str) -> str:
+    """题目内容哈希，相同汤面和汤底的题目在不同群之间共享缓存"""
+    return hashlib.sha1(f"{question}\n{answer}".encode("utf-8")).hexdigest()
+
+
+def _normalize_question(text: str) -> str:
+    """归一化问题：全角转半角 (NFKC)、小写、去掉标点和空白、去掉句末语气词"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _NON_WORD_RE.sub("", text)
+    return text.rstrip(_TRAILING_PARTICLES) or text
+
+
+class VerdictCache:
+    """
+    问题判断结果缓存，键为 (题目哈希, 模型, 归一化问题)。
+    LRU + TTL 淘汰，记录命中/未命中次数，可选持久化到插件目录。
+    """
+
+    PERSIST_FILE = "verdict_cache.json"
+
+    def __init__(
+        self, enabled: bool = True, max_entries: int = 5000,
+        ttl_seconds: float = 604800, persist: bool = True, save_every: int = 100
+    ):
+        self.enabled = enabled
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.persist = persist
+        self.save_every = max(1, save_every)
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict() # {key: (判断结果, 写入时间)}
+        self._unsaved = 0
+        self._dirty = False # 写入进行中时又攒够了 save_every 条，需要再写一次
+        self._save_task: Optional[asyncio.Task] = None
+        self._writing: Optional[asyncio.Future] = None # 后台线程中进行中的写入
+
+    @staticmethod
+    def make_key(puzzle_hash: str, model: str, question: str) -> str:
+        return f"{puzzle_hash}|{model}|{_normalize_question(question)}"
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        verdict, stored_at = entry
+        if time.time() - stored_at > self.ttl_seconds:
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return verdict
+
+    def put(self, key: str, verdict: str):
+        if not self.enabled or verdict not in QUESTION_VERDICTS:
+            return
+        self._entries[key] = (verdict, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self._schedule_save()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def load(self):
+        """从持久化文件恢复缓存，跳过已过期的条目"""
+        if not self.persist:
+            return
+        data = _load_json_data(self.PERSIST_FILE)
+        now = time.time()
+        # 跳过手工编辑或损坏的条目 (写入时间不是数字时无法排序)
+        entries = sorted(
+            (
+                (k, v) for k, v in data.items()
+                if isinstance(v, list) and len(v) == 2
+                and isinstance(v[1], (int, float)) and not isinstance(v[1], bool)
+            ),
+            key=lambda kv: kv[1][1]
+        )
+        for key, (verdict, stored_at) in entries[-self.max_entries:]:
+            if verdict in QUESTION_VERDICTS and now - stored_at <= self.ttl_seconds:
+                self._entries[key] = (verdict, stored_at)
+
+    def _snapshot(self) -> dict:
+        return {k: list(v) for k, v in self._entries.items()}
+
+    def save(self, data: Optional[dict] = None):
+        """把缓存 (或已取好的快照) 写入持久化文件"""
+        if not self.persist:
+            return
+        try:
+            _save_json_data(self.PERSIST_FILE, self._snapshot() if data is None else data)
+        except Exception:
+            pass # _save_json_data 已打印错误，缓存丢失只会导致重新调用LLM
+
+    def _schedule_save(self):
+        """在事件循环中取快照、在线程中写入 (不在判断问题的路径上做 JSON 编码和文件写入)"""
+        self._unsaved = 0
+        if not self.persist:
+            return
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.ensure_future(self._save_in_thread())
+
+    async def _save_in_thread(self):
+        # 写入期间又攒够了 save_every 条时再写一次
+        while self._dirty:
+            self._dirty = False
+            self._writing = asyncio.ensure_future(asyncio.to_thread(self.save, self._snapshot()))
+            await asyncio.shield(self._writing)
+
+    async def aclose(self):
+        """取消待写入任务，等待线程中的写入完成后同步保存缓存"""
+        if self._save_task is not None and not self._save_task.done():
+            self._save_task.cancel()
+            await asyncio.gather(self._save_task, return_exceptions=True)
+        if self._writing is not None:
+            await asyncio.gather(self._writing, return_exceptions=True)
+        self._unsaved = 0
+        self.save()
+
+
+def _get_verdict_cache() -> "VerdictCache":
+    """获取全局判断缓存，插件实例尚未创建时按默认配置懒加载"""
+    global verdict_cache
+    if verdict_cache is None:
+        verdict_cache = VerdictCache()
+        verdict_cache.load()
+    return verdict_cache
+
+
+# --- 问题判断合批：同一局短时间内的多个问题合并为一次LLM调用 ---
+_NUMBERED_LINE_RE = re.compile(r"^\s*[(（\[【]?\s*(\d{1,3})\s*[)）\]】.．、:：]\s*(.*)$")
+_VERDICT_SEPARATOR_RE = re.compile(r"[:：\-—→=]+")
+
+
+def _parse_verdict_text(text: str) -> Optional[str]:
+    """从一行回复中识别判断结果；模型复述了问题时 (如 "他死了吗：是") 取最后一个分隔符之后的部分"""
+    for part in (text, _VERDICT_SEPARATOR_RE.split(text)[-1]):
+        part = part.strip().strip("*`\"'“”「」。.!！ ").lower()
+        for verdict in ("是也不是", "不是", "无关", "是"):
+            if part.startswith(verdict):
+                return verdict
+    return None
+
+
+def _parse_numbered_verdicts(text: str, count: int) -> List[Optional[str]]:
+    """
+    解析 "编号. 判断" 格式的批量判断结果，返回与问题一一对应的列表，无法识别的位置为 None。
+    没有任何编号但恰好有 count 行时按行序对应。
+    """
+    verdicts: List[Optional[str]] = [None] * count
+    lines = [line for line in (text or "").splitlines() if line.strip()]
+    numbered = False
+    for line in lines:
+        match = _NUMBERED_LINE_RE.match(line)
+        if match is None:
+            continue
+        numbered = True
+        index = int(match.group(1)) - 1
+        if 0 <= index < count and verdicts[index] is None:
+            verdicts[index] = _parse_verdict_text(match.group(2))
+    if not numbered and len(lines) == count:
+        verdicts = [_parse_verdict_text(line) for line in lines]
+    return verdicts
+
+
+class _PendingBatch:
+    __slots__ = ("question", "answer", "api_url", "api_key", "model", "temperature", "group_id", "stream", "items", "timer")
+
+    def __init__(
+        self, question: str, answer: str, api_url: str, api_key: str, model: str,
+        temperature: float, group_id: str, stream: bool
+    ):
+        self.question = question
+        self.answer = answer
+        self.api_url = api_url
+        self.api_key = api_key
+        self.model = model
+        self.temperature = temperature
+        self.group_id = group_id
+        self.stream = stream
+        self.items: List[Tuple[str, asyncio.Future]] = [] # [(玩家问题, 等待结果的 future)]
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class QuestionBatcher:
+    """
+    按 (群, 题目, 模型) 收集问题：第一个问题到达后等待 window 秒，或凑满 max_questions 个时，
+    把这些问题编号后放进一次LLM调用，要求逐行返回判断结果。
+    批量回复中无法识别的问题单独再判断一次；只有一个问题时直接使用单题提示词。
+    """
+
+    def __init__(self, enabled: bool = False, window: float = 0.3, max_questions: int = 5):
+        self.enabled = enabled
+        self.window = max(0.0, window)
+        self.max_questions = max(1, max_questions)
+        self._pending: Dict[tuple, _PendingBatch] = {}
+        self._tasks: set = set()
+        # 监控数据
+        self.batches = 0
+        self.batched_questions = 0
+        self.fallbacks = 0
+
+    async def judge(
+        self, puzzle_id: str, question: str, answer: str, user_question: str,
+        api_url: str, api_key: str, model: str, temperature: float, group_id: str, stream: bool = False
+    ) -> str:
+        """加入当前批次并等待判断结果，失败时返回空字符串"""
+        loop = asyncio.get_running_loop()
+        key = (group_id, puzzle_id, model)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = _PendingBatch(question, answer, api_url, api_key, model, temperature, group_id, stream)
+            batch.timer = loop.call_later(self.window, self._flush, key)
+            self._pending[key] = batch
+        future = loop.create_future()
+        batch.items.append((user_question, future))
+        if len(batch.items) >= self.max_questions:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key: tuple):
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        task = asyncio.ensure_future(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: "_PendingBatch"):
+        questions = [question for question, _ in batch.items]
+        verdicts = [""] * len(questions)
+        try:
+            if len(questions) == 1:
+                verdicts = [await self._judge_one(batch, questions[0], batch.stream)]
+            else:
+                verdicts = await self._judge_many(batch, questions)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[Question Batch] 群 {batch.group_id} 批量判断时发生异常: {e}")
+        finally:
+            for (_, future), verdict in zip(batch.items, verdicts):
+                if not future.done():
+                    future.set_result(verdict)
+
+    async def _judge_one(self, batch: "_PendingBatch", user_question: str, stream: bool) -> str:
+        prompt = _get_prompt_registry().render(
+            "问题", question=batch.question, answer=batch.answer, user_question=user_question
+        )
+        return await _request_llm(
+            prompt, batch.api_url, batch.api_key, batch.model, batch.temperature,
+            stream=stream, stop_when=_settled_verdict, priority=PRIORITY_JUDGE, group_id=batch.group_id
+        )
+
+    async def _judge_many(self, batch: "_PendingBatch", questions: List[str]) -> List[str]:
+        self.batches += 1
+        self.batched_questions += len(questions)
+        numbered = "\n".join(f"{i}. {q.replace(chr(10), ' ').strip()}" for i, q in enumerate(questions, 1))
+        prompt = _get_prompt_registry().render(
+            "批量问题", question=batch.question, answer=batch.answer, numbered_questions=numbered
+        )
+        response = await _request_llm(
+            prompt, batch.api_url, batch.api_key, batch.model, batch.temperature,
+            max_tokens=16 * len(questions) + 32, priority=PRIORITY_JUDGE, group_id=batch.group_id
+        )
+        if not response:
+            return [""] * len(questions)
+        verdicts = _parse_numbered_verdicts(response, len(questions))
+        missing = [i for i, verdict in enumerate(verdicts) if verdict is None]
+        print(f"[Question Batch] 群 {batch.group_id} 合并判断 {len(questions)} 个问题，{len(missing)} 个无法解析")
+        if missing:
+            # 只为无法解析的问题单独调用，已识别的结果直接使用
+            self.fallbacks += len(missing)
+            retried = await asyncio.gather(*(self._judge_one(batch, questions[i], False) for i in missing))
+            for i, verdict in zip(missing, retried):
+                verdicts[i] = verdict
+        return verdicts
+
+    async def aclose(self):
+        """立即发出所有未到时间的批次，并等待进行中的批量判断完成"""
+        for key in list(self._pending):
+            self._flush(key)
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+def _get_question_batcher() -> "QuestionBatcher":
+    """获取全局问题合批器，插件实例尚未创建时返回未启用的默认实例"""
+    global question_batcher
+    if question_batcher is None:
+        question_batcher = QuestionBatcher()
+    return question_batcher
+
+
+# --- 开局预取的分级提示包和线索整理 ---
+def _extract_json_object(text: str) -> Optional[Dict[str, Any]]:
+    """取出回复中第一个 '{' 到最后一个 '}' 之间的 JSON 对象，无法解析时返回 None"""
+    if not text:
+        return None
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _parse_hint_bundle_json(text: str) -> Optional[Dict[str, Any]]:
+    """解析提示包，要求恰好三个非空提示和非空线索整理，否则返回 None"""
+    data = _extract_json_object(text)
+    return _hint_bundle_from_dict(data) if data is not None else None
+
+
+def _hint_bundle_from_dict(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    hints = data.get("hints")
+    clues = data.get("clues")
+    if isinstance(clues, list):
+        clues = "\n".join(str(c) for c in clues)
+    if not (isinstance(hints, list) and len(hints) >= 3 and all(isinstance(h, str) and h.strip() for h in hints[:3])):
+        return None
+    if not (isinstance(clues, str) and clues.strip()):
+        return None
+    return {"hints": [h.strip() for h in hints[:3]], "clues": clues.strip()}
+
+
+async def _prefetch_hint_bundle(
+    question: str, answer: str, api_url: str, api_key: str, model: str, temperature: float,
+    group_id: str = ""
+) -> Optional[Dict[str, Any]]:
+    """后台生成提示包，失败时返回 None (调用方回退到实时生成)"""
+    _metric_action.set("提示预取") # 在独立任务中运行，不影响创建它的命令
+    try:
+        prompt = _get_prompt_registry().render("提示包", question=question, answer=answer)
+        response = await _request_llm(
+            prompt, api_url, api_key, model, temperature, 1000,
+            priority=PRIORITY_HINT, group_id=group_id
+        )
+        bundle = _parse_hint_bundle_json(response)
+        if bundle is None:
+            print(f"[Hint Bundle] 提示包解析失败: {response}")
+        return bundle
+    except Exception as e:
+        print(f"[Hint Bundle] 预取提示包时发生异常: {e}")
+        return None
+
+
+def _discard_hint_bundle(group_id: str):
+    """丢弃 (并取消未完成的) 提示包预取任务"""
+    task = hint_bundles.pop(group_id, None)
+    if task is not None and not task.done():
+        task.cancel()
+
+
+async def _get_hint_bundle(group_id: str) -> Optional[Dict[str, Any]]:
+    """
+    获取当前游戏的提示包。
+    预取仍在进行时等待同一个任务完成，不重复请求；没有预取时使用本地题目的离线标注，都没有或预取失败时返回 None。
+    """
+    task = hint_bundles.get(group_id)
+    if task is None:
+        session = game_states.get(group_id)
+        return _get_soup_annotations().bundle(session.puzzle_id) if session is not None else None
+    try:
+        # shield: 单个命令被取消时不影响其他等待同一预取结果的命令
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if task.cancelled():
+            return None
+        raise
+    except Exception:
+        return None
+
+
+# --- 本地题目离线标注：按内容哈希保存的提示、线索、关键词和常见问题 ---
+def _parse_annotation_json(text: str) -> Optional[Dict[str, Any]]:
+    """解析标注结果，提示和线索整理必须有效；关键词和常见问题只保留格式正确的条目"""
+    data = _extract_json_object(text)
+    bundle = _hint_bundle_from_dict(data) if data is not None else None
+    if bundle is None:
+        return None
+    keywords = data.get("keywords")
+    faq = data.get("faq")
+    bundle["keywords"] = [k.strip() for k in keywords if isinstance(k, str) and k.strip()] if isinstance(keywords, list) else []
+    bundle["faq"] = [
+        [item["question"].strip(), item["verdict"].strip()]
+        for item in (faq if isinstance(faq, list) else [])
+        if isinstance(item, dict) and isinstance(item.get("question"), str) and item["question"].strip()
+        and isinstance(item.get("verdict"), str) and item["verdict"].strip() in QUESTION_VERDICTS
+    ]
+    return bundle
+
+
+class SoupAnnotations:
+    """
+    本地题目的离线标注 (题库旁的 sidecar 文件)，按题目id (内容哈希) 保存分级提示、线索整理、汤底关键词和常见问题。
+    以 JSONL 追加写入，每标注完一个题目写一行，中断后重新运行会跳过已有标注的题目；题目内容变化后哈希随之变化，会重新标注。
+    同一题目出现多行时以最后一行为准，compact 时去掉重复行；只有明确要求清理时才删除已不在题库中的题目的标注。
+    """
+
+    FILE = "turtle_annotations.jsonl"
+
+    def __init__(self, enabled: bool = True, path: Optional[str] = None):
+        self.enabled = enabled
+        self.path = path or os.path.join(PLUGIN_DIR, self.FILE)
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._faq: Dict[str, Dict[str, str]] = {} # {题目id: {归一化问题: 判断}}
+        self._lines = 0
+        self._write_lock = asyncio.Lock() # 多个标注协程的追加写入按顺序进行
+
+    def load(self):
+        """读取 sidecar 文件，跳过无法解析的行"""
+        self._entries.clear()
+        self._faq.clear()
+        self._lines = 0
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    self._lines += 1
+                    try:
+                        entry = _json_loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(entry, dict) and isinstance(entry.get("id"), str):
+                        self._index(entry)
+        except Exception as e:
+            print(f"加载 {self.path} 失败: {e}")
+            return
+        print(f"[Soup Annotations] 已加载 {len(self._entries)} 个本地题目的标注。")
+
+    def _index(self, entry: Dict[str, Any]):
+        self._entries[entry["id"]] = entry
+        self._faq[entry["id"]] = {_normalize_question(q): v for q, v in entry.get("faq", [])}
+
+    def _append(self, line: str):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    async def add(self, entry: Dict[str, Any]) -> bool:
+        """
+        追加一个题目的标注并在线程中立即写入文件。
+        写入失败 (磁盘已满、没有权限等) 时只打印错误并返回 False，本次运行中该标注仍然可用。
+        """
+        self._index(entry)
+        line = _json_dumps(entry) + "\n"
+        async with self._write_lock:
+            try:
+                await asyncio.to_thread(self._append, line)
+            except OSError as e:
+                print(f"[Soup Annotations] 写入 {self.path} 失败: {e}")
+                return False
+        self._lines += 1
+        return True
+
+    def compact(self, keep_ids: Optional[set] = None):
+        """重写 sidecar 文件，去掉重复行；keep_ids 不为 None 时还会删除不在其中的题目的标注 (不可恢复)"""
+        if keep_ids is not None:
+            for puzzle_id in [pid for pid in self._entries if pid not in keep_ids]:
+                del self._entries[puzzle_id]
+                del self._faq[puzzle_id]
+        if self._lines == len(self._entries):
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in self._entries.values():
+                f.write(_json_dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
+        self._lines = len(self._entries)
+
+    def __contains__(self, puzzle_id: str) -> bool:
+        return puzzle_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def bundle(self, puzzle_id: str) -> Optional[Dict[str, Any]]:
+        """题目的提示包 {"hints": [...], "clues": "..."}，未标注或未启用时返回 None"""
+        entry = self._entries.get(puzzle_id) if self.enabled else None
+        if entry is None:
+            return None
+        return {"hints": entry["hints"], "clues": entry["clues"]}
+
+    def faq_verdict(self, puzzle_id: str, question: str) -> Optional[str]:
+        """问题命中预先标注的常见问题时返回其判断"""
+        if not self.enabled:
+            return None
+        faq = self._faq.get(puzzle_id)
+        return faq.get(_normalize_question(question)) if faq else None
+
+
+def _get_soup_annotations() -> "SoupAnnotations":
+    """获取全局本地题目标注，插件实例尚未创建时按默认配置懒加载"""
+    global soup_annotations
+    if soup_annotations is None:
+        soup_annotations = SoupAnnotations()
+        soup_annotations.load()
+    return soup_annotations
+
+
+async def _annotate_library(
+    library: "SoupLibrary", annotations: "SoupAnnotations",
+    api_url: str, api_key: str, model: str, temperature: float,
+    concurrency: int = 4, force: bool = False, prune: bool = False,
+    on_progress: Optional[Callable[[Dict[str, int]], None]] = None
+) -> Dict[str, int]:
+    """
+    用固定数量的协程标注题库中尚未标注 (force=True 时为全部) 的题目，每完成一个立即写入 sidecar。
+    请求以出题优先级进入调度器，不影响玩家的提问和猜谜。返回 {total, skipped, done, failed}。
+    prune=True 时删除已不在题库中的题目的标注，否则保留 (临时换用较小的题库不会丢失已付费生成的标注)。
+    """
+    _metric_action.set("预处理")
+    queue: deque = deque()
+    seen = set()
+    for index in range(len(library)):
+        puzzle_id = library.digest(index).hex()
+        if puzzle_id not in seen and (force or puzzle_id not in annotations):
+            queue.append(index)
+        seen.add(puzzle_id)
+    stats = {"total": len(seen), "skipped": len(seen) - len(queue), "done": 0, "failed": 0}
+
+    async def worker():
+        while queue:
+            soup = library[queue.popleft()]
+            prompt = _get_prompt_registry().render("标注", question=soup["question"], answer=soup["answer"])
+            response = await _request_llm(
+                prompt, api_url, api_key, model, temperature, 1500,
+                priority=PRIORITY_GENERATE, group_id="预处理"
+            )
+            entry = _parse_annotation_json(response)
+            if entry is None:
+                print(f"[Soup Annotations] 题目【{soup['name']}】标注失败: {response[:200]}")
+                stats["failed"] += 1
+            else:
+                entry = {"id": soup["id"], **entry, "model": model, "at": int(time.time())}
+                if await annotations.add(entry):
+                    stats["done"] += 1
+                else:
+                    stats["failed"] += 1 # 没有写入文件，下次运行时重新标注
+            if on_progress is not None:
+                on_progress(stats)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(queue))))))
+    try:
+        await asyncio.to_thread(annotations.compact, seen if prune else None)
+    except OSError as e:
+        print(f"[Soup Annotations] 整理 {annotations.path} 失败: {e}")
+    return stats
+
+
+# --- 并发控制：群锁与相同请求合并 ---
+class GroupLockRegistry:
+    """
+    按群分配 asyncio.Lock，用于串行化跨 await 的游戏状态修改。
+    使用弱引用字典保存，没有协程持有或等待某个群的锁时自动释放。
+    """
+
+    def __init__(self):
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def get(self, group_id: str) -> asyncio.Lock:
+        lock = self._locks.get(group_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[group_id] = lock
+        return lock
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class SingleFlight:
+    """
+    相同 key 的并发请求只执行一次，所有等待者共享同一个结果。
+    执行完成后立即移除 key，之后的请求会重新执行。
+    """
+
+    def __init__(self):
+        self._flights: Dict[Any, asyncio.Task] = {}
+
+    async def run(self, key: Any, factory: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._flights[key] = task
+            task.add_done_callback(lambda t: self._discard(key, t))
+        else:
+            print(f"[Single Flight] 合并进行中的请求: {key}")
+        # shield: 某个等待者被取消时不影响其他等待者
+        return await asyncio.shield(task)
+
+    def _discard(self, key: Any, task: asyncio.Task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+
+# --- 全局并发控制实例 ---
+_group_locks = GroupLockRegistry()
+_single_flight = SingleFlight()
+
+
+# --- 反注入：违禁词多模式匹配 ---
+def _normalize_injection_text(text: str) -> str:
+    """归一化待检测文本：全角转半角 (NFKC)、小写、去掉空白和零宽字符等不可见格式字符"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in text if not ch.isspace() and unicodedata.category(ch) != "Cf")
+
+
+class InjectionFilter:
+    """
+    由违禁词列表构建的 Aho-Corasick 自动机。
+    违禁词和输入使用相同的归一化，扫描时间只与输入长度有关，与违禁词数量无关。
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.patterns: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._match: List[int] = [-1] # 以该状态结尾 (含失败链) 的违禁词序号，-1 表示没有
+        for pattern in patterns:
+            key = _normalize_injection_text(pattern) if isinstance(pattern, str) else ""
+            if not key:
+                continue
+            node = 0
+            for ch in key:
+                child = self._goto[node].get(ch)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto[node][ch] = child
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._match.append(-1)
+                node = child
+            if self._match[node] < 0:
+                self._match[node] = len(self.patterns)
+            self.patterns.append(pattern)
+        # 按层构建失败指针
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                if self._match[child] < 0:
+                    self._match[child] = self._match[self._fail[child]]
+
+    def find(self, text: str) -> Optional[str]:
+        """返回输入中出现的第一个违禁词，没有时返回 None"""
+        goto, fail, match = self._goto, self._fail, self._match
+        node = 0
+        for ch in _normalize_injection_text(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if match[node] >= 0:
+                return self.patterns[match[node]]
+        return None
+
+
+_injection_filter: Optional[InjectionFilter] = None
+_injection_filter_key: Optional[tuple] = None
+
+
+def _get_injection_filter(patterns: List[str]) -> "InjectionFilter":
+    """获取违禁词自动机，只在 anti_abuse.ban_history 变化时重新构建"""
+    global _injection_filter, _injection_filter_key
+    key = tuple(patterns)
+    if _injection_filter is None or key != _injection_filter_key:
+        _injection_filter = InjectionFilter(list(key))
+        _injection_filter_key = key
+    return _injection_filter
+
+
+# --- 猜谜本地预判：词法相似度 ---
+_SENTENCE_SPLIT_RE = re.compile(r"[。！？!?；;，,、\n]+")
+_BM25_K1 = 1.2
+GUESS_PRESCREEN_MODES = ("off", "shadow", "enforce")
+prescreen_stats = {"agree": 0, "disagree": 0, "undecided": 0} # 影子模式下本地预判与LLM的一致情况
+
+
+def _char_bigrams(text: str) -> List[str]:
+    """归一化后的字符二元组 (可重复)，不足两个字时返回整段文本"""
+    text = _normalize_search_text(text)
+    if len(text) < 2:
+        return [text] if text else []
+    return [text[i:i + 2] for i in range(len(text) - 1)]
+
+
+def _score_guess(guess: str, question: str, answer: str) -> Tuple[float, float]:
+    """
+    按字符二元组比较猜测和题目，返回 (得分, 相关度)，均在 0~1 之间。
+    以汤面和汤底的每个句子为文档计算 BM25 的 IDF 权重；汤底中没有出现在汤面里的二元组视为关键词。
+    得分为精确度 (猜测的二元组中属于汤底的加权比例) 和关键词覆盖率 (按 BM25 词频饱和加权) 的调和平均；
+    相关度为猜测的二元组中出现在汤面或汤底里的加权比例。
+    """
+    guess_grams = set(_char_bigrams(guess))
+    answer_counts: Dict[str, int] = {}
+    for gram in _char_bigrams(answer):
+        answer_counts[gram] = answer_counts.get(gram, 0) + 1
+    if not guess_grams or not answer_counts:
+        return 0.0, 0.0
+
+    documents = [set(_char_bigrams(sentence)) for sentence in _SENTENCE_SPLIT_RE.split(f"{question}\n{answer}")]
+    documents = [document for document in documents if document]
+    total = len(documents)
+
+    def idf(gram: str) -> float:
+        df = sum(1 for document in documents if gram in document)
+        return math.log(1 + (total - df + 0.5) / (df + 0.5))
+
+    weights = {gram: idf(gram) for gram in guess_grams | set(answer_counts)}
+    guess_weight = sum(weights[gram] for gram in guess_grams)
+    precision = sum(weights[gram] for gram in guess_grams & set(answer_counts)) / guess_weight
+
+    question_grams = set(_char_bigrams(question))
+    relevance = sum(weights[gram] for gram in guess_grams if gram in answer_counts or gram in question_grams) / guess_weight
+    keywords = [gram for gram in answer_counts if gram not in question_grams] or list(answer_counts)
+
+    def keyword_weight(gram: str) -> float:
+        tf = answer_counts[gram]
+        return weights[gram] * tf * (_BM25_K1 + 1) / (tf + _BM25_K1)
+
+    coverage = sum(keyword_weight(gram) for gram in keywords if gram in guess_grams) / sum(keyword_weight(gram) for gram in keywords)
+    if precision + coverage == 0:
+        return 0.0, relevance
+    return 2 * precision * coverage / (precision + coverage), relevance
+
+
+def _prescreen_guess(
+    guess: str, question: str, answer: str, accept_threshold: float, reject_threshold: float
+) -> Tuple[Optional[str], float]:
+    """
+    本地预判猜测，返回 (判定, 得分)。得分不低于 accept_threshold 时判为“是”；
+    与汤面、汤底几乎没有共同内容 (相关度低于 reject_threshold) 时判为“无关”；其余交给LLM，返回 None。
+    只要与题目有共同内容就不在本地判“不是”，避免把同义改写的猜测误判。
+    """
+    score, relevance = _score_guess(guess, question, answer)
+    if score >= accept_threshold:
+        return "是", score
+    if relevance < reject_threshold:
+        return "无关", score
+    return None, score
+
+
+def _record_prescreen_agreement(local_verdict: Optional[str], llm_verdict: str, score: float):
+    """影子模式：记录本地预判与LLM判断是否一致，用于调整阈值"""
+    if local_verdict is None:
+        prescreen_stats["undecided"] += 1
+        outcome = "待定"
+    elif local_verdict == llm_verdict or (local_verdict == "无关" and llm_verdict == "不是"):
+        prescreen_stats["agree"] += 1
+        outcome = "一致"
+    else:
+        prescreen_stats["disagree"] += 1
+        outcome = "不一致"
+    print(
+        f"[Guess Prescreen] 本地={local_verdict or '待定'} LLM={llm_verdict} 得分={score:.3f} {outcome} "
+        f"(累计 一致 {prescreen_stats['agree']} / 不一致 {prescreen_stats['disagree']} / 待定 {prescreen_stats['undecided']})"
+    )
+
+
+# --- 游戏会话：紧凑的有界内存表示 ---
+class GameStatus(enum.IntEnum):
+    """游戏状态，取代原来的 game_active / game_over 两个布尔值"""
+    ACTIVE = 1 # 进行中
+    SOLVED = 2 # 已猜对，汤底尚未被揭秘或退出
+    ENDED = 3 # 已退出或已揭秘
+
+
+def _guess_digest(guess: str) -> bytes:
+    """猜测记录只保存归一化文本的 8 字节摘要，用于判断重复猜测"""
+    return hashlib.blake2b(_normalize_question(guess).encode("utf-8"), digest_size=8).digest()
+
+
+class GameSession:
+    """
+    单个群的游戏会话。
+    本地题目只保存题目 id，题面和汤底通过 local_turtle_soups 查找；AI 生成的题目才在会话中保存文本。
+    猜测记录只保存摘要，按加入顺序存放在 OrderedDict 中当作有序集合，
+    最多保留 MAX_GUESSES 条，超出时淘汰最早的记录。
+    问答记录只追加不修改，qa_total 为累计条数 (即问答版本号)，最多保留最近 MAX_QA_LOG 条；
+    线索整理记录它覆盖到的版本号，之后只需把新增的问答合并进去。
+    """
+
+    __slots__ = (
+        "puzzle_id", "_question", "_answer", "status", "hints_used", "_guesses", "updated_at",
+        "_qa_log", "qa_total", "clue_summary", "clue_version",
+    )
+
+    MAX_GUESSES = 64
+    MAX_QA_LOG = 100
+
+    def __init__(self, puzzle_id: str, question: Optional[str] = None, answer: Optional[str] = None):
+        self.puzzle_id = puzzle_id
+        self._question = question # 为 None 时从本地题库读取
+        self._answer = answer
+        self.status = GameStatus.ACTIVE
+        self.hints_used = 0
+        self._guesses: "OrderedDict[bytes, None]" = OrderedDict() # {猜测摘要: None}，按加入顺序
+        self.updated_at = time.time()
+        self._qa_log: List[Tuple[str, str]] = [] # [(问题, 判断结果)]
+        self.qa_total = 0
+        self.clue_summary: Optional[str] = None
+        self.clue_version = 0
+
+    @classmethod
+    def from_local(cls, soup: dict) -> "GameSession":
+        """引用本地题库中的题目，不复制文本"""
+        return cls(soup["id"])
+
+    @classmethod
+    def from_text(cls, question: str, answer: str) -> "GameSession":
+        """AI 生成的题目，文本保存在会话中"""
+        return cls(_puzzle_hash(question, answer), sys.intern(question), sys.intern(answer))
+
+    # --- 题目文本 ---
+    @property
+    def question(self) -> str:
+        if self._question is not None:
+            return self._question
+        soup = local_turtle_soups.get(self.puzzle_id)
+        return soup["question"] if soup else "无题目"
+
+    @property
+    def answer(self) -> str:
+        if self._answer is not None:
+            return self._answer
+        soup = local_turtle_soups.get(self.puzzle_id)
+        return soup["answer"] if soup else "无答案"
+
+    def materialize(self):
+        """把本地题目文本复制到会话中，在题库重新加载且不再包含该题目时调用"""
+        if self._question is None:
+            soup = local_turtle_soups.get(self.puzzle_id)
+            if soup is not None:
+                self._question, self._answer = soup["question"], soup["answer"]
+
+    # --- 状态 ---
+    @property
+    def active(self) -> bool:
+        """游戏是否仍可提问/查看 (猜对后直到退出或揭秘前仍算活跃，与原行为一致)"""
+        return self.status != GameStatus.ENDED
+
+    @property
+    def over(self) -> bool:
+        """游戏是否已结束 (猜对、退出或揭秘)"""
+        return self.status != GameStatus.ACTIVE
+
+    def has_guessed(self, guess: str) -> bool:
+        return _guess_digest(guess) in self._guesses
+
+    def add_guess(self, guess: str):
+        digest = _guess_digest(guess)
+        if digest in self._guesses:
+            return
+        self._guesses[digest] = None
+        if len(self._guesses) > self.MAX_GUESSES:
+            self._guesses.popitem(last=False)
+
+    # --- 问答记录与线索整理 ---
+    def log_question(self, question: str, verdict: str):
+        """追加一条问答记录"""
+        self._qa_log.append((question, verdict))
+        self.qa_total += 1
+        if len(self._qa_log) > self.MAX_QA_LOG:
+            del self._qa_log[0]
+
+    def questions_since(self, version: int, until: Optional[int] = None) -> List[Tuple[str, str]]:
+        """版本 version 之后、until (默认最新) 及之前追加的问答 (已淘汰的早期记录不再返回)"""
+        until = self.qa_total if until is None else until
+        end = len(self._qa_log) - (self.qa_total - until)
+        count = min(until - version, end)
+        return self._qa_log[end - count:end] if count > 0 else []
+
+    def set_clues(self, summary: str, version: int):
+        """保存覆盖到问答版本 version 的线索整理"""
+        self.clue_summary = summary
+        self.clue_version = version
+
+    def touch(self):
+        self.updated_at = time.time()
+
+    def memory_size(self) -> int:
+        """估算会话占用的字节数 (不含本地题库中共享的文本)"""
+        size = sys.getsizeof(self) + sys.getsizeof(self._guesses)
+        size += sum(sys.getsizeof(digest) for digest in self._guesses)
+        if self._question is not None:
+            size += sys.getsizeof(self._question) + sys.getsizeof(self._answer)
+        size += sys.getsizeof(self._qa_log)
+        size += sum(sys.getsizeof(entry) + sys.getsizeof(entry[0]) for entry in self._qa_log)
+        if self.clue_summary is not None:
+            size += sys.getsizeof(self.clue_summary)
+        return size
+
+    # --- 序列化 ---
+    def to_dict(self) -> dict:
+        data = {
+            "id": self.puzzle_id,
+            "status": int(self.status),
+            "hints": self.hints_used,
+            "guesses": [digest.hex() for digest in self._guesses],
+            "updated_at": self.updated_at,
+        }
+        if self._question is not None:
+            data["q"] = self._question
+            data["a"] = self._answer
+        if self.qa_total:
+            data["qa"] = [list(entry) for entry in self._qa_log]
+            data["qn"] = self.qa_total
+        if self.clue_summary is not None:
+            data["clues"] = self.clue_summary
+            data["cv"] = self.clue_version
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GameSession":
+        if "id" not in data and "current_question" in data:
+            return cls._from_legacy_dict(data)
+        question, answer = data.get("q"), data.get("a")
+        session = cls(
+            data["id"],
+            sys.intern(question) if question is not None else None,
+            sys.intern(answer) if answer is not None else None,
+        )
+        session.status = GameStatus(data.get("status", GameStatus.ACTIVE))
+        session.hints_used = int(data.get("hints", 0))
+        session._guesses = OrderedDict.fromkeys(
+            bytes.fromhex(digest) for digest in data.get("guesses", [])[-cls.MAX_GUESSES:]
+        )
+        session.updated_at = float(data.get("updated_at", 0))
+        session._qa_log = [(str(q), str(v)) for q, v in data.get("qa", [])][-cls.MAX_QA_LOG:]
+        session.qa_total = int(data.get("qn", len(session._qa_log)))
+        if data.get("clues") is not None:
+            session.set_clues(data["clues"], int(data.get("cv", 0)))
+        return session
+
+    @classmethod
+    def _from_legacy_dict(cls, data: dict) -> "GameSession":
+        """兼容旧版本快照中的字典格式游戏状态"""
+        session = cls.from_text(data["current_question"], data.get("current_answer", ""))
+        if not data.get("game_active", False):
+            session.status = GameStatus.ENDED
+        elif data.get("game_over", False):
+            session.status = GameStatus.SOLVED
+        session.hints_used = int(data.get("hints_used", 0))
+        for guess in data.get("guess_history", []):
+            session.add_guess(guess)
+        session.updated_at = float(data.get("updated_at", 0))
+        return session
+
+
+def _session_memory_stats() -> dict:
+    """统计当前所有游戏会话的数量和估算内存占用"""
+    return {
+        "sessions": len(game_states),
+        "bytes": sum(session.memory_size() for session in game_states.values()),
+    }
+
+
+def _is_current_game(group_id: str, game_state: "GameSession") -> bool:
+    """该会话是否仍是群里当前的游戏且未被退出或揭秘 (等待LLM后修改状态前需在群锁内检查)"""
+    return game_states.get(group_id) is game_state and game_state.active
+
+
+# --- 游戏状态持久化：快照 + 追加日志 ---
+
+class GameStore:
+    """
+    把 game_states 和 model_selections 的变更追加写入日志 (JSONL，每行一条记录，值为 null 表示删除)，
+    日志累积到 compact_every 条时压缩为快照。启动时加载快照并重放日志恢复全部状态。
+    同时负责按 TTL 淘汰长时间无人操作的游戏和已结束的游戏。
+    """
+
+    SNAPSHOT_FILE = "game_snapshot.json"
+    JOURNAL_FILE = "game_journal.jsonl"
+
+    def __init__(
+        self, enabled: bool = True, compact_every: int = 500,
+        idle_ttl: float = 86400, finished_ttl: float = 1800, sweep_interval: float = 300
+    ):
+        self.enabled = enabled
+        self.compact_every = max(1, compact_every)
+        self.idle_ttl = idle_ttl
+        self.finished_ttl = finished_ttl
+        self.sweep_interval = sweep_interval
+        self._journal = None # 追加写入的文件对象
+        self._journal_entries = 0
+        self._last_sweep = time.time()
+        self._compacting: Optional[asyncio.Task] = None
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(PLUGIN_DIR, filename)
+
+    # --- 写入 ---
+    def record_game(self, group_id: str):
+        """记录某个群的最新游戏状态 (不存在时记录删除)"""
+        session = game_states.get(group_id)
+        if session is not None:
+            session.touch()
+        self._append({"k": "game", "id": group_id, "v": session.to_dict() if session is not None else None})
+
+    def record_model(self, stream_id: str):
+        """记录某个聊天流的模型选择"""
+        self._append({"k": "model", "id": stream_id, "v": model_selections.get(stream_id)})
+
+    def _append(self, entry: dict):
+        if not self.enabled:
+            return
+        try:
+            if self._journal is None:
+                self._journal = open(self._path(self.JOURNAL_FILE), "a", encoding="utf-8")
+            self._journal.write(_json_dumps(entry) + "\n")
+            self._journal.flush()
+            self._journal_entries += 1
+        except Exception as e:
+            print(f"写入游戏状态日志失败: {e}")
+            return
+        if self._journal_entries >= self.compact_every:
+            self.compact()
+
+    # --- 压缩 ---
+    def compact(self):
+        """
+        轮转日志并在后台线程写入快照。
+        先同步复制当前状态并把日志改名为 .old，之后的变更写入新日志；
+        快照写完后才删除 .old，中途崩溃时恢复流程会重放 .old。
+        """
+        if not self.enabled or (self._compacting is not None and not self._compacting.done()):
+            return
+        snapshot = {
+            "games": {gid: session.to_dict() for gid, session in game_states.items()},
+            "models": dict(model_selections),
+        }
+        old_path = self._rotate_journal()
+        if old_path is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_snapshot(snapshot, old_path)
+            return
+        self._compacting = loop.create_task(asyncio.to_thread(self._write_snapshot, snapshot, old_path))
+
+    def _rotate_journal(self) -> Optional[str]:
+        """
+        关闭当前日志并改名为 .old，返回 .old 的路径；失败时返回 None，日志保持原样。
+        上一次压缩没有写成快照时 .old 仍在，把当前日志追加进去而不是覆盖，避免丢失记录。
+        """
+        journal_path = self._path(self.JOURNAL_FILE)
+        old_path = journal_path + ".old"
+        try:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if os.path.exists(journal_path):
+                if os.path.exists(old_path):
+                    with open(old_path, "a", encoding="utf-8") as dst, open(journal_path, "r", encoding="utf-8") as src:
+                        dst.write(src.read())
+                    os.remove(journal_path)
+                else:
+                    os.replace(journal_path, old_path)
+            self._journal_entries = 0
+        except Exception as e:
+            print(f"轮转游戏状态日志失败: {e}")
+            return None
+        return old_path
+
+    def _write_snapshot(self, snapshot: dict, old_path: str):
+        """写入快照；成功写入后才删除 .old，失败时保留 .old 供下次启动重放"""
+        snapshot_path = self._path(self.SNAPSHOT_FILE)
+        tmp_path = snapshot_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(_json_dumps(snapshot))
+            os.replace(tmp_path, snapshot_path)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+        except Exception as e:
+            print(f"写入游戏状态快照失败: {e}")
+
+    # --- 恢复 ---
+    def restore(self) -> Tuple[int, int]:
+        """加载快照并重放日志，原地更新 game_states 和 model_selections，返回 (游戏数, 模型选择数)"""
+        if not self.enabled:
+            return 0, 0
+        snapshot_path = self._path(self.SNAPSHOT_FILE)
+        journal_path = self._path(self.JOURNAL_FILE)
+        games: Dict[str, dict] = {}
+        models: Dict[str, str] = {}
+        if os.path.exists(snapshot_path):
+            try:
+                with open(snapshot_path, "r", encoding="utf-8") as f:
+                    snapshot = _json_loads(f.read())
+                games.update(snapshot.get("games", {}))
+                models.update(snapshot.get("models", {}))
+            except Exception as e:
+                print(f"加载游戏状态快照失败: {e}")
+        for path in (journal_path + ".old", journal_path):
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entry = _json_loads(line)
+                        except ValueError:
+                            continue # 崩溃时可能留下半行，跳过
+                        target = games if entry.get("k") == "game" else models
+                        if entry.get("v") is None:
+                            target.pop(entry.get("id"), None)
+                        else:
+                            target[entry.get("id")] = entry["v"]
+            except Exception as e:
+                print(f"重放游戏状态日志 {path} 失败: {e}")
+        game_states.clear()
+        for group_id, data in games.items():
+            try:
+                game_states[group_id] = GameSession.from_dict(data)
+            except (KeyError, ValueError, TypeError) as e:
+                print(f"恢复群 {group_id} 的游戏状态失败: {e}")
+        model_selections.clear()
+        model_selections.update(models)
+        self.sweep(force=True)
+        return len(game_states), len(model_selections)
+
+    # --- 淘汰 ---
+    def sweep(self, force: bool = False) -> int:
+        """淘汰空闲超过 idle_ttl 的游戏和结束超过 finished_ttl 的游戏，返回淘汰数量"""
+        now = time.time()
+        if not force and now - self._last_sweep < self.sweep_interval:
+            return 0
+        self._last_sweep = now
+        expired = []
+        for group_id, session in game_states.items():
+            idle = now - session.updated_at
+            if idle > self.idle_ttl or (session.over and idle > self.finished_ttl):
+                expired.append(group_id)
+        for group_id in expired:
+            game_states.pop(group_id, None)
+            _discard_hint_bundle(group_id)
+            self._append({"k": "game", "id": group_id, "v": None})
+        if expired:
+            print(f"[Game Store] 淘汰了 {len(expired)} 个过期游戏。")
+        return len(expired)
+
+    async def aclose(self):
+        """等待进行中的压缩完成，再做一次完整压缩并关闭日志 (与 compact 相同，快照写入成功前不删除 .old)"""
+        if self._compacting is not None:
+            await asyncio.gather(self._compacting, return_exceptions=True)
+        if self.enabled:
+            snapshot = {
+                "games": {gid: session.to_dict() for gid, session in game_states.items()},
+                "models": dict(model_selections),
+            }
+            old_path = self._rotate_journal()
+            if old_path is not None:
+                self._write_snapshot(snapshot, old_path)
+
+
+def _get_game_store() -> "GameStore":
+    """获取全局状态存储，插件实例尚未创建时返回不持久化的默认实例"""
+    global game_store
+    if game_store is None:
+        game_store = GameStore(enabled=False)
+    return game_store
+
+
+# --- 配置快照：config.toml 变化时才重新读取 ---
+class ConfigSnapshot:
+    """
+    命令处理用到的全部配置项的只读快照。
+    每条消息只读取一次快照，不再逐项调用 get_config；列表类配置转为 tuple/frozenset。
+    """
+    __slots__ = (
+        "enabled", "api_url", "api_key", "models", "default_model", "temperature",
+        "generation_mode", "prefetch_enabled", "streaming_actions", "flush_min_chars",
+        "page_size", "search_results", "prescreen_mode", "prescreen_accept", "prescreen_reject",
+        "admin_users", "ban_history", "annotation_concurrency", "annotation_admins", "dedup_retries",
+    )
+
+    def __init__(self, get_config: Callable[[str, Any], Any]):
+        models = tuple(get_config("llm.models", ["deepseek-ai/DeepSeek-V3"]))
+        default_model = get_config("llm.model", "deepseek-ai/DeepSeek-V3")
+        if default_model not in models:
+            # 默认模型不在可用列表中时使用列表第一个
+            default_model = models[0] if models else "deepseek-ai/DeepSeek-V3"
+        values = {
+            "enabled": get_config("plugin.enabled", True),
+            "api_url": get_config("llm.api_url", "").strip(),
+            "api_key": get_config("llm.api_key", "").strip(),
+            "models": models,
+            "default_model": default_model,
+            "temperature": get_config("llm.temperature", 0.7),
+            "generation_mode": get_config("llm.generation_mode", "single"),
+            "prefetch_enabled": get_config("prefetch.enabled", True),
+            "streaming_actions": frozenset(get_config("streaming.actions", DEFAULT_STREAMING_ACTIONS)),
+            "flush_min_chars": get_config("streaming.flush_min_chars", 40),
+            "page_size": max(1, get_config("library.page_size", 20)),
+            "search_results": max(1, get_config("library.search_results", 10)),
+            "prescreen_mode": get_config("guess_prescreen.mode", "shadow"),
+            "prescreen_accept": get_config("guess_prescreen.accept_threshold", 0.8),
+            "prescreen_reject": get_config("guess_prescreen.reject_threshold", 0.05),
+            "admin_users": frozenset(str(user) for user in get_config("metrics.admin_users", [])),
+            "ban_history": tuple(get_config("anti_abuse.ban_history", [])),
+            "annotation_concurrency": max(1, get_config("annotations.concurrency", 4)),
+            "annotation_admins": frozenset(str(user) for user in get_config("annotations.admin_users", [])),
+            "dedup_retries": max(0, get_config("dedup.max_retries", 2)),
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name: str, value: Any):
+        raise AttributeError("配置快照只读，配置变化时会整体重建")
+
+    def resolve_model(self, stream_id: str) -> str:
+        """当前聊天流选中的模型，未选择或已不在可用列表中时使用默认模型"""
+        model = model_selections.get(stream_id)
+        return model if model and model in self.models else self.default_model
+
+
+class ConfigSnapshotCache:
+    """
+    缓存最近一次构建的配置快照。
+    宿主传入的配置字典被替换，或 config.toml 的 mtime/大小变化时重建；
+    文件状态最多每 check_interval 秒检查一次。
+    """
+
+    def __init__(self, check_interval: float = 1.0):
+        self.check_interval = check_interval
+        self._snapshot: Optional[ConfigSnapshot] = None
+        self._source: Any = None
+        self._file_state: Optional[Tuple[int, int]] = None
+        self._checked_at = 0.0
+        self.rebuilds = 0
+
+    @staticmethod
+    def _config_file_state() -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(os.path.join(PLUGIN_DIR, HaiTurtleSoupPlugin.config_file_name))
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, get_config: Callable[[str, Any], Any], source: Any = None) -> ConfigSnapshot:
+        now = time.monotonic()
+        snapshot = self._snapshot
+        if snapshot is not None and source is self._source and now - self._checked_at < self.check_interval:
+            return snapshot
+        file_state = self._config_file_state()
+        if snapshot is None or source is not self._source or file_state != self._file_state:
+            snapshot = self._snapshot = ConfigSnapshot(get_config)
+            self._source, self._file_state = source, file_state
+            self.rebuilds += 1
+        self._checked_at = now
+        return snapshot
+
+    def invalidate(self):
+        self._snapshot = None
+        self._source = None
+
+
+_config_snapshots = ConfigSnapshotCache()
+
+
+# --- 命令路由：动作 (及别名) -> 处理方法 ---
+class CommandRoute:
+    """一个命令动作的路由信息"""
+    __slots__ = ("action", "handler", "needs_llm")
+
+    def __init__(self, action: str, handler: Callable[..., Awaitable[Tuple[bool, Optional[str], bool]]], needs_llm: bool):
+        self.action = action # 规范动作名，用于指标标签
+        self.handler = handler
+        self.needs_llm = needs_llm # 是否需要解析当前模型并触发题目池补充
+
+
+class CommandContext:
+    """一次命令调用的上下文，由分发器构建后传给处理方法"""
+    __slots__ = ("rest", "stream_id", "group_id", "config", "model")
+
+    def __init__(self, rest: str, stream_id: str, group_id: str, config: ConfigSnapshot):
+        self.rest = rest
+        self.stream_id = stream_id
+        self.group_id = group_id
+        self.config = config
+        self.model = config.default_model
+
+
+COMMAND_ROUTES: Dict[str, CommandRoute] = {}
+
+
+def _command(action: str, *aliases: str, needs_llm: bool = False):
+    """注册命令处理方法，动作名和别名指向同一个路由"""
+    def register(handler):
+        route = CommandRoute(action, handler, needs_llm)
+        for name in (action,) + aliases:
+            COMMAND_ROUTES[name] = route
+        return handler
+    return register
+
+
+# --- 帮助信息 (静态文本，只构建一次) ---
+HELP_TEXT = (
+    "📖 **海龟汤游戏帮助信息**\n\n"
+    "🎯 **指令列表**\n"
+    "🔸 `/hgt 问题` - 生成AI海龟汤题目\n"
+    "🔸 `/hgt 问题 <问题>` - 向AI提问\n"
+    "🔸 `/hgt 提示` - 获取提示（最多3次）\n"
+    "🔸 `/hgt 整理线索` - 整理关键线索\n"
+    "🔸 `/hgt 猜谜 <答案>` - 猜测汤底\n"
+    "🔸 `/hgt 揭秘` - 直接揭示汤底并结束游戏\n"
+    "🔸 `/hgt 退出` - 退出当前游戏\n"
+    "🔸 `/hgt 汤面` - 查看当前题目（汤面）\n"
+    "🔸 `/hgt 帮助` - 查看此帮助信息\n"
+    "🔸 `/hgt 载入` - 从 `turtle.json` 载入本地题目\n"
+    "🔸 `/hgt 列表 [页码]` - 分页查看已载入的本地题目列表\n"
+    "🔸 `/hgt 搜索 <关键词>` - 按名称和汤面搜索本地题目\n"
+    "🔸 `/hgt 本地` - 随机使用一个已载入的本地题目开始游戏\n"
+    "🔸 `/hgt 本地 <序号>` - 使用指定序号的已载入本地题目开始游戏\n"
+    "🔸 `/hgt 模型` - 列出可用模型\n"
+    "🔸 `/hgt 模型 <序号>` - 切换模型\n"
+    "🔸 `/hgt 统计` - 查看运行统计 (管理员)\n"
+    "🔸 `/hgt 预处理 [全部]` - 预先为本地题目生成提示、线索和常见问题 (管理员)\n\n"
+    "💡 **游戏提示**\n"
+    "🔹 使用 `/hgt 问题` 或 `/hgt 本地` 开始游戏\n"
+    "🔹 通过提问和提示推理汤底\n"
+    "🔹 猜对后游戏结束\n"
+    "🔹 可以随时使用 `/hgt 退出` 退出游戏"
+)
+EMPTY_LIBRARY_REPLY = "❌ 本地题目库为空。请先使用 `/hgt 载入` 命令加载题目。"
+NO_GAME_REPLY = "❌ 当前没有正在进行的游戏。请先使用 `/hgt 问题` 生成题目。"
+
+
+# --- Command组件 ---
+class HaiTurtleSoupCommand(BaseCommand):
+    """处理 /hgt 命令"""
+
+    command_name = "HaiTurtleSoupCommand"
+    command_description = "生成海龟汤题目或进行游戏互动。用法: /hgt [问题|提示|整理线索|猜谜|退出|帮助|汤面|揭秘|载入|本地|列表|搜索|模型|统计|预处理]"
+    # 更新后的正则表达式，支持 /hgt 本地 <序号> 和 /hgt 模型 <参数>
+    command_pattern = r"^/hgt\s+(?P<action>\S+)(?:\s+(?P<rest>.+))?$"
+    command_help = (
+        "海龟汤游戏：\n"
+        "/hgt 问题 - 生成AI题目\n"
+        "/hgt 问题 <问题> - 提问\n"
+        "/hgt 提示 - 获取提示\n"
+        "/hgt 整理线索 - 整理线索\n"
+        "/hgt 猜谜 <答案> - 猜测汤底\n"
+        "/hgt 揭秘 - 揭示汤底\n"
+        "/hgt 退出 - 退出游戏\n"
+        "/hgt 汤面 - 查看题目\n"
+        "/hgt 帮助 - 查看帮助\n"
+        "/hgt 载入 - 从 turtle.json 载入本地题目\n"
+        "/hgt 列表 [页码] - 分页查看已载入的本地题目列表\n"
+        "/hgt 搜索 <关键词> - 按名称和汤面搜索本地题目\n"
+        "/hgt 本地 - 随机使用一个本地题目开始游戏\n"
+        "/hgt 本地 <序号> - 使用指定序号的本地题目开始游戏\n"
+        "/hgt 模型 - 列出可用模型\n"
+        "/hgt 模型 <序号> - 切换模型\n"
+        "/hgt 统计 - 查看运行统计 (管理员)\n"
+        "/hgt 预处理 [全部] - 预先标注本地题目 (管理员)"
+    )
+    command_examples = [
+        "/hgt 问题", "/hgt 问题 为什么海龟不喝水？", "/hgt 提示", "/hgt 整理线索",
+        "/hgt 猜谜 海龟是用海龟做的", "/hgt 退出", "/hgt 帮助", "/hgt 汤面",
+        "/hgt 揭秘", "/hgt 载入", "/hgt 列表", "/hgt 列表 2", "/hgt 搜索 冰箱", "/hgt 本地", "/hgt 本地 1",
+        "/hgt 模型", "/hgt 模型 2", "/hgt 统计", "/hgt 预处理"
+    ]
+    intercept_message = True # 确保拦截消息，防止转发
+
+    async def execute(self) -> Tuple[bool, Optional[str], bool]:
+        """执行命令，并按动作记录端到端耗时"""
+        # --- 安全处理匹配结果 ---
+        matched_groups = self.matched_groups or {}
+        action = str(matched_groups.get("action") or "").strip()
+        rest_input = str(matched_groups.get("rest") or "").strip()
+        route = COMMAND_ROUTES.get(action)
+
+        label = _metric_action_label(route.action if route is not None else action)
+        token = _metric_action.set(label)
+        started = time.monotonic()
+        success = False
+        try:
+            result = await self._dispatch(route or _DEFAULT_ROUTE, rest_input)
+            success = bool(result[0])
+            return result
+        finally:
+            metrics.observe(
+                "command_duration_seconds", time.monotonic() - started,
+                action=label, outcome="ok" if success else "error"
+            )
+            _metric_action.reset(token)
+            metrics.maybe_export()
+
+    async def send_text(self, content: str, *args, **kwargs):
+        """
+        把回复放入当前聊天流的发送队列后立即返回，由队列负责限速、合并、拆分和重试。
+        发送队列未启用或取不到聊天流时直接发送。
+        """
+        queue = _get_outbox()
+        stream_id = getattr(self._chat_stream(), "stream_id", None)
+        if queue.enabled and stream_id is not None:
+            queue.put(stream_id, content, self._deliver, args, kwargs)
+            return True
+        return await queue.send_now(content, self._deliver, args, kwargs)
+
+    async def _deliver(self, content: str, *args, **kwargs):
+        """真正调用平台接口发送消息 (发送队列的后台协程调用)"""
+        return await super().send_text(content, *args, **kwargs)
+
+    def _chat_stream(self):
+        """当前命令的聊天流，取不到时返回 None"""
+        chat_stream = getattr(self, 'chat_stream', None)
+        if chat_stream is None:
+            message_obj = getattr(self, 'message', None)
+            if message_obj:
+                chat_stream = getattr(message_obj, 'chat_stream', None)
+        return chat_stream
+
+    def _config(self) -> ConfigSnapshot:
+        """当前配置快照 (config.toml 未变化时直接复用)"""
+        return _config_snapshots.get(self.get_config, getattr(self, "plugin_config", None))
+
+    async def _dispatch(self, route: CommandRoute, rest_input: str) -> Tuple[bool, Optional[str], bool]:
+        """准备公共上下文后调用路由对应的处理方法"""
+        # --- 获取聊天上下文 ---
+        chat_stream = self._chat_stream()
+
+        if chat_stream is None:
+            error_msg = "❌ 无法获取聊天上下文信息 (chat_stream)。"
+            try:
+                await self.send_text(error_msg)
+            except Exception as send_e:
+                print(f"发送聊天上下文错误消息也失败了: {send_e}")
+            return False, "缺少聊天上下文 (chat_stream)", True
+
+        stream_id = getattr(chat_stream, 'stream_id', None)
+        if stream_id is None:
+            error_msg = "❌ 无法获取聊天流ID (stream_id)。"
+            try:
                 await self.send_text(error_msg)
             except Exception as send_e:
                 print(f"发送聊天流ID错误消息也失败了: {send_e}")
             return False, "缺少聊天流ID (stream_id)", True
 
+        # 插件加载时没有运行中的事件循环则在这里启动后台预热和题库监视
+        _get_library_watcher().start()
+
         # --- 检查插件是否启用 ---
-        enabled = self.get_config("plugin.enabled", True)
-        if not enabled:
+        config = self._config()
+        if not config.enabled:
             try:
                 await self.send_text("❌ 海龟汤插件已被禁用。")
             except Exception as e:
                 print(f"发送插件禁用消息失败: {e}")
             return False, "插件未启用", True
 
-        # --- 获取LLM配置 (仅在需要时使用) ---
-        api_url = self.get_config("llm.api_url", "").strip()
-        api_key = self.get_config("llm.api_key", "").strip()
-        # --- 获取模型列表 ---
-        available_models = self.get_config("llm.models", ["deepseek-ai/DeepSeek-V3"])
-
-        # --- 获取当前聊天上下文选中的模型 (修改后) ---
-        # 优先从全局 model_selections 字典获取，回退到配置文件默认值
-        current_model = model_selections.get(stream_id) # 使用 stream_id 查找
-        if not current_model or current_model not in available_models:
-            # 如果没有为当前上下文设置模型，或设置的模型无效，则使用 llm.model 配置项的默认值
-            current_model = self.get_config("llm.model", "deepseek-ai/DeepSeek-V3")
-            # 再次检查默认模型是否在可用列表中，不在则使用列表第一个
-            if current_model not in available_models:
-                 current_model = available_models[0] if available_models else "deepseek-ai/DeepSeek-V3"
-
-        temperature = self.get_config("llm.temperature", 0.7)
-
-        # --- 根据动作执行不同逻辑 ---
-        group_id = getattr(chat_stream, 'group_info', None)
-        if group_id:
-            group_id = group_id.group_id
-        else:
-            user_id = getattr(chat_stream, 'user_info', None)
-            if user_id:
-                group_id = user_id.user_id
-            else:
-                group_id = "unknown"
+        group_id = getattr(chat_stream, 'group_info', None)
+        if group_id:
+            group_id = group_id.group_id
+        else:
+            user_id = getattr(chat_stream, 'user_info', None)
+            if user_id:
+                group_id = user_id.user_id
+            else:
+                group_id = "unknown"
+
+        # --- 定期淘汰过期游戏 ---
+        _get_game_store().sweep()
+
+        ctx = CommandContext(rest_input, stream_id, group_id, config)
+        if route.needs_llm:
+            # --- 获取当前聊天上下文选中的模型，题目池低于低水位时在后台补充 (不阻塞当前命令) ---
+            ctx.model = config.resolve_model(stream_id)
+            _get_puzzle_pool().maybe_refill(config.models, config.api_url, config.api_key, config.temperature)
+        return await route.handler(self, ctx)
+
+    # --- 命令处理方法 (通过 @_command 注册到 COMMAND_ROUTES) ---
+    @_command("模型")
+    async def _cmd_model(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """列出可用模型，或按序号切换当前会话的模型"""
+        available_models = ctx.config.models
+        if not ctx.rest:
+            # 列出可用模型
+            current_model = ctx.config.resolve_model(ctx.stream_id)
+            model_list_text = "🤖 **可用模型列表**\n"
+            for i, model_name in enumerate(available_models, 1):
+                # 检查当前上下文的模型
+                marker = " (当前)" if model_name == current_model else ""
+                model_list_text += f"{i}. {model_name}{marker}\n"
+            try:
+                await self.send_text(model_list_text)
+            except Exception as e:
+                print(f"发送模型列表失败: {e}")
+            return True, "已发送模型列表", True
+
+        # 切换模型
+        try:
+            model_index = int(ctx.rest) - 1
+        except ValueError:
+            await self.send_text(f"❌ '{ctx.rest}' 不是一个有效的序号。请输入一个数字。")
+            return False, "模型序号无效", True
+        if not 0 <= model_index < len(available_models):
+            await self.send_text(f"❌ 序号 {ctx.rest} 超出范围。请输入 1 到 {len(available_models)} 之间的数字。")
+            return False, "模型序号超出范围", True
+        selected_model = available_models[model_index]
+        # 使用 stream_id 作为键存储模型选择
+        model_selections[ctx.stream_id] = selected_model
+        _get_game_store().record_model(ctx.stream_id)
+        try:
+            await self.send_text(f"✅ 已在当前会话 ({ctx.stream_id}) 切换到模型: {selected_model} (设置存储于内存)")
+        except Exception as e:
+            print(f"发送模型切换确认失败: {e}")
+        return True, f"已切换模型到 {selected_model}", True
+
+    @_command("载入")
+    async def _cmd_load(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """从 turtle.json 载入本地题目"""
+        success, message = await _load_local_turtle_soups()
+        try:
+            if success:
+                await self.send_text(f"✅ {message}")
+            else:
+                await self.send_text(f"❌ {message}")
+        except Exception as e:
+            print(f"发送载入结果失败: {e}")
+        return success, message, True
+
+    @_command("列表")
+    async def _cmd_list(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """分页列出本地题目，只解码当前页的题目名称"""
+        if not local_turtle_soups:
+            try:
+                await self.send_text(EMPTY_LIBRARY_REPLY)
+            except Exception as e:
+                print(f"发送本地题目列表失败: {e}")
+            return False, "本地题目库为空", True
+
+        page_size = ctx.config.page_size
+        total_pages = (len(local_turtle_soups) + page_size - 1) // page_size
+        try:
+            page = int(ctx.rest) if ctx.rest else 1
+        except ValueError:
+            page = 0
+        if not 1 <= page <= total_pages:
+            try:
+                await self.send_text(f"❌ 页码无效。请输入 1 到 {total_pages} 之间的数字。")
+            except Exception as e:
+                print(f"发送本地题目列表失败: {e}")
+            return False, "本地题目页码无效", True
+
+        list_text = f"📋 **已载入的本地海龟汤题目列表** (第 {page}/{total_pages} 页，共 {len(local_turtle_soups)} 个)\n"
+        for number, name in local_turtle_soups.page(page, page_size):
+            list_text += f"{number}. {name}\n"
+        if total_pages > 1:
+            list_text += "🔸 使用 `/hgt 列表 <页码>` 翻页，`/hgt 搜索 <关键词>` 搜索题目"
+
+        try:
+            await self.send_text(list_text)
+        except Exception as e:
+            print(f"发送本地题目列表失败: {e}")
+            return False, "发送本地题目列表失败", True
+        return True, "已发送本地题目列表", True
+
+    @_command("搜索")
+    async def _cmd_search(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """按名称和汤面搜索本地题目"""
+        keyword = ctx.rest
+        if not keyword:
+            try:
+                await self.send_text("❌ 请提供关键词。用法：`/hgt 搜索 <关键词>`")
+            except Exception as e:
+                print(f"发送搜索结果失败: {e}")
+            return False, "缺少关键词", True
+        if not local_turtle_soups:
+            try:
+                await self.send_text(EMPTY_LIBRARY_REPLY)
+            except Exception as e:
+                print(f"发送搜索结果失败: {e}")
+            return False, "本地题目库为空", True
+        if len(_normalize_search_text(keyword)) < SoupSearchIndex.N:
+            try:
+                await self.send_text(f"❌ 关键词至少需要 {SoupSearchIndex.N} 个字。")
+            except Exception as e:
+                print(f"发送搜索结果失败: {e}")
+            return False, "关键词过短", True
+
+        # 索引尚未建立或题库已更换时先 (增量) 更新索引
+        if soup_search_index.library is not local_turtle_soups:
+            await _single_flight.run(("搜索索引",), _refresh_search_index)
+        results = soup_search_index.search(keyword, ctx.config.search_results)
+        if not results:
+            try:
+                await self.send_text(f"❌ 没有找到与“{keyword}”相关的本地题目。")
+            except Exception as e:
+                print(f"发送搜索结果失败: {e}")
+            return True, "搜索无结果", True
+
+        result_text = f"🔎 **与“{keyword}”相关的本地题目**\n"
+        for index, _ in results:
+            result_text += f"{index + 1}. {local_turtle_soups.name(index)}\n"
+        result_text += "🔸 使用 `/hgt 本地 <序号>` 开始游戏"
+        try:
+            await self.send_text(result_text)
+        except Exception as e:
+            print(f"发送搜索结果失败: {e}")
+            return False, "发送搜索结果失败", True
+        return True, "已发送搜索结果", True
+
+    @_command("本地", needs_llm=True)
+    async def _cmd_local(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """使用随机或指定序号的本地题目开始游戏"""
+        if not local_turtle_soups:
+            try:
+                await self.send_text(EMPTY_LIBRARY_REPLY)
+            except Exception as e:
+                print(f"发送本地游戏错误消息失败: {e}")
+            return False, "本地题目库为空", True
+
+        if ctx.rest: # 如果提供了序号
+            try:
+                index = int(ctx.rest) - 1 # 用户输入从1开始，列表索引从0开始
+            except ValueError:
+                await self.send_text(f"❌ '{ctx.rest}' 不是一个有效的序号。请输入一个数字。")
+                return False, "本地题目序号无效", True
+            if not 0 <= index < len(local_turtle_soups):
+                await self.send_text(f"❌ 序号 {ctx.rest} 超出范围。请输入 1 到 {len(local_turtle_soups)} 之间的数字。")
+                return False, "本地题目序号超出范围", True
+            selected_soup = local_turtle_soups[index]
+        else: # 没有提供序号，随机选择
+            selected_soup = random.choice(local_turtle_soups)
+
+        return await self._start_new_game(
+            ctx.group_id, ctx.config.api_url, ctx.config.api_key, ctx.model, ctx.config.temperature, ctx.stream_id,
+            local_question=selected_soup["question"],
+            local_answer=selected_soup["answer"],
+            local_name=selected_soup["name"],
+            local_id=selected_soup["id"]
+        )
+
+    @_command("问题", needs_llm=True)
+    async def _cmd_question(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """向AI提问；没有问题内容或没有进行中的游戏时开始新游戏"""
+        game_state = game_states.get(ctx.group_id) # GameSession 或 None
+        if not ctx.rest or game_state is None or not game_state.active:
+            return await self._cmd_new_game(ctx)
+        # --- 同一群内相同的问题同时只判断一次，结果共享 ---
+        config = ctx.config
+        flight_key = (ctx.group_id, "问题", _normalize_question(ctx.rest))
+        return await _single_flight.run(flight_key, lambda: self._judge_question(
+            ctx.group_id, game_state, ctx.rest, config.api_url, config.api_key, ctx.model, config.temperature
+        ))
+
+    @_command("提示", needs_llm=True)
+    async def _cmd_hint(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """获取提示 (同一群并发的提示请求合并为一次)"""
+        config = ctx.config
+        return await _single_flight.run((ctx.group_id, "提示"), lambda: self._give_hint(
+            ctx.group_id, config.api_url, config.api_key, ctx.model, config.temperature
+        ))
+
+    @_command("整理线索", needs_llm=True)
+    async def _cmd_clues(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """整理线索 (同一群并发的请求合并为一次)"""
+        config = ctx.config
+        return await _single_flight.run((ctx.group_id, "整理线索"), lambda: self._organize_clues(
+            ctx.group_id, config.api_url, config.api_key, ctx.model, config.temperature
+        ))
+
+    @_command("猜谜", needs_llm=True)
+    async def _cmd_guess(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """猜测汤底；没有答案内容时开始新游戏"""
+        if not ctx.rest:
+            return await self._cmd_new_game(ctx)
+        return await self._check_guess(
+            ctx.group_id, ctx.rest, ctx.config.api_url, ctx.config.api_key, ctx.model, ctx.config.temperature
+        )
+
+    @_command("退出")
+    async def _cmd_quit(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """主动退出游戏 (持有群锁修改状态，进行中的判断完成后发现本局已结束会作废)"""
+        async with _group_locks.get(ctx.group_id):
+            game_state = game_states.get(ctx.group_id)
+            if game_state is None or not game_state.active:
+                try:
+                    await self.send_text("❌ 当前没有正在进行的游戏。")
+                except Exception as e:
+                    print(f"发送错误消息失败: {e}")
+                return False, "无游戏", True
+
+            # 重置游戏状态
+            game_state.status = GameStatus.ENDED
+            _get_game_store().record_game(ctx.group_id)
+            _discard_hint_bundle(ctx.group_id)
+
+            try:
+                await self.send_text("🚪 **游戏已退出。**\n你可以随时使用 `/hgt 问题` 重新开始游戏。")
+            except Exception as e:
+                print(f"发送退出消息失败: {e}")
+                return False, "发送退出消息失败", True
+            return True, "已退出游戏", True
+
+    @_command("统计")
+    async def _cmd_stats(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """管理员查看运行统计"""
+        return await self._send_stats()
+
+    @_command("预处理", needs_llm=True)
+    async def _cmd_annotate(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """管理员离线标注本地题库，`全部` 时忽略已有标注重新生成"""
+        config = ctx.config
+        if not self._is_admin(config.annotation_admins):
+            try:
+                await self.send_text("❌ 只有管理员可以预处理本地题库。")
+            except Exception as e:
+                print(f"发送预处理结果失败: {e}")
+            return False, "无权预处理", True
+        if not local_turtle_soups:
+            try:
+                await self.send_text(EMPTY_LIBRARY_REPLY)
+            except Exception as e:
+                print(f"发送预处理结果失败: {e}")
+            return False, "本地题目库为空", True
+        if not (config.api_url and config.api_key):
+            try:
+                await self.send_text("❌ 未配置 LLM API 地址或密钥，无法预处理。")
+            except Exception as e:
+                print(f"发送预处理结果失败: {e}")
+            return False, "缺少LLM配置", True
+
+        global annotation_task
+        # 同一时间只运行一个预处理任务
+        if annotation_task is not None and not annotation_task.done():
+            try:
+                await self.send_text("⏳ 预处理正在进行中，完成后会通知。")
+            except Exception as e:
+                print(f"发送预处理消息失败: {e}")
+            return False, "预处理进行中", True
+
+        force = ctx.rest == "全部"
+        # 标注整个题库耗时较长，在后台任务中运行，命令立即返回；完成后再发送汇总
+        annotation_task = asyncio.ensure_future(self._run_annotation(ctx, force))
+        try:
+            await self.send_text(
+                f"⏳ 开始预处理 {len(local_turtle_soups)} 个本地题目"
+                f"{'' if force else '，已标注且内容未变化的题目将跳过'}，完成后会通知。"
+            )
+        except Exception as e:
+            print(f"发送预处理消息失败: {e}")
+        return True, "已开始预处理", True
+
+    async def _run_annotation(self, ctx: CommandContext, force: bool):
+        """预处理后台任务：标注本地题库，完成或失败后向发起的聊天发送结果"""
+        config = ctx.config
+        try:
+            stats = await _annotate_library(
+                local_turtle_soups, _get_soup_annotations(), config.api_url, config.api_key, ctx.model,
+                config.temperature, concurrency=config.annotation_concurrency, force=force, prune=force
+            )
+        except asyncio.CancelledError:
+            print("[Soup Annotations] 预处理已取消")
+            raise
+        except Exception as e:
+            print(f"[Soup Annotations] 预处理失败: {e}")
+            reply = f"❌ 预处理失败: {e}"
+        else:
+            message = (
+                f"预处理完成：共 {stats['total']} 个题目，跳过 {stats['skipped']} 个，"
+                f"新标注 {stats['done']} 个，失败 {stats['failed']} 个。"
+            )
+            print(f"[Soup Annotations] {message}")
+            reply = f"{'✅' if not stats['failed'] else '⚠️'} {message}"
+        try:
+            await self.send_text(reply)
+        except Exception as e:
+            print(f"发送预处理结果失败: {e}")
+
+    @_command("帮助", "help")
+    async def _cmd_help(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """显示帮助信息"""
+        try:
+            await self.send_text(HELP_TEXT)
+        except Exception as e:
+            print(f"发送帮助信息失败: {e}")
+            return False, "发送帮助信息失败", True
+        return True, "已发送帮助信息", True
+
+    @_command("汤面")
+    async def _cmd_question_text(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """查看当前汤面（题目）"""
+        game_state = game_states.get(ctx.group_id)
+        if game_state is None or not game_state.active:
+            try:
+                await self.send_text(NO_GAME_REPLY)
+            except Exception as e:
+                print(f"发送错误消息失败: {e}")
+            return False, "无游戏", True
+
+        if not game_state.question:
+            try:
+                await self.send_text("❌ 当前没有题目。")
+            except Exception as e:
+                print(f"发送错误消息失败: {e}")
+            return False, "无题目", True
+
+        try:
+            await self.send_text(f"📖 **当前海龟汤题目（汤面）**\n\n{game_state.question}")
+        except Exception as e:
+            print(f"发送汤面失败: {e}")
+            return False, "发送汤面失败", True
+        return True, "已发送汤面", True
+
+    @_command("揭秘")
+    async def _cmd_reveal(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """揭示汤底并结束游戏 (持有群锁修改状态，进行中的判断完成后发现本局已结束会作废)"""
+        async with _group_locks.get(ctx.group_id):
+            game_state = game_states.get(ctx.group_id)
+            if game_state is None or not game_state.active:
+                try:
+                    await self.send_text(NO_GAME_REPLY)
+                except Exception as e:
+                    print(f"发送错误消息失败: {e}")
+                return False, "无游戏", True
+
+            if game_state.over:
+                try:
+                    await self.send_text("❌ 游戏已经结束。")
+                except Exception as e:
+                    print(f"发送错误消息失败: {e}")
+                return False, "游戏已结束", True
+
+            # 获取汤底并结束游戏
+            answer = game_state.answer
+            game_state.status = GameStatus.ENDED
+            _get_game_store().record_game(ctx.group_id)
+            _discard_hint_bundle(ctx.group_id)
+
+            # 发送汤底和结束信息
+            reply_text = (
+                f"🔍 **已为你揭示汤底**\n\n"
+                f"{answer}\n\n"
+                f"🔚 **游戏结束**。感谢参与！"
+            )
+            try:
+                await self.send_text(reply_text)
+            except Exception as e:
+                print(f"发送揭秘信息失败: {e}")
+                return False, "发送揭秘信息失败", True
+            return True, "已发送汤底并结束游戏", True
+
+    async def _cmd_new_game(self, ctx: CommandContext) -> Tuple[bool, Optional[str], bool]:
+        """默认动作：生成一个新的AI海龟汤题目"""
+        return await self._start_new_game(
+            ctx.group_id, ctx.config.api_url, ctx.config.api_key, ctx.model, ctx.config.temperature, ctx.stream_id
+        )
 
-        game_state = game_states.get(group_id, {})
-        if group_id not in game_states:
-            game_states[group_id] = game_state
-
-        # --- 处理不同动作 ---
-
-        # --- 新增功能：模型管理 ---
-        if action == "模型":
-            if not rest_input:
-                # 列出可用模型
-                model_list_text = "🤖 **可用模型列表**\n"
-                for i, model_name in enumerate(available_models, 1):
-                    # 检查当前上下文的模型
-                    marker = " (当前)" if model_name == current_model else ""
-                    model_list_text += f"{i}. {model_name}{marker}\n"
-                try:
-                    await self.send_text(model_list_text)
-                except Exception as e:
-                    print(f"发送模型列表失败: {e}")
-                return True, "已发送模型列表", True
-            else:
-                # 切换模型
-                try:
-                    model_index = int(rest_input) - 1
-                    if 0 <= model_index < len(available_models):
-                        selected_model = available_models[model_index]
-                        # --- 保存用户选择到全局字典 (修改后) ---
-                        # 使用 stream_id 作为键存储模型选择
-                        model_selections[stream_id] = selected_model
-                        try:
-                            # 修改提示信息，说明是存储在内存中
-                            await self.send_text(f"✅ 已在当前会话 ({stream_id}) 切换到模型: {selected_model} (设置存储于内存)")
-                        except Exception as e:
-                            print(f"发送模型切换确认失败: {e}")
-                        return True, f"已切换模型到 {selected_model}", True
-                    else:
-                        await self.send_text(f"❌ 序号 {rest_input} 超出范围。请输入 1 到 {len(available_models)} 之间的数字。")
-                        return False, "模型序号超出范围", True
-                except ValueError:
-                    await self.send_text(f"❌ '{rest_input}' 不是一个有效的序号。请输入一个数字。")
-                    return False, "模型序号无效", True
-
-        # --- 新增功能：载入本地题目 ---
-        elif action == "载入":
-            success, message = _load_local_turtle_soups()
-            try:
-                if success:
-                    await self.send_text(f"✅ {message}")
-                else:
-                    await self.send_text(f"❌ {message}")
-            except Exception as e:
-                print(f"发送载入结果失败: {e}")
-            return success, message, True
 
-        # --- 新增功能：列出本地题目 ---
-        elif action == "列表":
-            if not local_turtle_soups:
-                 try:
-                     await self.send_text("❌ 本地题目库为空。请先使用 `/hgt 载入` 命令加载题目。")
-                 except Exception as e:
-                     print(f"发送本地题目列表失败: {e}")
-                 return False, "本地题目库为空", True
+    # --- 辅助方法：运行统计 ---
+    def _is_admin(self, admins: frozenset) -> bool:
+        """发送者是否在给定的管理员列表中 (列表为空时没有管理员，一律拒绝)"""
+        sender = self._sender_id()
+        return bool(sender) and sender in admins
 
-            list_text = "📋 **已载入的本地海龟汤题目列表**\n"
-            for i, soup in enumerate(local_turtle_soups, 1):
-                list_text += f"{i}. {soup['name']}\n"
+    def _sender_id(self) -> str:
+        """发送者的用户ID，取不到时返回空字符串"""
+        message = getattr(self, "message", None)
+        user_info = getattr(getattr(message, "message_info", None), "user_info", None)
+        if user_info is None:
+            user_info = getattr(getattr(message, "chat_stream", None), "user_info", None)
+        return str(getattr(user_info, "user_id", "") or "")
 
+    async def _send_stats(self) -> Tuple[bool, Optional[str], bool]:
+        """发送按动作、模型汇总的运行统计 (仅限 metrics.admin_users)"""
+        if not self._is_admin(self._config().admin_users):
             try:
-                await self.send_text(list_text)
+                await self.send_text("❌ 只有管理员可以查看运行统计。")
             except Exception as e:
-                print(f"发送本地题目列表失败: {e}")
-                return False, "发送本地题目列表失败", True
-            return True, "已发送本地题目列表", True
-
-        # --- 修改功能：使用本地题目开始游戏 ---
-        elif action == "本地":
-             if not local_turtle_soups:
-                 try:
-                     await self.send_text("❌ 本地题目库为空。请先使用 `/hgt 载入` 命令加载题目。")
-                 except Exception as e:
-                     print(f"发送本地游戏错误消息失败: {e}")
-                 return False, "本地题目库为空", True
-
-             selected_soup = None
-             if rest_input: # 如果提供了序号
-                 try:
-                     index = int(rest_input) - 1 # 用户输入从1开始，列表索引从0开始
-                     if 0 <= index < len(local_turtle_soups):
-                         selected_soup = local_turtle_soups[index]
-                     else:
-                         await self.send_text(f"❌ 序号 {rest_input} 超出范围。请输入 1 到 {len(local_turtle_soups)} 之间的数字。")
-                         return False, "本地题目序号超出范围", True
-                 except ValueError:
-                     await self.send_text(f"❌ '{rest_input}' 不是一个有效的序号。请输入一个数字。")
-                     return False, "本地题目序号无效", True
-             else: # 没有提供序号，随机选择
-                 selected_soup = random.choice(local_turtle_soups)
-
-             if selected_soup:
-                 # 调用修改后的 _start_new_game 来启动本地游戏
-                 # --- 传递当前选中的模型 ---
-                 return await self._start_new_game(
-                     group_id, api_url, api_key, current_model, temperature, stream_id,
-                     local_question=selected_soup["question"],
-                     local_answer=selected_soup["answer"],
-                     local_name=selected_soup["name"]
-                 )
-             # 如果 selected_soup 为 None (理论上不会发生)，返回错误
-             await self.send_text("❌ 无法选择题目。")
-             return False, "无法选择本地题目", True
-
-        # --- 原有功能逻辑 ---
-        elif action == "问题" and rest_input:
-            # 用户提出问题
-            if not game_state.get("game_active", False):
-                # 如果没有正在进行的游戏，先生成一个新题目 (AI生成)
-                # --- 传递当前选中的模型 ---
-                return await self._start_new_game(group_id, api_url, api_key, current_model, temperature, stream_id)
-            else:
-                # 检查当前是否有题目
-                if not game_state.get("current_question", ""):
-                    try:
-                        await self.send_text("❌ 当前没有题目，无法提问。请先使用 `/hgt 问题` 生成题目。")
-                    except Exception as e:
-                        print(f"发送错误消息失败: {e}")
-                    return False, "无题目", True
+                print(f"发送统计信息失败: {e}")
+            return False, "无权查看统计", True
 
-                # 调用LLM判断问题是否符合汤底
-                prompt = f"""
-你是一个海龟汤游戏专家。请判断用户提出的以下问题是否符合当前海龟汤的汤底（真相）。
-当前海龟汤题目: {game_state.get('current_question', '无题目')}
-当前海龟汤答案: {game_state.get('current_answer', '无答案')}
-用户问题: {rest_input}
+        def line(name: str, item: Dict[str, float]) -> str:
+            p95 = "∞" if item["p95"] == float("inf") else f"{item['p95']:g}s"
+            return f"{name}: {item['count']} 次，失败 {item['errors']}，平均 {item['avg']:.2f}s，P95 ≤ {p95}\n"
 
-请仅回答以下四个词之一：
-- 是
-- 不是
-- 无关
-- 是也不是
+        uptime = (time.time() - metrics.started) / 60
+        text = f"📊 **海龟汤运行统计** (已运行 {uptime:.0f} 分钟)\n\n⏱️ **命令耗时**\n"
+        for action, item in sorted(metrics.summarize("command_duration_seconds", "action").items()):
+            text += line(action, item)
 
-不要添加任何解释或额外文字。
-                """
-                # --- 传递当前选中的模型 ---
-                llm_response = await self._call_llm_api(prompt, api_url, api_key, current_model, temperature)
-                if not llm_response:
-                    try:
-                        await self.send_text("❌ 调用LLM API失败，请稍后再试。")
-                    except Exception as e:
-                        print(f"发送API失败消息失败: {e}")
-                    return False, "LLM API调用失败", True
+        text += "\n🤖 **LLM 调用 (含重试)**\n"
+        tokens = metrics.counter_totals("llm_tokens_total", ("model", "kind"))
+        errors = metrics.counter_totals("llm_errors_total", ("model",))
+        for model, item in sorted(metrics.summarize("llm_call_duration_seconds", "model").items()):
+            text += line(model, item).rstrip("\n")
+            text += (
+                f"，请求错误 {errors.get((model,), 0):.0f}，"
+                f"Token 输入 {tokens.get((model, 'prompt'), 0):.0f} / 输出 {tokens.get((model, 'completion'), 0):.0f}\n"
+            )
 
-                # 处理LLM响应
-                cleaned_response = llm_response.strip().lower()
-                print(f"[LLM Question Judgment Response] {cleaned_response}")
+        text += "\n⏳ **排队与发送**\n"
+        for priority, item in sorted(metrics.summarize("llm_queue_wait_seconds", "priority").items()):
+            text += line(f"排队({priority})", item)
+        for action, item in sorted(metrics.summarize("send_duration_seconds", "action").items()):
+            text += line(f"发送({action})", item)
 
-                # 根据LLM响应决定如何回应 (修改为新格式)
-                formatted_question = rest_input.replace("\n", " ").strip() # 简单处理换行
-                if cleaned_response == "是":
-                    reply_text = f"🔍 **问题判断结果**\n问题：{formatted_question}\n答案：✅ 是"
-                elif cleaned_response == "不是":
-                    reply_text = f"🔍 **问题判断结果**\n问题：{formatted_question}\n答案：❌ 否"
-                elif cleaned_response == "无关":
-                    reply_text = f"🔍 **问题判断结果**\n问题：{formatted_question}\n答案：❓ 无关"
-                elif cleaned_response == "是也不是":
-                    reply_text = f"🔍 **问题判断结果**\n问题：{formatted_question}\n答案：🔄 是也不是"
-                else:
-                    reply_text = f"🔍 **问题判断结果**\n问题：{formatted_question}\n答案：❓ 无法判断。LLM返回: '{llm_response}'"
+        text += "\n💾 **缓存命中**\n"
+        lookups = metrics.counter_totals("cache_lookups_total", ("cache", "result"))
+        for cache in sorted({cache for cache, _ in lookups}):
+            hits, misses = lookups.get((cache, "hit"), 0), lookups.get((cache, "miss"), 0)
+            text += f"{cache}: {hits:.0f}/{hits + misses:.0f} ({hits / (hits + misses):.0%})\n" if hits + misses else ""
 
-                try:
-                    await self.send_text(reply_text)
-                except Exception as e:
-                    print(f"发送问题判断结果失败: {e}")
-                    return False, "发送问题判断失败", True
-                return True, "已发送问题判断", True
+        renders = metrics.counter_totals("prompt_renders_total", ("template",))
+        if renders:
+            text += "\n📝 **提示词 (估算输入 Token)**\n"
+            estimated = metrics.counter_totals("prompt_tokens_estimated_total", ("template",))
+            prefixes = _get_prompt_registry().prefix_tokens()
+            for (template,), count in sorted(renders.items()):
+                text += (
+                    f"{template}: {count:.0f} 次，平均 {estimated.get((template,), 0) / count:.0f}"
+                    f" (固定前缀 {prefixes.get(template, 0)})\n"
+                )
 
-        elif action == "提示":
-            # 用户请求提示
-            if not game_state.get("game_active", False):
-                try:
-                    await self.send_text("❌ 当前没有正在进行的游戏。请先使用 `/hgt 问题` 来生成题目。")
-                except Exception as e:
-                    print(f"发送错误消息失败: {e}")
-                return False, "无游戏", True
+        router = _get_llm_router().stats()
+        text += (
+            f"\n🔁 **故障转移**: 重试 {router['retries']}，切换模型 {router['failovers']}，"
+            f"对冲 {router['hedges']} (胜出 {router['hedge_wins']})\n"
+            f"🎯 **猜谜预判**: 一致 {prescreen_stats['agree']} / 不一致 {prescreen_stats['disagree']} / 待定 {prescreen_stats['undecided']}"
+        )
+        dedup = _get_dedup_index()
+        if dedup.enabled:
+            text += f"\n🧬 **题目去重**: 索引 {len(dedup)} 个题目，拒绝重复 {dedup.rejections} 次"
+        batcher = _get_question_batcher()
+        if batcher.enabled:
+            text += (
+                f"\n🧺 **问题合批**: {batcher.batches} 批共 {batcher.batched_questions} 个问题，"
+                f"逐条回退 {batcher.fallbacks} 个"
+            )
+        queue = _get_outbox()
+        if queue.enabled:
+            counts = queue.counts
+            text += (
+                f"\n📮 **发送队列**: 已发送 {counts['sent']} 条 (合并 {counts['merged']}，拆分 {counts['split']}，"
+                f"重试 {counts['retried']})，失败 {counts['failed']}，丢弃 {counts['dropped']}，排队中 {queue.pending()}"
+            )
+        try:
+            await self.send_text(text)
+        except Exception as e:
+            print(f"发送统计信息失败: {e}")
+            return False, "发送统计信息失败", True
+        return True, "已发送统计信息", True
 
-            hints_used = game_state.get("hints_used", 0)
-            if hints_used >= 3:
-                try:
-                    await self.send_text("❌ 提示次数已达上限（3次）。游戏结束。")
-                except Exception as e:
-                    print(f"发送错误消息失败: {e}")
-                return False, "提示次数超限", True
+    # --- 辅助方法：判断问题 ---
+    async def _reject_injection(self, text: str) -> bool:
+        """输入包含违禁词 (anti_abuse.ban_history) 时发送警告并返回 True"""
+        banned = _get_injection_filter(self._config().ban_history).find(text)
+        if banned is None:
+            return False
+        print(f"[Anti Abuse] 检测到违禁词: {banned}")
+        try:
+            await self.send_text("❌ 你他妈的还玩注入？")
+        except Exception as e:
+            print(f"发送错误消息失败: {e}")
+        return True
 
-            # 生成提示
-            prompt = f"""
-你是一个海龟汤游戏专家。请为以下海龟汤提供一个温和的提示，帮助玩家推理。
+    async def _judge_question(
+        self, group_id: str, game_state: "GameSession", question: str,
+        api_url: str, api_key: str, model: str, temperature: float
+    ) -> Tuple[bool, Optional[str], bool]:
+        """
+        调用LLM (或命中缓存) 判断问题是否符合汤底并发送结果。
+        判断期间不持有群锁 (同一群的不同问题可以并行判断)，记录本局状态时持有群锁，
+        等待判断后重新确认本局仍是当前进行中的游戏，期间被揭秘或换了新局时不再回复判断结果。
+        """
+        if not _is_current_game(group_id, game_state):
+            return await self._send_stale_game("问题")
+        # 检查当前是否有题目
+        if not game_state.question:
+            try:
+                await self.send_text("❌ 当前没有题目，无法提问。请先使用 `/hgt 问题` 生成题目。")
+            except Exception as e:
+                print(f"发送错误消息失败: {e}")
+            return False, "无题目", True
 
-海龟汤题目: {game_state.get('current_question', '无题目')}
-海龟汤答案: {game_state.get('current_answer', '无答案')}
+        # --- 违禁词检测 ---
+        if await self._reject_injection(question):
+            return False, "提示词注入", True
 
-请给出一个不直接透露答案的提示，用简短的句子。不要包含任何解释或答案。
-            """
-            # --- 传递当前选中的模型 ---
-            llm_response = await self._call_llm_api(prompt, api_url, api_key, current_model, temperature)
+        # --- 先查跨群判断缓存，命中时不再调用LLM ---
+        cache = _get_verdict_cache()
+        cache_key = cache.make_key(game_state.puzzle_id, model, question)
+        # --- 本地题目命中离线标注的常见问题时直接使用标注的判断 ---
+        llm_response = _get_soup_annotations().faq_verdict(game_state.puzzle_id, question)
+        if llm_response is not None:
+            metrics.inc("cache_lookups_total", cache="常见问题", result="hit")
+            print(f"[Annotation FAQ Hit] {question} -> {llm_response}")
+        else:
+            llm_response = cache.get(cache_key)
+            metrics.inc("cache_lookups_total", cache="判断缓存", result="hit" if llm_response is not None else "miss")
+            if llm_response is not None:
+                print(f"[Verdict Cache Hit] {cache_key} -> {llm_response}")
+        if llm_response is None:
+            if _get_question_batcher().enabled:
+                # --- 与同一局短时间内的其他问题合并为一次调用 ---
+                llm_response = await _get_question_batcher().judge(
+                    game_state.puzzle_id, game_state.question, game_state.answer, question,
+                    api_url, api_key, model, temperature, group_id, stream=self._stream_enabled("问题")
+                )
+            else:
+                # --- 传递当前选中的模型 (流式时识别出判断结果即停止) ---
+                prompt = _get_prompt_registry().render(
+                    "问题", question=game_state.question, answer=game_state.answer, user_question=question
+                )
+                llm_response = await self._call_llm_api(
+                    prompt, api_url, api_key, model, temperature,
+                    stream=self._stream_enabled("问题"), stop_when=_settled_verdict,
+                    priority=PRIORITY_JUDGE, group_id=group_id
+                )
             if not llm_response:
                 try:
                     await self.send_text("❌ 调用LLM API失败，请稍后再试。")
                 except Exception as e:
                     print(f"发送API失败消息失败: {e}")
                 return False, "LLM API调用失败", True
+            cache.put(cache_key, llm_response.strip().lower())
 
-            # 处理LLM响应
-            cleaned_response = llm_response.strip()
-            print(f"[LLM Hint Response] {cleaned_response}")
+        # 处理LLM响应
+        cleaned_response = llm_response.strip().lower()
+        print(f"[LLM Question Judgment Response] {cleaned_response}")
 
-            # 更新游戏状态
-            game_state["hints_used"] = hints_used + 1
-            game_states[group_id] = game_state # 保存更新后的状态
+        # 根据LLM响应决定如何回应 (修改为新格式)
+        formatted_question = question.replace("\n", " ").strip() # 简单处理换行
+        if cleaned_response == "是":
+            reply_text = f"🔍 **问题判断结果**\n问题：{formatted_question}\n答案：✅ 是"
+        elif cleaned_response == "不是":
+            reply_text = f"🔍 **问题判断结果**\n问题：{formatted_question}\n答案：❌ 否"
+        elif cleaned_response == "无关":
+            reply_text = f"🔍 **问题判断结果**\n问题：{formatted_question}\n答案：❓ 无关"
+        elif cleaned_response == "是也不是":
+            reply_text = f"🔍 **问题判断结果**\n问题：{formatted_question}\n答案：🔄 是也不是"
+        else:
+            reply_text = f"🔍 **问题判断结果**\n问题：{formatted_question}\n答案：❓ 无法判断。LLM返回: '{llm_response}'"
 
-            try:
-                await self.send_text(f"💡 **提示 ({game_state['hints_used']}/3)**\n{cleaned_response}")
-            except Exception as e:
-                print(f"发送提示失败: {e}")
-                return False, "发送提示失败", True
-            return True, "已发送提示", True
+        # --- 记入本局问答记录，整理线索时只合并新增的问答 (判断期间本局已结束或被替换时不再回复) ---
+        async with _group_locks.get(group_id):
+            if not _is_current_game(group_id, game_state):
+                current = False
+            else:
+                current = True
+                if cleaned_response in QUESTION_VERDICTS:
+                    game_state.log_question(formatted_question, cleaned_response)
+                    _get_game_store().record_game(group_id)
+        if not current:
+            return await self._send_stale_game("问题")
 
-        elif action == "整理线索":
-            # 用户请求整理线索
-            if not game_state.get("game_active", False):
-                try:
-                    await self.send_text("❌ 当前没有正在进行的游戏。请先使用 `/hgt 问题` 生成题目。")
-                except Exception as e:
-                    print(f"发送错误消息失败: {e}")
-                return False, "无游戏", True
+        try:
+            await self.send_text(reply_text)
+        except Exception as e:
+            print(f"发送问题判断结果失败: {e}")
+            return False, "发送问题判断失败", True
+        return True, "已发送问题判断", True
 
-            # 生成线索整理
-            prompt = f"""
-你是一个海龟汤游戏专家。请为以下海龟汤整理出关键线索。
+    # --- 辅助方法：提示 ---
+    async def _give_hint(
+        self, group_id: str, api_url: str, api_key: str, model: str, temperature: float
+    ) -> Tuple[bool, Optional[str], bool]:
+        """
+        发送下一条提示并累加提示次数。
+        生成提示期间不持有群锁，累加提示次数时持有群锁；
+        等待后本局已被揭秘、换了新局或提示次数已被修改时不再回复，也不累加次数。
+        """
+        game_state = game_states.get(group_id)
+        active = game_state is not None and game_state.active
+        hints_used = game_state.hints_used if active else 0
+        if not active:
+            try:
+                await self.send_text("❌ 当前没有正在进行的游戏。请先使用 `/hgt 问题` 来生成题目。")
+            except Exception as e:
+                print(f"发送错误消息失败: {e}")
+            return False, "无游戏", True
 
-海龟汤题目: {game_state.get('current_question', '无题目')}
-海龟汤答案: {game_state.get('current_answer', '无答案')}
+        if hints_used >= 3:
+            try:
+                await self.send_text("❌ 提示次数已达上限（3次）。游戏结束。")
+            except Exception as e:
+                print(f"发送错误消息失败: {e}")
+            return False, "提示次数超限", True
 
-请列出关键线索，用简洁的要点形式呈现。不要包含答案。
-            """
-            # --- 传递当前选中的模型 ---
-            llm_response = await self._call_llm_api(prompt, api_url, api_key, current_model, temperature)
+        # --- 优先使用开局预取的分级提示，预取失败时才实时生成 ---
+        bundle = await _get_hint_bundle(group_id)
+        metrics.inc("cache_lookups_total", cache="提示预取", result="hit" if bundle is not None else "miss")
+        if bundle is not None:
+            llm_response = bundle["hints"][hints_used]
+            print(f"[Hint Bundle Hit] 提示 {hints_used + 1}/3")
+        else:
+            # 生成提示
+            prompt = _get_prompt_registry().render("提示", question=game_state.question, answer=game_state.answer)
+            # --- 传递当前选中的模型 (流式时按句子分段先发出) ---
+            flusher = None
+            if self._stream_enabled("提示"):
+                flusher = _SentenceFlusher(
+                    self.send_text, f"💡 **提示 ({hints_used + 1}/3)**\n",
+                    self._config().flush_min_chars
+                )
+            llm_response = await self._call_llm_api(
+                prompt, api_url, api_key, model, temperature,
+                stream=flusher is not None, on_delta=flusher.feed if flusher else None,
+                priority=PRIORITY_HINT, group_id=group_id
+            )
             if not llm_response:
                 try:
                     await self.send_text("❌ 调用LLM API失败，请稍后再试。")
                 except Exception as e:
                     print(f"发送API失败消息失败: {e}")
                 return False, "LLM API调用失败", True
+            if flusher is not None and flusher.flushed:
+                await flusher.finish()
+                # 提示已经分段发出，本局仍在进行时才累加次数，否则这次提示作废
+                if not await self._consume_hint(group_id, game_state, hints_used):
+                    return await self._send_stale_game("提示")
+                return True, "已发送提示", True
 
-            # 处理LLM响应
-            cleaned_response = llm_response.strip()
-            print(f"[LLM Clue Response] {cleaned_response}")
+        # 处理LLM响应
+        cleaned_response = llm_response.strip()
+        print(f"[LLM Hint Response] {cleaned_response}")
 
-            try:
-                await self.send_text(f"📋 **线索整理**\n{cleaned_response}")
-            except Exception as e:
-                print(f"发送线索失败: {e}")
-                return False, "发送线索失败", True
-            return True, "已发送线索", True
+        # 更新游戏状态 (等待期间本局结束、换了新局或次数已变化时作废)
+        if not await self._consume_hint(group_id, game_state, hints_used):
+            return await self._send_stale_game("提示")
 
-        elif action == "猜谜" and rest_input:
-            # 用户尝试猜测汤底
-            if not game_state.get("game_active", False):
-                try:
-                    await self.send_text("❌ 当前没有正在进行的游戏。请先使用 `/hgt 问题` 生成题目。")
-                except Exception as e:
-                    print(f"发送错误消息失败: {e}")
-                return False, "无游戏", True
+        try:
+            await self.send_text(f"💡 **提示 ({hints_used + 1}/3)**\n{cleaned_response}")
+        except Exception as e:
+            print(f"发送提示失败: {e}")
+            return False, "发送提示失败", True
+        return True, "已发送提示", True
 
-            if game_state.get("game_over", False):
-                try:
-                    await self.send_text("❌ 游戏已经结束。请开始新的游戏。")
-                except Exception as e:
-                    print(f"发送错误消息失败: {e}")
-                return False, "游戏已结束", True
+    async def _consume_hint(self, group_id: str, game_state: "GameSession", hints_used: int) -> bool:
+        """持有群锁累加提示次数；本局已不是当前游戏或次数已被修改时返回 False"""
+        async with _group_locks.get(group_id):
+            if not _is_current_game(group_id, game_state) or game_state.hints_used != hints_used:
+                return False
+            game_state.hints_used = hints_used + 1
+            _get_game_store().record_game(group_id)
+            return True
 
-            # 检查是否已经猜过
-            guess_history = game_state.get("guess_history", [])
-            if rest_input in guess_history:
-                try:
-                    await self.send_text("❌ 你已经尝试过这个答案了。")
-                except Exception as e:
-                    print(f"发送错误消息失败: {e}")
-                return False, "重复猜测", True
+    async def _send_stale_game(self, action: str) -> Tuple[bool, Optional[str], bool]:
+        """等待LLM期间本局被揭秘、退出或换了新局时的回复"""
+        try:
+            await self.send_text(f"❌ 本局游戏已经结束或开始了新的一局，这次{action}作废。")
+        except Exception as e:
+            print(f"发送错误消息失败: {e}")
+        return False, "游戏已变化", True
 
-            # --- 从配置文件读取违禁词列表 ---
-            ban_history_from_config = self.get_config("anti_abuse.ban_history", [])
-            if any(banned.lower() in rest_input.lower() for banned in ban_history_from_config):
-                try:
-                    await self.send_text("❌ 你他妈的还玩注入？")
-                except Exception as e:
-                    print(f"发送错误消息失败: {e}")
-                return False, "提示词注入", True
+    # --- 辅助方法：整理线索 ---
+    async def _organize_clues(
+        self, group_id: str, api_url: str, api_key: str, model: str, temperature: float
+    ) -> Tuple[bool, Optional[str], bool]:
+        """发送当前题目的线索整理；等待LLM期间本局被揭秘或换了新局时不再保存和回复"""
+        game_state = game_states.get(group_id)
+        if game_state is None or not game_state.active:
+            try:
+                await self.send_text("❌ 当前没有正在进行的游戏。请先使用 `/hgt 问题` 生成题目。")
+            except Exception as e:
+                print(f"发送错误消息失败: {e}")
+            return False, "无游戏", True
 
-            # 调用LLM判断答案是否正确
-            prompt = f"""
-你是一个海龟汤游戏专家。请判断用户提出的以下答案是否是当前海龟汤的正确汤底（真相）。
-当前海龟汤题目: {game_state.get('current_question', '无题目')}
-当前海龟汤答案: {game_state.get('current_answer', '无答案')}
-用户猜测的答案: {rest_input}
+        # --- 线索整理按问答版本缓存：没有新的问答时直接复用，不调用LLM ---
+        version = game_state.qa_total
+        if game_state.clue_summary is not None and game_state.clue_version == version:
+            metrics.inc("cache_lookups_total", cache="线索整理", result="hit")
+            print(f"[Clue Cache Hit] 问答版本 {version}")
+            return await self._send_clues(game_state.clue_summary)
+        metrics.inc("cache_lookups_total", cache="线索整理", result="miss")
 
-请仅回答以下三个词之一：
-- 是
-- 不是
-- 无关
+        # --- 基础线索整理：优先使用开局预取的结果，预取失败时才实时生成 ---
+        if game_state.clue_summary is None:
+            bundle = await _get_hint_bundle(group_id)
+            metrics.inc("cache_lookups_total", cache="提示预取", result="hit" if bundle is not None else "miss")
+            if bundle is not None:
+                print("[Hint Bundle Hit] 线索整理")
+                if not self._store_clues(group_id, game_state, bundle["clues"].strip(), 0):
+                    return await self._send_stale_game("整理线索")
+            else:
+                # 还没有问答时直接流式发出，否则先生成基础整理再合并问答
+                prompt = _get_prompt_registry().render("整理线索", question=game_state.question, answer=game_state.answer)
+                sent, llm_response = await self._stream_clues(
+                    prompt, api_url, api_key, model, temperature, group_id, stream=version == 0
+                )
+                if not llm_response:
+                    return await self._send_clue_failure()
+                if not self._store_clues(group_id, game_state, llm_response.strip(), 0):
+                    return await self._send_stale_game("整理线索")
+                if sent:
+                    return True, "已发送线索", True
 
-不要添加任何解释或额外文字。
-            """
-            # --- 传递当前选中的模型 ---
-            llm_response = await self._call_llm_api(prompt, api_url, api_key, current_model, temperature)
+        # --- 增量更新：只发送上次整理之后新增的问答和上次的整理结果 ---
+        entries = game_state.questions_since(game_state.clue_version, version)
+        if entries:
+            first = version - len(entries) + 1
+            prompt = _get_prompt_registry().render(
+                "线索更新", question=game_state.question, summary=game_state.clue_summary,
+                entries="\n".join(f"{i}. 问：{q} 答：{v}" for i, (q, v) in enumerate(entries, first))
+            )
+            sent, llm_response = await self._stream_clues(prompt, api_url, api_key, model, temperature, group_id)
             if not llm_response:
-                try:
-                    await self.send_text("❌ 调用LLM API失败，请稍后再试。")
-                except Exception as e:
-                    print(f"发送API失败消息失败: {e}")
-                return False, "LLM API调用失败", True
+                return await self._send_clue_failure()
+            if not self._store_clues(group_id, game_state, llm_response.strip(), version):
+                return await self._send_stale_game("整理线索")
+            if sent:
+                return True, "已发送线索", True
+        return await self._send_clues(game_state.clue_summary)
 
-            # 处理LLM响应
-            cleaned_response = llm_response.strip().lower()
-            print(f"[LLM Guess Response] {cleaned_response}")
-
-            # 更新游戏状态
-            guess_history.append(rest_input)
-            game_state["guess_history"] = guess_history
-            game_states[group_id] = game_state # 保存更新后的状态
-
-            # 根据LLM响应决定如何回应
-            if cleaned_response == "是":
-                # 猜对了
-                answer = game_state.get('current_answer', '无答案')
-                reply_text = (
-                    f"🎉 **恭喜你猜对了！**\n"
-                    f"✅ **正确答案是：**\n{answer}\n"
-                    f"🎊 **游戏结束！**"
-                )
-                game_state["game_over"] = True
-                game_states[group_id] = game_state # 保存更新后的状态
-            elif cleaned_response == "不是":
-                # 猜错了
-                reply_text = (
-                    f"❌ **很遗憾，这不是正确答案。**\n"
-                    f"💡 当前提示次数: {game_state.get('hints_used', 0)}/3\n"
-                    f"🔄 请继续提问或使用提示来推理。"
-                )
-            elif cleaned_response == "无关":
-                reply_text = "❓ **你看看你在说啥。**"
-            else:
-                reply_text = f"❓ **无法判断。** LLM返回: '{llm_response}'"
+    def _store_clues(self, group_id: str, game_state: "GameSession", clues: str, version: int) -> bool:
+        """保存线索整理及其覆盖的问答版本并写入状态日志；本局已不是当前进行中的游戏时不保存，返回 False"""
+        if not _is_current_game(group_id, game_state):
+            return False
+        game_state.set_clues(clues, version)
+        _get_game_store().record_game(group_id)
+        return True
 
-            try:
-                await self.send_text(reply_text)
-            except Exception as e:
-                print(f"发送猜测结果失败: {e}")
-                return False, "发送猜测结果失败", True
-            return True, "已发送猜测结果", True
+    async def _stream_clues(
+        self, prompt: List[Dict[str, str]], api_url: str, api_key: str, model: str, temperature: float,
+        group_id: str, stream: bool = True
+    ) -> Tuple[bool, Optional[str]]:
+        """生成线索整理，返回 (是否已流式发出, 完整回复)"""
+        # --- 传递当前选中的模型 (流式时按句子分段先发出) ---
+        flusher = None
+        if stream and self._stream_enabled("整理线索"):
+            flusher = _SentenceFlusher(
+                self.send_text, "📋 **线索整理**\n",
+                self._config().flush_min_chars
+            )
+        llm_response = await self._call_llm_api(
+            prompt, api_url, api_key, model, temperature,
+            stream=flusher is not None, on_delta=flusher.feed if flusher else None,
+            priority=PRIORITY_HINT, group_id=group_id
+        )
+        if llm_response and flusher is not None and flusher.flushed:
+            await flusher.finish()
+            print(f"[LLM Clue Response] {llm_response.strip()}")
+            return True, llm_response
+        return False, llm_response
 
-        elif action == "退出":
-            # 用户主动退出游戏
-            if not game_state.get("game_active", False):
-                try:
-                    await self.send_text("❌ 当前没有正在进行的游戏。")
-                except Exception as e:
-                    print(f"发送错误消息失败: {e}")
-                return False, "无游戏", True
+    async def _send_clue_failure(self) -> Tuple[bool, Optional[str], bool]:
+        try:
+            await self.send_text("❌ 调用LLM API失败，请稍后再试。")
+        except Exception as e:
+            print(f"发送API失败消息失败: {e}")
+        return False, "LLM API调用失败", True
 
-            # 重置游戏状态
-            game_state["game_active"] = False
-            game_state["game_over"] = True
-            game_states[group_id] = game_state # 保存更新后的状态
+    async def _send_clues(self, clues: str) -> Tuple[bool, Optional[str], bool]:
+        print(f"[LLM Clue Response] {clues}")
+        try:
+            await self.send_text(f"📋 **线索整理**\n{clues}")
+        except Exception as e:
+            print(f"发送线索失败: {e}")
+            return False, "发送线索失败", True
+        return True, "已发送线索", True
 
+    # --- 辅助方法：猜谜 ---
+    async def _check_guess(
+        self, group_id: str, guess: str,
+        api_url: str, api_key: str, model: str, temperature: float
+    ) -> Tuple[bool, Optional[str], bool]:
+        """
+        判断猜测是否为正确汤底。
+        判断期间不持有群锁，之后持有群锁重新确认本局仍在进行 (没有被猜对、揭秘或换了新局) 再修改状态，
+        否则这次猜测作废。
+        """
+        game_state = game_states.get(group_id)
+        if game_state is None or not game_state.active:
             try:
-                await self.send_text("🚪 **游戏已退出。**\n你可以随时使用 `/hgt 问题` 重新开始游戏。")
+                await self.send_text("❌ 当前没有正在进行的游戏。请先使用 `/hgt 问题` 生成题目。")
             except Exception as e:
-                print(f"发送退出消息失败: {e}")
-                return False, "发送退出消息失败", True
-            return True, "已退出游戏", True
+                print(f"发送错误消息失败: {e}")
+            return False, "无游戏", True
 
-        elif action == "帮助":
-            # 显示帮助信息 (更新帮助文本)
-            help_text = (
-                "📖 **海龟汤游戏帮助信息**\n\n"
-                "🎯 **指令列表**\n"
-                "🔸 `/hgt 问题` - 生成AI海龟汤题目\n"
-                "🔸 `/hgt 问题 <问题>` - 向AI提问\n"
-                "🔸 `/hgt 提示` - 获取提示（最多3次）\n"
-                "🔸 `/hgt 整理线索` - 整理关键线索\n"
-                "🔸 `/hgt 猜谜 <答案>` - 猜测汤底\n"
-                "🔸 `/hgt 揭秘` - 直接揭示汤底并结束游戏\n"
-                "🔸 `/hgt 退出` - 退出当前游戏\n"
-                "🔸 `/hgt 汤面` - 查看当前题目（汤面）\n"
-                "🔸 `/hgt 帮助` - 查看此帮助信息\n"
-                "🔸 `/hgt 载入` - 从 `turtle.json` 载入本地题目\n"
-                "🔸 `/hgt 列表` - 查看已载入的本地题目列表\n"
-                "🔸 `/hgt 本地` - 随机使用一个已载入的本地题目开始游戏\n"
-                "🔸 `/hgt 本地 <序号>` - 使用指定序号的已载入本地题目开始游戏\n"
-                "🔸 `/hgt 模型` - 列出可用模型\n"
-                "🔸 `/hgt 模型 <序号>` - 切换模型\n\n"
-                "💡 **游戏提示**\n"
-                "🔹 使用 `/hgt 问题` 或 `/hgt 本地` 开始游戏\n"
-                "🔹 通过提问和提示推理汤底\n"
-                "🔹 猜对后游戏结束\n"
-                "🔹 可以随时使用 `/hgt 退出` 退出游戏"
-            )
-            try:
-                await self.send_text(help_text)
+        if game_state.over:
+            try:
+                await self.send_text("❌ 游戏已经结束。请开始新的游戏。")
             except Exception as e:
-                print(f"发送帮助信息失败: {e}")
-                return False, "发送帮助信息失败", True
-            return True, "已发送帮助信息", True
-
-        elif action == "汤面":
-            # 用户查看汤面（题目）
-            if not game_state.get("game_active", False):
-                try:
-                    await self.send_text("❌ 当前没有正在进行的游戏。请先使用 `/hgt 问题` 生成题目。")
-                except Exception as e:
-                    print(f"发送错误消息失败: {e}")
-                return False, "无游戏", True
-
-            if not game_state.get("current_question", ""):
-                try:
-                    await self.send_text("❌ 当前没有题目。")
-                except Exception as e:
-                    print(f"发送错误消息失败: {e}")
-                return False, "无题目", True
+                print(f"发送错误消息失败: {e}")
+            return False, "游戏已结束", True
 
+        # 检查是否已经猜过
+        if game_state.has_guessed(guess):
             try:
-                await self.send_text(f"📖 **当前海龟汤题目（汤面）**\n\n{game_state.get('current_question', '无题目')}")
+                await self.send_text("❌ 你已经尝试过这个答案了。")
             except Exception as e:
-                print(f"发送汤面失败: {e}")
-                return False, "发送汤面失败", True
-            return True, "已发送汤面", True
+                print(f"发送错误消息失败: {e}")
+            return False, "重复猜测", True
 
-        elif action == "揭秘":
-            # 用户主动要求揭示汤底
-            if not game_state.get("game_active", False):
-                try:
-                    await self.send_text("❌ 当前没有正在进行的游戏。请先使用 `/hgt 问题` 生成题目。")
-                except Exception as e:
-                    print(f"发送错误消息失败: {e}")
-                return False, "无游戏", True
+        # --- 违禁词检测 ---
+        if await self._reject_injection(guess):
+            return False, "提示词注入", True
 
-            if game_state.get("game_over", False):
+        # --- 本地预判：明确猜中或明显无关时可不调用LLM ---
+        config = self._config()
+        prescreen_mode = config.prescreen_mode
+        local_verdict, local_score = None, 0.0
+        if prescreen_mode in ("shadow", "enforce"):
+            local_verdict, local_score = _prescreen_guess(
+                guess, game_state.question, game_state.answer,
+                config.prescreen_accept,
+                config.prescreen_reject,
+            )
+
+        if prescreen_mode == "enforce" and local_verdict is not None:
+            print(f"[Guess Prescreen] 本地判定 {local_verdict} (得分 {local_score:.3f})，跳过LLM调用")
+            llm_response = local_verdict
+        else:
+            llm_response = await self._request_guess_verdict(
+                game_state, guess, api_url, api_key, model, temperature, group_id
+            )
+            if not llm_response:
                 try:
-                    await self.send_text("❌ 游戏已经结束。")
+                    await self.send_text("❌ 调用LLM API失败，请稍后再试。")
                 except Exception as e:
-                    print(f"发送错误消息失败: {e}")
-                return False, "游戏已结束", True
-
-            # 获取汤底
-            answer = game_state.get('current_answer', '无答案')
+                    print(f"发送API失败消息失败: {e}")
+                return False, "LLM API调用失败", True
+            if prescreen_mode == "shadow":
+                _record_prescreen_agreement(local_verdict, llm_response.strip().lower(), local_score)
 
-            # 结束游戏
-            game_state["game_over"] = True
-            game_state["game_active"] = False # 也标记为非活跃，表示游戏完全结束
-            game_states[group_id] = game_state # 保存更新后的状态
+        # 处理LLM响应
+        cleaned_response = llm_response.strip().lower()
+        print(f"[LLM Guess Response] {cleaned_response}")
 
-            # 发送汤底和结束信息
-            reply_text = (
-                f"🔍 **已为你揭示汤底**\n\n"
-                f"{answer}\n\n"
-                f"🔚 **游戏结束**。感谢参与！"
-            )
-            try:
-                await self.send_text(reply_text)
-            except Exception as e:
-                print(f"发送揭秘信息失败: {e}")
-                return False, "发送揭秘信息失败", True
-            return True, "已发送汤底并结束游戏", True
+        # 更新游戏状态 (判断期间本局已被猜对、结束或换了新局时作废)
+        async with _group_locks.get(group_id):
+            if not _is_current_game(group_id, game_state) or game_state.over:
+                current = False
+            else:
+                current = True
+                game_state.add_guess(guess)
 
-        else:
-            # 默认情况：生成一个新的AI海龟汤题目
-            # --- 传递当前上下文选中的模型 ---
-            return await self._start_new_game(group_id, api_url, api_key, current_model, temperature, stream_id)
+                # 根据LLM响应决定如何回应
+                if cleaned_response == "是":
+                    # 猜对了
+                    answer = game_state.answer
+                    reply_text = (
+                        f"🎉 **恭喜你猜对了！**\n"
+                        f"✅ **正确答案是：**\n{answer}\n"
+                        f"🎊 **游戏结束！**"
+                    )
+                    game_state.status = GameStatus.SOLVED
+                elif cleaned_response == "不是":
+                    # 猜错了
+                    reply_text = (
+                        f"❌ **很遗憾，这不是正确答案。**\n"
+                        f"💡 当前提示次数: {game_state.hints_used}/3\n"
+                        f"🔄 请继续提问或使用提示来推理。"
+                    )
+                elif cleaned_response == "无关":
+                    reply_text = "❓ **你看看你在说啥。**"
+                else:
+                    reply_text = f"❓ **无法判断。** LLM返回: '{llm_response}'"
+                _get_game_store().record_game(group_id)
+        if not current:
+            return await self._send_stale_game("猜测")
 
-        # 为了防止意外情况，添加一个默认返回
-        # 但理想情况下，上面的 if/elif 应该覆盖所有情况
-        # 这里可以返回一个通用的错误提示
         try:
-             await self.send_text("❌ 未知命令或参数。请使用 `/hgt 帮助` 查看可用命令。")
+            await self.send_text(reply_text)
         except Exception as e:
-             print(f"发送未知命令错误失败: {e}")
-        return False, "未知命令或参数", True
+            print(f"发送猜测结果失败: {e}")
+            return False, "发送猜测结果失败", True
+        return True, "已发送猜测结果", True
 
+    async def _request_guess_verdict(
+        self, game_state: "GameSession", guess: str,
+        api_url: str, api_key: str, model: str, temperature: float, group_id: str
+    ) -> Optional[str]:
+        """调用LLM判断答案是否正确，返回原始回复，失败时返回 None"""
+        prompt = _get_prompt_registry().render(
+            "猜谜", question=game_state.question, answer=game_state.answer, guess=guess
+        )
+        # --- 传递当前选中的模型 (流式时识别出判断结果即停止) ---
+        return await self._call_llm_api(
+            prompt, api_url, api_key, model, temperature,
+            stream=self._stream_enabled("猜谜"), stop_when=_settled_verdict,
+            priority=PRIORITY_JUDGE, group_id=group_id
+        )
 
     # --- 辅助方法：开始新游戏 (修改以支持本地题目) ---
     async def _start_new_game(
         self, group_id: str, api_url: str, api_key: str, model: str,
         temperature: float, stream_id: str,
-        local_question: str = None, local_answer: str = None, local_name: str = None
+        local_question: str = None, local_answer: str = None, local_name: str = None,
+        local_id: str = None
     ) -> Tuple[bool, Optional[str], bool]:
         """
         开始一个新的海龟汤游戏。
+        同一群同时发起的多个开局请求合并为一次，只生成一个题目。
+        """
+        async def start():
+            async with _group_locks.get(group_id):
+                return await self._create_game(
+                    group_id, api_url, api_key, model, temperature, stream_id,
+                    local_question, local_answer, local_name, local_id
+                )
+        return await _single_flight.run((group_id, "开局"), start)
+
+    async def _create_game(
+        self, group_id: str, api_url: str, api_key: str, model: str,
+        temperature: float, stream_id: str,
+        local_question: str = None, local_answer: str = None, local_name: str = None,
+        local_id: str = None
+    ) -> Tuple[bool, Optional[str], bool]:
+        """
+        创建新游戏，调用方需持有该群的锁。
         如果提供了 local_question 和 local_answer，则使用本地题目。
         否则，调用LLM生成新题目。
         """
@@ -807,92 +5678,64 @@ class HaiTurtleSoupCommand(BaseCommand):
         is_local_game = local_question is not None and local_answer is not None
 
         if not is_local_game:
-            # --- 原有AI生成逻辑 ---
-            prompt = """
-你是一个专业的海龟汤故事生成器。请生成一个有趣的海龟汤题目。
-
-要求：
-1. 题目必须是海龟汤风格的推理谜题，包含一个看似矛盾或奇怪的情境。
-2. 题目应该简洁明了，容易理解。
-3. 题目结尾应该留有悬念，让人好奇真相。
-4. 生成的题目应该是原创的，不要复制已有例子。
-5. 请以纯文本形式返回，不要包含任何HTML、Markdown或其他格式。
-6. 不要包含任何解释、分析或答案。
-
-请生成一个海龟汤题目。
-
-可以参考的海龟汤汤面and汤底（仅供参考，可以套模版或者直接搬，但是严格按照输出格式，仅输出汤面）：
-1.【子的爱】
-汤面：我的父母都不理我，但我还是很爱他们。
-汤底：小时候我是个很听话的孩子，爸爸妈妈经常给我好吃的水果，我吃不完。他们就告诉我喜欢的东西一定要放进冰箱，这样可以保鲜，记得那时候他们工作可辛苦了，经常加班到深夜。没睡过一个好觉。于是我耍了个小聪明，在他们的水里下了安眠药。他们睡得可香了，然后我把他们放进冰箱里，从那以后我每天都会对他们说：爸爸妈妈我爱你们。现在我都六十了，他们还是那么年轻。
-
-2.【舞】
-汤面：我六岁那年，外公去世，我和亲人一起去祭奠，和姐姐玩捉迷藏，然后我对母亲说了句话把她吓昏了过去。
-汤底：我去参加外公的葬礼，同行的还有比我大两岁的姐姐，我和她完捉迷藏我没有找到她没想到她躲在了纸做的房子里，当纸房子被点燃，我看见姐姐在跳舞，我对妈说，妈姐姐在那房子里面跳舞，因为姐姐被烧死了，我一直记得这个事。
-
-3.【插进来】
-汤面：他迅速的插进来，又迅速的拔出去。反反复复，我流血了。他满头大汗，露出了笑容。"啊，好舒服"
-汤底：他是护士，在给我打针，针头打进血管里面会回血，因此说明成功了。流汗是因为反反复复了好几次。
-
-4.【无罪】
-汤面："她是自愿的！"尸体无暴力痕迹，凶手被判无罪。"我是无罪的！"尸体有暴力痕迹，凶手也被判无罪。
-汤底：第一幕：女儿为救他人（如器官移植）自愿牺牲，所以"自愿"且无暴力痕迹，他人无罪。第二幕：父亲无法接受女儿死亡真相，杀害了被判无罪的人，但法医发现此人所受暴力伤害与父亲行为不符（或父亲伪造证据），真相是女儿死于意外，父亲为报复误杀他人，故父亲也称自己"无罪"，但法律上仍有罪。
-            """
-            # --- 传递当前选中的模型 ---
-            llm_response = await self._call_llm_api(prompt, api_url, api_key, model, temperature)
-            if not llm_response:
-                try:
-                    await self.send_text("❌ 调用LLM API失败，请稍后再试。")
-                except Exception as e:
-                    print(f"发送API失败消息失败: {e}")
-                return False, "LLM API调用失败", True
-            question = llm_response.strip()
-            print(f"[LLM Question Response] {question}")
-
-            answer_prompt = f"""
-你是一个专业的海龟汤故事专家。请为以下海龟汤题目生成一个合理的答案。
-
-题目: {question}
-
-请仅给出答案，不要包含任何解释或额外文字。
-可以参考的海龟汤汤面and汤底（仅供参考，可以套模版或者直接搬，但是严格按照输出格式，仅输出汤底）：
-1.【子的爱】
-汤面：我的父母都不理我，但我还是很爱他们。
-汤底：小时候我是个很听话的孩子，爸爸妈妈经常给我好吃的水果，我吃不完。他们就告诉我喜欢的东西一定要放进冰箱，这样可以保鲜，记得那时候他们工作可辛苦了，经常加班到深夜。没睡过一个好觉。于是我耍了个小聪明，在他们的水里下了安眠药。他们睡得可香了，然后我把他们放进冰箱里，从那以后我每天都会对他们说：爸爸妈妈我爱你们。现在我都六十了，他们还是那么年轻。
-
-2.【舞】
-汤面：我六岁那年，外公去世，我和亲人一起去祭奠，和姐姐玩捉迷藏，然后我对母亲说了句话把她吓昏了过去。
-汤底：我去参加外公的葬礼，同行的还有比我大两岁的姐姐，我和她完捉迷藏我没有找到她没想到她躲在了纸做的房子里，当纸房子被点燃，我看见姐姐在跳舞，我对妈说，妈姐姐在那房子里面跳舞，因为姐姐被烧死了，我一直记得这个事。
-
-3.【插进来】
-汤面：他迅速的插进来，又迅速的拔出去。反反复复，我流血了。他满头大汗，露出了笑容。"啊，好舒服"
-汤底：他是实习护士，在给我打针，针头打进血管里面会回血，因此说明成功了。流汗是因为反反复复了好几次，让人紧张。
-
-4.【无罪】
-汤面："她是自愿的！"尸体无暴力痕迹，凶手被判无罪。"我是无罪的！"尸体有暴力痕迹，凶手也被判无罪。
-汤底：第一幕：女儿为救他人（如器官移植）自愿牺牲，所以"自愿"且无暴力痕迹，他人无罪。第二幕：父亲无法接受女儿死亡真相，杀害了被判无罪的人，但法医发现此人所受暴力伤害与父亲行为不符（或父亲伪造证据），真相是女儿死于意外，父亲为报复误杀他人，故父亲也称自己"无罪"，但法律上仍有罪。
-            """
-            # --- 传递当前选中的模型 ---
-            answer_response = await self._call_llm_api(answer_prompt, api_url, api_key, model, temperature)
-            if not answer_response:
-                try:
-                    await self.send_text("❌ 生成答案失败，请稍后再试。")
-                except Exception as e:
-                    print(f"发送答案失败消息失败: {e}")
-                return False, "生成答案失败", True
-            answer = answer_response.strip()
-            print(f"[LLM Answer Response] {answer}")
+            # --- 优先从预生成题目池取题，池为空时才实时生成 ---
+            generated = _get_puzzle_pool().pop(model)
+            if _get_puzzle_pool().enabled:
+                metrics.inc("cache_lookups_total", cache="题目池", result="hit" if generated is not None else "miss")
+            if generated is not None:
+                print(f"[Puzzle Pool] 模型 {model} 命中预生成题目，剩余 {_get_puzzle_pool().available(model)} 个。")
+                _get_puzzle_pool().maybe_refill([model], api_url, api_key, temperature)
+            # --- 实时生成；与已有题目近似重复时先换题目池中的题，没有再重新生成 ---
+            retries = self._config().dedup_retries
+            attempt = 0
+            while generated is None:
+                generated, error = await self._generate_puzzle(api_url, api_key, model, temperature, group_id)
+                if generated is None:
+                    try:
+                        await self.send_text(f"❌ {error}，请稍后再试。")
+                    except Exception as e:
+                        print(f"发送生成失败消息失败: {e}")
+                    return False, error, True
+                if _get_dedup_index().admit(*generated, source="开局"):
+                    break
+                generated = None # 被判为重复的题目不会发给玩家
+                if attempt >= retries:
+                    break
+                attempt += 1
+                generated = _get_puzzle_pool().pop(model)
+            if generated is None:
+                # 重试次数用完仍然重复：改用随机的本地题目，题库为空时本次开局失败
+                if not local_turtle_soups:
+                    try:
+                        await self.send_text("❌ 生成的题目与已有题目重复，请稍后再试。")
+                    except Exception as e:
+                        print(f"发送生成失败消息失败: {e}")
+                    return False, "题目重复", True
+                local_soup = random.choice(local_turtle_soups)
+                print(f"[Puzzle Dedup] 重新生成 {retries} 次后仍然重复，改用本地题目【{local_soup['name']}】")
+                question, answer = local_soup["question"], local_soup["answer"]
+                local_name, local_id = local_soup["name"], local_soup["id"]
+                is_local_game = True
+            else:
+                question, answer = generated
             # --- AI生成逻辑结束 ---
 
         # --- 通用游戏状态保存和消息发送逻辑 ---
-        game_states[group_id] = {
-            "current_question": question,
-            "current_answer": answer,
-            "hints_used": 0,
-            "game_active": True,
-            "guess_history": [],
-            "game_over": False
-        }
+        local_soup = local_turtle_soups.get(local_id) if local_id else None
+        if local_soup is not None:
+            game_states[group_id] = GameSession.from_local(local_soup) # 只引用题库中的题目，不复制文本
+        else:
+            game_states[group_id] = GameSession.from_text(question, answer)
+        _get_game_store().record_game(group_id)
+
+        # --- 后台预取分级提示和线索整理，提示/整理线索时直接使用 ---
+        _discard_hint_bundle(group_id)
+        # 已离线标注的本地题目由 _get_hint_bundle 直接读取标注，不需要预取
+        annotated = local_soup is not None and _get_soup_annotations().bundle(local_soup["id"]) is not None
+        if not annotated and self._config().prefetch_enabled and api_url and api_key:
+            hint_bundles[group_id] = asyncio.create_task(
+                _prefetch_hint_bundle(question, answer, api_url, api_key, model, temperature, group_id)
+            )
 
         game_type_text = " (本地题目)" if is_local_game and local_name else ""
         name_text = f"【{local_name}】" if is_local_game and local_name else ""
@@ -914,40 +5757,91 @@ class HaiTurtleSoupCommand(BaseCommand):
 
         return True, "已发送题目", True
 
+    async def _generate_puzzle(
+        self, api_url: str, api_key: str, model: str, temperature: float, group_id: str = ""
+    ) -> Tuple[Optional[Tuple[str, str]], Optional[str]]:
+        """按配置选择单次结构化生成或原有两步生成，返回 ((汤面, 汤底), None) 或 (None, 错误原因)"""
+        if self._config().generation_mode == "single":
+            generated = await self._generate_puzzle_single(api_url, api_key, model, temperature, group_id)
+            if generated is not None:
+                return generated, None
+            print("[Puzzle Generation] 单次结构化生成失败，回退到两步生成。")
+        return await self._generate_puzzle_two_step(api_url, api_key, model, temperature, group_id)
+
+    # --- 辅助方法：两步生成题目 (先汤面后汤底) ---
+    async def _generate_puzzle_two_step(
+        self, api_url: str, api_key: str, model: str, temperature: float, group_id: str = ""
+    ) -> Tuple[Optional[Tuple[str, str]], Optional[str]]:
+        """
+        分两次调用LLM，先生成汤面，再根据汤面生成汤底。
+        返回 ((汤面, 汤底), None)；失败时返回 (None, 错误原因)。
+        """
+        prompts = _get_prompt_registry()
+        prompt = prompts.render("汤面")
+        # --- 传递当前选中的模型 ---
+        llm_response = await self._call_llm_api(prompt, api_url, api_key, model, temperature, group_id=group_id)
+        if not llm_response:
+            return None, "调用LLM API失败"
+        question = llm_response.strip()
+        print(f"[LLM Question Response] {question}")
+
+        answer_prompt = prompts.render("汤底", question=question)
+        # --- 传递当前选中的模型 ---
+        answer_response = await self._call_llm_api(answer_prompt, api_url, api_key, model, temperature, group_id=group_id)
+        if not answer_response:
+            return None, "生成答案失败"
+        answer = answer_response.strip()
+        print(f"[LLM Answer Response] {answer}")
+        return (question, answer), None
+
+    # --- 辅助方法：单次结构化生成题目 ---
+    async def _generate_puzzle_single(
+        self, api_url: str, api_key: str, model: str, temperature: float, group_id: str = ""
+    ) -> Optional[Tuple[str, str]]:
+        """
+        一次LLM调用同时生成汤面和汤底 (JSON格式)。
+        输出不合法时把原输出交给LLM修复一次；仍失败则返回 None，由调用方回退到两步生成。
+        """
+        llm_response = await self._call_llm_api(
+            _get_prompt_registry().render("出题"), api_url, api_key, model, temperature,
+            max_tokens=1000, group_id=group_id
+        )
+        if not llm_response:
+            return None
+        print(f"[LLM Puzzle JSON Response] {llm_response}")
+        parsed = _parse_puzzle_json(llm_response)
+        if parsed is not None:
+            return parsed
+
+        # 修复重试：只重试一次，温度置0以获得稳定格式
+        repair_prompt = _get_prompt_registry().render("修复", bad_output=llm_response)
+        repaired = await self._call_llm_api(repair_prompt, api_url, api_key, model, 0.0, max_tokens=1000, group_id=group_id)
+        if not repaired:
+            return None
+        print(f"[LLM Puzzle JSON Repair Response] {repaired}")
+        return _parse_puzzle_json(repaired)
+
     # --- LLM API 调用辅助方法 ---
-    async def _call_llm_api(self, prompt: str, api_url: str, api_key: str, model: str, temperature: float) -> str:
+    async def _call_llm_api(
+        self, prompt: Union[str, List[Dict[str, str]]], api_url: str, api_key: str, model: str, temperature: float,
+        max_tokens: int = 500, stream: bool = False,
+        on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+        stop_when: Optional[Callable[[str], Optional[str]]] = None,
+        priority: int = PRIORITY_GENERATE, group_id: str = ""
+    ) -> str:
         """
         调用OpenAI格式的LLM API并返回响应文本
         """
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        payload = {
-            "model": model, # --- 使用传入的模型名称 ---
-            "messages": [
-                {"role": "system", "content": "你是一个专业的海龟汤故事生成器和解释者。"},
-                {"role": "user", "content": prompt}
-            ],
-            "temperature": temperature,
-            "max_tokens": 500, # 增加最大token数以容纳较长的回答
-            "stream": False # 设置为False，因为我们不使用流式输出
-        }
+        return await _request_llm(
+            prompt, api_url, api_key, model, temperature, max_tokens,
+            stream=stream, on_delta=on_delta, stop_when=stop_when,
+            priority=priority, group_id=group_id
+        )
 
-        try:
-            timeout = aiohttp.ClientTimeout(total=30) # 设置超时
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(api_url, headers=headers, json=payload) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        # 根据OpenAI API响应结构提取回复
-                        # 假设回复在 choices[0].message.content 中
-                        content = data.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
-                        return content
-                    else:
-                        error_text = await response.text()
-                        print(f"LLM API 请求失败: Status {response.status}, Body: {error_text}")
-                        return "" # 返回空字符串表示失败
-        except Exception as e:
-            print(f"调用LLM API时发生异常: {e}")
-            return "" # 返回空字符串表示失败
+    def _stream_enabled(self, action: str) -> bool:
+        """该动作是否在配置中启用了流式输出"""
+        return action in self._config().streaming_actions
+
+
+# 未注册的动作默认开始一个新的AI题目
+_DEFAULT_ROUTE = CommandRoute("", HaiTurtleSoupCommand._cmd_new_game, needs_llm=True)